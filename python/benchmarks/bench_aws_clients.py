@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark: boto3.client per call vs the cached client factory.
+
+Run from the `python` folder: PYTHONPATH=. python benchmarks/bench_aws_clients.py [iterations]
+No AWS call is made, only client creation is measured.
+"""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2019 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import os
+import sys
+import timeit
+
+import boto3
+
+from metamorphctl.utils.awsutils import clear_clients, get_client
+
+SERVICES = ['ec2', 'iam', 's3', 'elbv2', 'eks']
+
+
+def _uncached():
+    for service in SERVICES:
+        boto3.client(service)
+
+
+def _cached():
+    for service in SERVICES:
+        get_client(service)
+
+
+def main(iterations=20):
+    """Print the time spent building clients with and without the factory."""
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    clear_clients()
+    # warm up botocore loaders and the factory cache, only steady state calls are measured
+    _uncached()
+    _cached()
+
+    uncached = timeit.timeit(_uncached, number=iterations)
+    cached = timeit.timeit(_cached, number=iterations)
+    calls = iterations * len(SERVICES)
+    print('boto3.client: {:8.3f} ms/client'.format(uncached * 1000 / calls))
+    print('get_client:   {:8.3f} ms/client'.format(cached * 1000 / calls))
+    print('speedup:      {:8.1f}x'.format(uncached / cached))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""Offline benchmark of the inventory collectors and the excel report.
+
+Run from the `python` folder: PYTHONPATH=. python benchmarks/bench_inventory.py [scale ...]
+Scales default to 1 and 10. At 100x the synthetic account has 10k instances and the
+synthetic cluster 100k pods. No network is used: AWS answers come from botocore stubs,
+kubernetes from a fake REST client and etcd from a fake client.
+Memory is traced with tracemalloc while timing, so compare seconds between runs of this
+script only.
+"""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from unittest import mock
+from urllib.parse import urlparse
+
+import botocore.session
+from botocore.awsrequest import AWSResponse
+from botocore.stub import Stubber
+from etcd import EtcdResult
+from kubernetes.client.rest import RESTClientObject
+
+from metamorphctl.commands.inventory import aws, etcd, k8s
+from metamorphctl.commands.inventory.report_handlers import excel
+from metamorphctl.utils.awsutils import clear_clients, get_client
+from metamorphctl.utils.config import Config
+
+DEFAULT_SCALES = [1, 10]
+PAGE_SIZE = 100
+KERNEL_NAMESPACE = 'bench'
+
+# records per title at 1x
+AWS_TITLES = [
+    {"service": "ec2", "api": "describe_vpcs", "objects": "Vpcs", "title": "VPC", "count": 5,
+     "fields": ["VpcId", "CidrBlock", {"Name": "Tags[?Key=='Name'] | [0].Value"}]},
+    {"service": "ec2", "api": "describe_subnets", "objects": "Subnets", "title": "Subnets",
+     "count": 20, "fields": ["SubnetId", "VpcId", "CidrBlock", "AvailabilityZone"]},
+    {"service": "ec2", "api": "describe_instances", "objects": "Reservations[].Instances",
+     "title": "EC2_Instances", "count": 100,
+     "fields": ["InstanceId", "InstanceType", "PrivateIpAddress", "State.Name",
+                {"Name": "Tags[?Key=='Name'] | [0].Value"}]},
+    {"service": "ec2", "api": "describe_volumes", "objects": "Volumes", "title": "EC2_Volumes",
+     "count": 150, "fields": ["VolumeId", "Size", "VolumeType", "Attachments[].InstanceId"]},
+    {"service": "iam", "api": "list_roles", "objects": "Roles", "title": "IAM_Roles",
+     "count": 20, "fields": ["RoleName", "Arn", "CreateDate"]},
+    {"service": "s3", "api": "list_buckets", "objects": "Buckets", "title": "S3_Buckets",
+     "paginator_support": False, "count": 10, "fields": ["Name", "CreationDate"]},
+]
+
+K8S_TITLES = [
+    {"api": "list_pod_for_all_namespaces", "title": "Pods", "path": "/api/v1/pods",
+     "count": 1000, "fields": ["metadata.namespace", "metadata.name", "status.phase",
+                               {"Image": "spec.containers[].image"}]},
+    {"api": "list_deployment_for_all_namespaces", "title": "Deployments",
+     "path": "/apis/apps/v1/deployments", "count": 100,
+     "fields": ["metadata.namespace", "metadata.name", "spec.replicas"]},
+    {"api": "list_service_for_all_namespaces", "title": "Services", "path": "/api/v1/services",
+     "count": 100, "fields": ["metadata.namespace", "metadata.name", "spec.clusterIP"]},
+    {"api": "list_config_map_for_all_namespaces", "title": "ConfigMaps",
+     "path": "/api/v1/configmaps", "count": 200,
+     "fields": ["metadata.namespace", "metadata.name"]},
+    {"api": "list_event_for_all_namespaces", "title": "Events", "path": "/api/v1/events",
+     "count": 1000, "fields": ["metadata.namespace", "reason", "message"]},
+    {"api": "list_node", "title": "Nodes", "path": "/api/v1/nodes", "count": 20,
+     "fields": ["metadata.name", "status.nodeInfo.kubeletVersion"]},
+]
+
+ETCD_KEYS = 1000
+ETCD_KEYS_PER_DIRECTORY = 100
+
+
+class OperationStubber(Stubber):
+    """Stubber answering by operation and pagination token instead of by call order.
+
+    botocore's Stubber expects calls in the order responses were queued, which does not hold
+    when titles are collected concurrently, nor when the same run is repeated.
+    """
+
+    def __init__(self, client):
+        """Init."""
+        super().__init__(client)
+        self._pages = {}
+        self._service = client.meta.service_model.service_name
+
+    def add_pages(self, method, key, records, last_token=None):
+        """Serve the records split in pages, chained through the paginator tokens."""
+        operation = self.client.meta.method_to_api_mapping[method]
+        try:
+            paginator = botocore.session.get_session().get_paginator_model(
+                self._service).get_paginator(operation)
+        except ValueError:
+            paginator = {}
+        chunks = [records[i:i + PAGE_SIZE] for i in range(0, len(records), PAGE_SIZE)] or [[]]
+        if not paginator:
+            chunks = [records]
+        responses = {}
+        for index, chunk in enumerate(chunks):
+            response = {key: chunk}
+            if paginator:
+                last = index == len(chunks) - 1
+                response[paginator['output_token']] = last_token if last else 'page-{}'.format(
+                    index + 1)
+                if paginator.get('more_results'):
+                    response[paginator['more_results']] = not last
+                response = {k: v for k, v in response.items() if v is not None}
+            responses['page-{}'.format(index) if index else None] = response
+        self._pages[operation] = (paginator.get('input_token'), responses)
+
+    def _assert_expected_params(self, model, params, context, **kwargs):
+        # before-call only sees the serialized request, keep the token for it in the context
+        input_token = self._pages[model.name][0]
+        context['stub_token'] = params.get(input_token) if input_token else None
+
+    def _get_response_handler(self, model, params, context, **kwargs):
+        responses = self._pages[model.name][1]
+        return AWSResponse(None, 200, {}, None), responses[context.get('stub_token') or None]
+
+
+class FakeKubernetesApi():
+    """Answer kubernetes list calls from synthetic items, honouring limit/continue."""
+
+    def __init__(self, items_by_path):
+        """Init."""
+        self.items_by_path = items_by_path
+        self._encoded = {}
+
+    def request(self, method, url, query_params=None, headers=None, post_params=None,
+                body=None, _preload_content=True, _request_timeout=None):
+        # pylint: disable=unused-argument,too-many-arguments
+        """Return a urllib3 like response for a GET of a list path."""
+        path = urlparse(url).path
+        query = dict(query_params or [])
+        limit = int(query.get('limit') or 0)
+        start = int(query.get('continue') or 0)
+        key = (path, start, limit)
+        if key not in self._encoded:
+            items = self.items_by_path[path]
+            end = start + limit if limit else len(items)
+            metadata = {"resourceVersion": "1"}
+            if end < len(items):
+                metadata["continue"] = str(end)
+            self._encoded[key] = json.dumps(
+                {"kind": "List", "apiVersion": "v1", "metadata": metadata,
+                 "items": items[start:end]}).encode('utf8')
+        data = self._encoded[key]
+        return mock.Mock(status=200, reason='OK', data=data.decode('utf8') if _preload_content
+                         else data, getheaders=lambda: {}, getheader=lambda *a: None)
+
+
+class FakeEtcdClient():
+    """python-etcd client reading a synthetic keyspace."""
+
+    def __init__(self, tree):
+        """Init."""
+        self.tree = tree
+
+    def read(self, key, recursive=False, **kwargs):  # pylint: disable=unused-argument
+        """Return the node under key, without the children of its children unless recursive."""
+        node = self.tree
+        for part in [p for p in key.split('/') if p]:
+            node = next(child for child in node['nodes']
+                        if child['key'].rsplit('/', 1)[-1] == part)
+        if not recursive and 'nodes' in node:
+            node = dict(node, nodes=[{name: value for name, value in child.items()
+                                      if name != 'nodes'} for child in node['nodes']])
+        return EtcdResult('get', node)
+
+
+def _tags(name):
+    return [{"Key": "Name", "Value": name},
+            {"Key": "kubernetes.io/cluster/bench", "Value": "owned"}]
+
+
+def aws_records(title, count):
+    """Return synthetic records for an AWS title."""
+    if title == 'VPC':
+        return [{"VpcId": "vpc-{:08x}".format(i), "CidrBlock": "10.{}.0.0/16".format(i % 256),
+                 "State": "available", "Tags": _tags("vpc-{}".format(i))} for i in range(count)]
+    if title == 'Subnets':
+        return [{"SubnetId": "subnet-{:08x}".format(i), "VpcId": "vpc-{:08x}".format(i % 5),
+                 "CidrBlock": "10.0.{}.0/24".format(i % 256), "AvailabilityZone": "us-east-1a",
+                 "Tags": _tags("subnet-{}".format(i))} for i in range(count)]
+    if title == 'EC2_Instances':
+        instances = [{
+            "InstanceId": "i-{:017x}".format(i), "InstanceType": "m5.xlarge",
+            "ImageId": "ami-{:08x}".format(i % 10), "PrivateIpAddress": "10.0.{}.{}".format(
+                i // 256 % 256, i % 256), "State": {"Code": 16, "Name": "running"},
+            "SubnetId": "subnet-{:08x}".format(i % 20), "Tags": _tags("node-{}".format(i)),
+            "SecurityGroups": [{"GroupId": "sg-{:08x}".format(i % 30), "GroupName": "nodes"}],
+            "BlockDeviceMappings": [{"DeviceName": "/dev/xvda", "Ebs": {
+                "VolumeId": "vol-{:017x}".format(i), "Status": "attached"}}],
+        } for i in range(count)]
+        # 5 instances per reservation, like node groups launched together
+        return [{"ReservationId": "r-{:08x}".format(i), "OwnerId": "123456789012",
+                 "Instances": instances[i:i + 5]} for i in range(0, count, 5)]
+    if title == 'EC2_Volumes':
+        return [{"VolumeId": "vol-{:017x}".format(i), "Size": 100, "VolumeType": "gp2",
+                 "State": "in-use", "Attachments": [{"InstanceId": "i-{:017x}".format(i)}],
+                 "Tags": _tags("vol-{}".format(i))} for i in range(count)]
+    if title == 'IAM_Roles':
+        return [{"RoleName": "role-{}".format(i), "RoleId": "AROA{:016d}".format(i),
+                 "Arn": "arn:aws:iam::123456789012:role/role-{}".format(i), "Path": "/",
+                 "CreateDate": "2020-01-01T00:00:00Z"} for i in range(count)]
+    if title == 'S3_Buckets':
+        return [{"Name": "bucket-{}".format(i), "CreationDate": "2020-01-01T00:00:00Z"}
+                for i in range(count)]
+    raise ValueError(title)
+
+
+def _metadata(kind, i):
+    return {"name": "{}-{}".format(kind, i), "namespace": "ns-{}".format(i % 20),
+            "uid": "{}-{:032x}".format(kind, i), "resourceVersion": str(i),
+            "creationTimestamp": "2020-01-01T00:00:00Z",
+            "labels": {"app": "app-{}".format(i % 50), "tier": "backend"}}
+
+
+def k8s_items(title, count):
+    """Return synthetic objects for a kubernetes title."""
+    container = {"name": "app", "image": "registry/app:1.0",
+                 "resources": {"limits": {"cpu": "500m", "memory": "512Mi"}}}
+    if title == 'Pods':
+        return [{"metadata": _metadata("pod", i), "spec": {
+            "containers": [container, dict(container, name="sidecar")],
+            "nodeName": "node-{}".format(i % 20)}, "status": {
+                "phase": "Running", "podIP": "100.64.{}.{}".format(i // 256 % 256, i % 256),
+                "conditions": [{"type": "Ready", "status": "True"}]}} for i in range(count)]
+    if title == 'Deployments':
+        return [{"metadata": _metadata("deploy", i), "spec": {
+            "replicas": 3, "selector": {"matchLabels": {"app": "app-{}".format(i)}},
+            "template": {"metadata": {"labels": {"app": "app-{}".format(i)}},
+                         "spec": {"containers": [container]}}}} for i in range(count)]
+    if title == 'Services':
+        return [{"metadata": _metadata("svc", i), "spec": {
+            "clusterIP": "172.20.{}.{}".format(i // 256 % 256, i % 256),
+            "ports": [{"port": 80, "protocol": "TCP"}]}} for i in range(count)]
+    if title == 'ConfigMaps':
+        return [{"metadata": _metadata("cm", i), "data": {"config.yaml": "x" * 512}}
+                for i in range(count)]
+    if title == 'Events':
+        return [{"metadata": _metadata("event", i), "reason": "Scheduled",
+                 "message": "Successfully assigned pod-{}".format(i), "type": "Normal",
+                 "involvedObject": {"kind": "Pod", "name": "pod-{}".format(i)}}
+                for i in range(count)]
+    if title == 'Nodes':
+        return [{"metadata": _metadata("node", i), "status": {
+            "nodeInfo": {"kubeletVersion": "v1.15.11", "kubeProxyVersion": "v1.15.11",
+                         "osImage": "Amazon Linux 2", "operatingSystem": "linux",
+                         "architecture": "amd64", "kernelVersion": "4.14.177",
+                         "containerRuntimeVersion": "docker://18.9.9", "bootID": str(i),
+                         "machineID": str(i), "systemUUID": str(i)}}}
+                for i in range(count)]
+    raise ValueError(title)
+
+
+def etcd_tree(count):
+    """Return a synthetic etcd keyspace with count keys."""
+    directories = []
+    for start in range(0, count, ETCD_KEYS_PER_DIRECTORY):
+        path = "/registry/dir-{}".format(start // ETCD_KEYS_PER_DIRECTORY)
+        directories.append({"key": path, "dir": True, "nodes": [
+            {"key": "{}/key-{}".format(path, i), "value": "v" * 64, "modifiedIndex": i,
+             "createdIndex": i} for i in range(start, min(start + ETCD_KEYS_PER_DIRECTORY,
+                                                          count))]})
+    return {"key": "/", "dir": True, "nodes": [
+        {"key": "/registry", "dir": True, "nodes": directories}]}
+
+
+def _strip(titles):
+    return [{k: v for k, v in title.items() if k not in ('count', 'path')} for title in titles]
+
+
+def _measure(name, scale, function, results):
+    """Run function, print its wall time, items per second and tracemalloc peak."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result, items = function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{:>5}x  {:<12} {:>9} {:>9.2f} {:>12.0f} {:>10.1f}'.format(
+        scale, name, items, elapsed, items / elapsed if elapsed else 0, peak / 2 ** 20),
+        file=results)
+    return result
+
+
+def _count(output):
+    return sum(len(items) for items in output.values() if isinstance(items, list))
+
+
+def run(scale, results=sys.stdout):
+    """Benchmark every collector and the excel report at the given scale."""
+    inventory = {"awsv2": _strip(AWS_TITLES), "kubernetes": _strip(K8S_TITLES),
+                 "aws": ["ResourceTagMappingList"], "etcd": ["key", "value", "modifiedIndex"]}
+    settings = {"awsv2": {}}
+
+    clear_clients()
+    # a single stubber per client, stubbers of the same client would share their event ids
+    stubbers = {}
+    for title in AWS_TITLES:
+        stubber = stubbers.setdefault(title['service'],
+                                      OperationStubber(get_client(title['service'])))
+        stubber.add_pages(title['api'], title['objects'].split('[')[0],
+                          aws_records(title['title'], title['count'] * scale))
+    tagging = stubbers.setdefault('resourcegroupstaggingapi',
+                                  OperationStubber(get_client('resourcegroupstaggingapi')))
+    tagging.add_pages('get_resources', 'ResourceTagMappingList', [
+        {"ResourceARN": "arn:aws:ec2:us-east-1:123456789012:instance/i-{:017x}".format(i),
+         "Tags": _tags("node-{}".format(i))} for i in range(100 * scale)], last_token="")
+    fake_k8s = FakeKubernetesApi(
+        {title['path']: k8s_items(title['title'], title['count'] * scale)
+         for title in K8S_TITLES})
+    fake_etcd = FakeEtcdClient(etcd_tree(ETCD_KEYS * scale))
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', lambda x, key: {
+                "inventory": inventory, "inventory_settings": settings}.get(key)), \
+            mock.patch.object(RESTClientObject, 'request',
+                              lambda self, *args, **kwargs: fake_k8s.request(*args, **kwargs)), \
+            mock.patch.object(k8s, 'load_kubeconfig', lambda kubeconfig: None), \
+            mock.patch.object(etcd.etcd, 'Client', lambda **kwargs: fake_etcd), \
+            mock.patch.dict(os.environ, {"KERNEL_NAMESPACE": KERNEL_NAMESPACE,
+                                         "ETCDCTL_PEERS": "http://127.0.0.1:2379"}):
+        for stubber in stubbers.values():
+            stubber.activate()
+        outputs = {}
+        for name, collector in [("awsv2", aws.Awsv2), ("aws", aws.Aws),
+                                ("kubernetes", k8s.Kubernetes), ("etcd", etcd.Etcd)]:
+
+            def collect(collector=collector):
+                output = collector().collect()
+                return output, (_count(output) if name != "etcd" else ETCD_KEYS * scale)
+
+            outputs[name] = _measure(name, scale, collect, results)
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            def report():
+                rows = 0
+                for name in ("awsv2", "kubernetes"):
+                    excel.handle(os.path.join(folder, name), inventory[name], outputs[name])
+                    rows += _count(outputs[name])
+                return None, rows
+
+            _measure("excel", scale, report, results)
+        for stubber in stubbers.values():
+            stubber.deactivate()
+
+
+def main(scales=None):
+    """Print the benchmark of every requested scale."""
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    results = sys.stdout
+    print('{:>6}  {:<12} {:>9} {:>9} {:>12} {:>10}'.format(
+        'scale', 'collector', 'items', 'seconds', 'items/s', 'peak MB'), file=results)
+    for scale in scales or DEFAULT_SCALES:
+        # collectors print their progress, only the benchmark lines are kept
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            run(scale, results)
+
+
+if __name__ == '__main__':
+    main([int(scale) for scale in sys.argv[1:]])
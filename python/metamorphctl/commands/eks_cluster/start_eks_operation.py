@@ -22,11 +22,11 @@
 import copy
 from time import sleep
 
-import boto3
 import yaml
 from kubernetes import client
 from kubernetes.client.rest import ApiException
 
+from metamorphctl.utils.awsutils import get_client
 from metamorphctl.utils.kubeutils import load_kubernetes, taint_nodes, untaint_nodes
 from metamorphctl.utils.printutils import print_success, print_warn
 from metamorphctl.utils.timeout import timeout, TimeOutException
@@ -59,9 +59,9 @@ def describe():
 def apply(namespace, start_rds):
     """Orchestrate the EKS environment start."""
     load_kubernetes()
-    autoscaling_client = boto3.client('autoscaling')
-    ec2_client = boto3.client('ec2')
-    rds_client = boto3.client('rds')
+    autoscaling_client = get_client('autoscaling')
+    ec2_client = get_client('ec2')
+    rds_client = get_client('rds')
 
     print_warn('\n\n== ASG ==\nPausing Kubernetes cluster-autoscaler\n')
     _disable_cluster_autoscaler()
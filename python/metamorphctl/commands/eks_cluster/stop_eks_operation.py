@@ -21,12 +21,12 @@
 
 import copy
 from time import sleep
-import boto3
 import yaml
 
 from kubernetes import client
 from kubernetes.client.rest import ApiException
 
+from metamorphctl.utils.awsutils import get_client
 from metamorphctl.utils.kubeutils import load_kubernetes, taint_nodes
 from metamorphctl.utils.printutils import print_warn, print_success
 
@@ -52,9 +52,9 @@ def describe():
 def apply(namespace, stop_rds):
     """Orchestrate the EKS environment stop."""
     load_kubernetes()
-    autoscaling_client = boto3.client('autoscaling')
-    ec2_client = boto3.client('ec2')
-    rds_client = boto3.client('rds')
+    autoscaling_client = get_client('autoscaling')
+    ec2_client = get_client('ec2')
+    rds_client = get_client('rds')
 
     print_warn("\n\n== PAUSING AUTOSCALING GROUP ==\n\n------------ASG---------------\n")
     _pause_autoscaling_groups(namespace, autoscaling_client)
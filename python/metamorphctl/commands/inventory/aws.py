@@ -20,11 +20,13 @@
 # express and approved by McAfee in writing
 
 import os
-import boto3
-import jmespath
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+from metamorphctl.utils.awsutils import REGION_KEY, get_client
 from metamorphctl.utils.config import Config
-from metamorphctl.commands.inventory.report_handlers.jmespath_custom import CustomFunctions
+from metamorphctl.utils.profiling import PROFILER
+from metamorphctl.commands.inventory.cache import TitleCache
+from metamorphctl.commands.inventory.report_handlers.jmespath_custom import search
 
 from .aws_handlers.asg import Asg
 from .aws_handlers.ecr import Ecr
@@ -42,7 +44,13 @@ AVAILABLE_HANDLERS = {
     "Eks": Eks
 }
 
-JMESPATH_OPT = jmespath.Options(custom_functions=CustomFunctions())
+# Titles collected at the same time, overall and per AWS service.
+# Both can be tuned in config.yaml under `inventory_settings.awsv2`.
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_WORKERS_PER_SERVICE = 2
+
+# Services answering the same for every region, the global `regions` setting does not apply
+GLOBAL_SERVICES = ("iam", "route53", "s3", "cloudfront", "organizations")
 
 
 class Aws():
@@ -65,47 +73,171 @@ class Aws():
 
     def collect(self):
         """Collect data from registered handlers."""
-        response = {}
+        return dict(self.iter_collect())
+
+    def iter_collect(self):
+        """Yield (handler, items) as soon as each handler is collected."""
         for key, value in self.handlers.items():
-            try:
-                response[key] = value.handle()
-            except Exception as err:  # pylint: disable=broad-except
-                print("Exception been caught, error:", err)
-                response[key] = {'error': str(err)}
-        return response
+            with PROFILER.section("aws", key):
+                try:
+                    items = value.handle()
+                except Exception as err:  # pylint: disable=broad-except
+                    print("Exception been caught, error:", err)
+                    items = {'error': str(err)}
+                PROFILER.record_items(items)
+            yield key, items
 
 
-class Awsv2():  # pragma: no cover
+class Awsv2():
     """Class to handle AWS resources."""
 
     def __init__(self):
         """Init."""
+        settings = (Config().get("inventory_settings") or {}).get("awsv2") or {}
+        self.max_workers = settings.get("max_workers", DEFAULT_MAX_WORKERS)
+        self.max_workers_per_service = settings.get("max_workers_per_service",
+                                                    DEFAULT_MAX_WORKERS_PER_SERVICE)
+        self.regions = settings.get("regions")
+        self.cache = TitleCache()
+        self._all_regions = None
 
-    def collect(self):  # pylint: disable=no-self-use
+    def collect(self):
         """Collect AWS data."""
-        response = {}
+        aws_cfg = Config().get("inventory").get("awsv2") or []
+        results = dict(self.iter_collect(aws_cfg))
+        return {req['title']: results[req['title']] for req in aws_cfg}
+
+    def iter_collect(self, aws_cfg=None):
+        """Yield (title, items) as soon as each title is collected."""
+        if aws_cfg is None:
+            aws_cfg = Config().get("inventory").get("awsv2") or []
+        scope = self._cache_scope(aws_cfg)
+        title_regions = {}
+        for req in aws_cfg:
+            try:
+                title_regions[req['title']] = self._title_regions(req)
+            except Exception as err:  # pylint: disable=broad-except
+                print("Exception been caught, error:", err)
+                yield req['title'], {'error': str(err)}
+        # a task per title and region, None being the default region
+        pending = [(req, region) for req in aws_cfg
+                   for region in title_regions.get(req['title'], [])]
+        running = {}
+        partial = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # submit every task whose service still has room in its region, keeping the
+                # config order
+                for task in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    busy = sum(1 for ongoing in running.values() if _lane(ongoing) == _lane(task))
+                    if busy < self.max_workers_per_service:
+                        pending.remove(task)
+                        future = executor.submit(_collect_title, task[0], self.cache, scope,
+                                                 task[1])
+                        running[future] = task
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    region = running.pop(future)[1]
+                    title, items = future.result()
+                    partial.setdefault(title, {})[region] = items
+                    # a title is ready once all its regions are
+                    if len(partial[title]) == len(title_regions[title]):
+                        yield title, _merge_regions(partial.pop(title), title_regions[title])
+
+    def _title_regions(self, req):
+        """Return the regions a title is collected in, [None] for the default one."""
+        regions = req.get("regions")
+        if regions is None and req['service'] not in GLOBAL_SERVICES:
+            regions = self.regions
+        if not regions:
+            return [None]
+        if regions == "all":
+            if self._all_regions is None:
+                self._all_regions = search("Regions[].RegionName",
+                                           get_client('ec2').describe_regions())
+            regions = self._all_regions
+        return list(regions)
+
+    def _cache_scope(self, aws_cfg):
+        """Return the account and region the cached titles belong to."""
+        if not any(self.cache.enabled_for(req) for req in aws_cfg):
+            return None
         try:
-            aws_cfg = Config().get("inventory").get("awsv2")
-            for req in aws_cfg:
-                title = req['title']
-                print('Collecting AWS: {}'.format(title))
-                res = _handle_request(req)
-                response[title] = res
+            sts = get_client('sts')
+            return "{}/{}".format(sts.get_caller_identity()['Account'], sts.meta.region_name)
         except Exception as err:  # pylint: disable=broad-except
             print("Exception been caught, error:", err)
-            response[title] = {'error': str(err)}
-        return response
+            return None
+
+
+def _lane(task):
+    """Titles of the same service and region share the AWS request quota."""
+    req, region = task
+    return req['service'], region
+
+
+def _merge_regions(results, regions):
+    """Merge the items of every region, tagging them with it.
+
+    Records which are not objects (e.g. EKS cluster names) are wrapped as
+    `{"name": record, "_region": region}` so the same name in two regions stays apart.
+    A failed region is kept as a `{"error": ..., "_region": region}` record next to the
+    records of the others, the title is only an error when every region failed.
+    """
+    if regions == [None]:
+        return results[None]
+    failed = [region for region in regions if not isinstance(results[region], list)]
+    if len(failed) == len(regions):
+        return {'error': "; ".join("{}: {}".format(region, results[region]['error'])
+                                   for region in regions)}
+    merged = []
+    for region in regions:
+        if region in failed:
+            merged.append({'error': results[region]['error'], REGION_KEY: region})
+            continue
+        for record in results[region]:
+            if isinstance(record, dict):
+                record[REGION_KEY] = region
+            else:
+                record = {"name": record, REGION_KEY: region}
+            merged.append(record)
+    return merged
+
+
+def _collect_title(req, cache=None, scope=None, region=None):
+    """Collect a single title, keeping its errors in its own entry."""
+    title = req['title']
+    # the cache and the profile tell the regions of a title apart
+    cache_req = dict(req, region=region) if region else req
+    section = "{}@{}".format(title, region) if region else title
+    with PROFILER.section("awsv2", section):
+        items = cache.get("awsv2", scope, cache_req) if cache else None
+        if items is not None:
+            print('Using cached AWS: {}'.format(section))
+        else:
+            try:
+                print('Collecting AWS: {}'.format(section))
+                items = _handle_request(req, region)
+            except Exception as err:  # pylint: disable=broad-except
+                print("Exception been caught, error:", err)
+                items = {'error': str(err)}
+            if cache:
+                cache.put("awsv2", scope, cache_req, items)
+        PROFILER.record_items(items)
+    return title, items
 
 
-def _handle_request(req):  # pragma: no cover
+def _handle_request(req, region=None):  # pragma: no cover
     """Handle collection of items."""
     res = []
-    client = boto3.client(req['service'])
+    client = get_client(req['service'], region_name=region)
 
     # if paginator is not supported for the service, execute the api directly
     if req.get('paginator_support') is False:
         out = getattr(client, req['api'])()
-        res += jmespath.search(req['objects'] + "[]", out, options=JMESPATH_OPT)
+        res += search(req['objects'] + "[]", out)
     else:
         paginator = client.get_paginator(req['api'])
         # use params if they are present
@@ -114,6 +246,6 @@ def _handle_request(req):  # pragma: no cover
         else:
             iterator = paginator.paginate()
         for page in iterator:
-            res += jmespath.search(req['objects'] + "[]", page, options=JMESPATH_OPT)
+            res += search(req['objects'] + "[]", page)
 
     return res
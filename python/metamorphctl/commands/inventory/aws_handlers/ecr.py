@@ -19,7 +19,7 @@
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
 
-import boto3
+from metamorphctl.utils.awsutils import get_client
 
 
 class Ecr():
@@ -28,7 +28,7 @@ class Ecr():
     def __init__(self, kernel_ns):
         """Init."""
         self.kernel_ns = kernel_ns
-        self.client = boto3.client("ecr")
+        self.client = get_client("ecr")
 
     def handle(self):
         """Handle collection of items."""
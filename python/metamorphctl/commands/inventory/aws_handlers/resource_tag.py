@@ -18,7 +18,7 @@
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
 
-import boto3
+from metamorphctl.utils.awsutils import get_client
 
 
 class ResourceTag():
@@ -27,7 +27,7 @@ class ResourceTag():
     def __init__(self, kernel_ns):
         """Init."""
         self.kernel_ns = kernel_ns
-        self.client = boto3.client("resourcegroupstaggingapi")
+        self.client = get_client("resourcegroupstaggingapi")
 
     def handle(self):
         """Handle collection of items."""
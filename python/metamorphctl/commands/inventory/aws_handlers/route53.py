@@ -19,7 +19,7 @@
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
 
-import boto3
+from metamorphctl.utils.awsutils import get_client
 
 
 class Route53():
@@ -27,7 +27,7 @@ class Route53():
 
     def __init__(self, kernel_ns):  # pylint: disable=unused-argument
         """Init."""
-        self.client = boto3.client("route53")
+        self.client = get_client("route53")
 
     def handle(self):
         """Handle collection of items."""
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""On disk cache of inventory titles."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import hashlib
+import json
+import os
+import time
+from os.path import expanduser, join
+
+CACHE_FOLDER = join(expanduser("~"), ".metamorphctl", "cache")
+
+# Title settings which only change how the items are presented, not what is collected
+PRESENTATION_KEYS = ("fields", "report", "max_age", "id")
+
+
+class TitleCache():
+    """Keep the items of each title on disk, reused while younger than its `max_age`.
+
+    Entries are keyed by system, scope (the aws account and region, or the kubernetes
+    cluster) and the title request, so changing the api or its params is a cache miss.
+    max_age, when set, overrides the `max_age` of the titles having one (0 disables the cache
+    reads). Titles without `max_age`, like secrets, are never written to disk.
+    """
+
+    def __init__(self, folder=CACHE_FOLDER, max_age=None, clock=time.time):
+        """Init."""
+        self.folder = folder
+        self.max_age = max_age
+        self.clock = clock
+
+    def enabled_for(self, req):
+        """Return whether the title is cached, reads or writes."""
+        return bool(req.get("max_age"))
+
+    def get(self, system, scope, req):
+        """Return the cached items of the title if they are fresh enough, None otherwise."""
+        if not self.enabled_for(req):
+            return None
+        max_age = self.max_age if self.max_age is not None else req.get("max_age")
+        if not max_age or scope is None:
+            return None
+        try:
+            with open(self._path(system, scope, req), encoding='utf-8') as stream:
+                entry = json.load(stream)
+        except (IOError, ValueError):
+            return None
+        if self.clock() - entry["time"] > max_age:
+            return None
+        return entry["items"]
+
+    def put(self, system, scope, req, items):
+        """Store the items of the title, errors are never cached."""
+        if not self.enabled_for(req) or scope is None or not isinstance(items, list):
+            return
+        path = self._path(system, scope, req)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        # inventories hold sensitive details of the accounts, only the user can read them
+        descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(descriptor, 'w', encoding='utf-8') as stream:
+            json.dump({"time": self.clock(), "items": items}, stream, default=str)
+        # readers never see a partially written entry
+        os.replace(tmp_path, path)
+
+    def _path(self, system, scope, req):
+        request = {key: value for key, value in req.items() if key not in PRESENTATION_KEYS}
+        digest = hashlib.sha1(json.dumps([scope, request], sort_keys=True,
+                                         default=str).encode('utf8')).hexdigest()
+        return join(self.folder, system, "{}-{}.json".format(req["title"], digest))
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Inventory delta against a previous snapshot."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import hashlib
+import json
+
+from metamorphctl.commands.inventory.report_handlers.jmespath_custom import search
+from metamorphctl.utils.awsutils import REGION_KEY, is_region_error
+
+# Id used for the records of a title when config.yaml does not set one
+DEFAULT_ID_EXPRESSIONS = {"kubernetes": "metadata.uid", "etcd": "key"}
+
+# Pseudo title holding the flattened keys of a directory tree (etcd)
+TREE_TITLE = "nodes"
+
+
+def compute(previous, current, config):
+    """Compare two inventories and return only what was added, removed or changed.
+
+    Records are matched by a stable id per title and compared through a hash of their content,
+    so each title costs O(n) regardless of how many records there are.
+    """
+    summary = {"added": 0, "removed": 0, "changed": 0, "unchanged": 0}
+    systems = {}
+    for system, titles in current.items():
+        if _is_error(titles):
+            systems[system] = titles
+            continue
+        # systems and titles new since the snapshot had no records, all of theirs are added
+        previous_titles = _titles(previous.get(system, {}))
+        current_titles = _titles(titles)
+        # titles gone since the snapshot have no records left, all of theirs are removed
+        gone = {title: [] for title in previous_titles if title not in current_titles}
+        for title, records in dict(current_titles, **gone).items():
+            if _is_error(records):
+                # do not report every record as removed because a title failed this time
+                systems.setdefault(system, {})[title] = records
+                continue
+            # a title that failed in the snapshot had no records
+            previous_records = previous_titles.get(title, [])
+            if _is_error(previous_records):
+                previous_records = []
+            records, previous_records, errors = _skip_failed_regions(records, previous_records)
+            id_expression = _id_expression(config.get(system), system, title)
+            diff = _diff(previous_records, records, id_expression)
+            if errors:
+                diff["errors"] = errors
+            summary["unchanged"] += diff.pop("unchanged")
+            for kind in ("added", "removed", "changed"):
+                summary[kind] += len(diff[kind])
+            if any(diff.values()):
+                systems.setdefault(system, {})[title] = diff
+    return {"summary": summary, "systems": systems}
+
+
+def record_hash(record):
+    """Hash a record content, independently of its keys order."""
+    content = json.dumps(record, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()  # nosec
+
+
+def _diff(previous, current, id_expression):
+    previous_index = _index(previous, id_expression)
+    current_index = _index(current, id_expression)
+    diff = {"added": [], "removed": [], "changed": [], "unchanged": 0}
+    for record_id, (digest, record) in current_index.items():
+        if record_id not in previous_index:
+            diff["added"].append(record)
+        elif previous_index[record_id][0] != digest:
+            diff["changed"].append(record)
+        else:
+            diff["unchanged"] += 1
+    for record_id, (_, record) in previous_index.items():
+        if record_id not in current_index:
+            diff["removed"].append(record)
+    return diff
+
+
+def _index(records, id_expression):
+    """Map each record id to the record and its hash."""
+    index = {}
+    for record in _as_list(records):
+        digest = record_hash(record)
+        record_id = _record_id(record, id_expression)
+        if record_id is None or record_id in index:
+            # without a usable id, the content itself identifies the record
+            record_id = "#" + digest
+        index[record_id] = (digest, record)
+    return index
+
+
+def _record_id(record, id_expression):
+    if not id_expression:
+        return None
+    try:
+        value = search(id_expression, record)
+    except Exception:  # pylint: disable=broad-except
+        return None
+    if value is None:
+        return None
+    record_id = value if isinstance(value, str) else json.dumps(value, sort_keys=True,
+                                                                default=str)
+    # the same resource name may be used in several regions
+    if isinstance(record, dict) and record.get(REGION_KEY):
+        return "{}/{}".format(record[REGION_KEY], record_id)
+    return record_id
+
+
+def _skip_failed_regions(records, previous_records):
+    """Leave the regions that failed this time out of the comparison, returning their errors.
+
+    Their records are neither reported as removed, nor the ones of the snapshot as added when
+    it is the snapshot that failed in a region.
+    """
+    errors = [record for record in _as_list(records) if is_region_error(record)]
+    failed = {error[REGION_KEY] for error in errors}
+    if errors:
+        records = [record for record in records if not is_region_error(record)]
+    previous_records = [
+        record for record in _as_list(previous_records)
+        if not is_region_error(record)
+        and not (isinstance(record, dict) and record.get(REGION_KEY) in failed)]
+    return records, previous_records, errors
+
+
+def _titles(system_items):
+    """Return the titles of a system, flattening directory trees into their leaves."""
+    if isinstance(system_items, dict) and system_items.get("type") == "directory":
+        return {TREE_TITLE: list(_leaves(system_items))}
+    return system_items if isinstance(system_items, dict) else {}
+
+
+def _leaves(tree):
+    pending = [tree]
+    while pending:
+        node = pending.pop()
+        if node.get("type") == "directory":
+            pending.extend(node.get("children", []))
+        else:
+            yield node
+
+
+def _id_expression(system_config, system, title):
+    for cfg in system_config or []:
+        if isinstance(cfg, dict) and cfg.get("title") == title and cfg.get("id"):
+            return cfg["id"]
+    return DEFAULT_ID_EXPRESSIONS.get(system)
+
+
+def _is_error(records):
+    return isinstance(records, dict) and set(records.keys()) == {"error"}
+
+
+def _as_list(records):
+    return records if isinstance(records, list) else [records]
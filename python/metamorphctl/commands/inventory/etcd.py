@@ -18,17 +18,46 @@
 # of the Materials, either expressly, by implication, inducement, estoppel or
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
+import hashlib
+import itertools
+import json
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
 from urllib.parse import urlparse
 
 import etcd
 
+from metamorphctl.commands.inventory.cache import CACHE_FOLDER
 from metamorphctl.utils.config import Config
+from metamorphctl.utils.profiling import PROFILER
 
 INVENTORY_NAME = "etcd"
 
 DEFAULT_OUTPUT_VALUES = ["key", "value", "modifiedIndex", "createdIndex", "ttl", "expiration"]
 
+# Top-level directories read at the same time and seconds each of them is given to be read,
+# tuned in config.yaml under `inventory_settings.etcd`
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_TIMEOUT = 60
+# Seconds a single read waits for a peer before it is retried on the next one
+DEFAULT_READ_TIMEOUT = 10
+# Seconds a peer that failed a read is only tried once the others failed too
+DEFAULT_PEER_BACKOFF = 30
+# Seconds a subtree waits for room in the streamed results before checking it is still read
+PUT_TIMEOUT = 0.1
+
+DEFAULT_PORT = 2379
+
+# Actions of the etcd events removing a key, or a directory and everything under it
+DELETE_ACTIONS = ("delete", "expire", "compareAndDelete")
+
+# Values of a node always kept in the incremental snapshot, besides the requested ones
+SNAPSHOT_VALUES = ("key", "dir", "modifiedIndex")
+
 
 class Etcd():
     """Class to handle ETCD."""
@@ -39,15 +68,39 @@ class Etcd():
         self.etcd_peers = os.environ.get("ETCDCTL_PEERS", None)
         if not self.etcd_peers:
             raise ValueError("ETCDCTL_PEERS env variable is not present.")
-        tokenized_url = urlparse(str(self.etcd_peers))
-        self.etcd_host, self.etcd_port = tokenized_url.netloc.split(":")
-        self.protocol = tokenized_url.scheme
+        self.protocol, self.peers = _parse_peers(self.etcd_peers)
+
+        settings = (Config().get("inventory_settings") or {}).get(INVENTORY_NAME) or {}
+        self.max_workers = settings.get("max_workers", DEFAULT_MAX_WORKERS)
+        self.timeout = settings.get("timeout", DEFAULT_TIMEOUT)
+        self.read_timeout = settings.get("read_timeout", DEFAULT_READ_TIMEOUT)
+        self.peer_backoff = settings.get("peer_backoff", DEFAULT_PEER_BACKOFF)
 
-        self.etcd = etcd.Client(
-            host=self.etcd_host,
-            port=int(self.etcd_port),
-            allow_reconnect=True,
-            protocol=self.protocol)
+        # One client per peer, the reads take them in turn so they are spread over every member
+        # of the cluster. python-etcd reconnection changes the peer of a client without any
+        # locking and never comes back, so the clients stay on their peer and _read() fails
+        # over to the next one.
+        self.clients = [
+            etcd.Client(
+                host=host,
+                port=port,
+                allow_reconnect=False,
+                protocol=self.protocol,
+                per_host_pool_size=self.max_workers) for host, port in self.peers
+        ]
+        self.etcd = self.clients[0]
+        self._reads = itertools.count()
+        # client index -> time until which its peer is tried last, a down or blackholed peer
+        # would otherwise cost read_timeout to a share of the reads
+        self._backoffs = {}
+        self._reads_lock = threading.Lock()
+
+        # With `incremental`, the nodes of the keyspace are kept in a snapshot under
+        # cache_folder and the next runs only read the etcd events since its index.
+        self.incremental = settings.get("incremental", False)
+        self.cache_folder = CACHE_FOLDER
+        # key -> node, filled by the reads of a full run in incremental mode
+        self._nodes = None
 
         self.output_values = []
         desired_output = Config().get("inventory").get(INVENTORY_NAME)
@@ -59,37 +112,318 @@ class Etcd():
         else:
             raise ValueError("At least one etcd inventory value must be set in config.yaml!")
 
-    def generate_output(self, etcd_values):
-        """Generate output from etcd raw input."""
-
-        def discover_nodes(subtree):
-            """Obtain values recursively for each subtree."""
-            output = {}
-            if subtree.get("dir") and subtree.get("nodes"):  # Some directories are empty
-                output["type"] = "directory"
-                output["path"] = subtree["key"]
-                if subtree.get("nodes"):
-                    output["children"] = [discover_nodes(child) for child in subtree["nodes"]]
-                    output["children_count"] = len(output["children"])
-            else:
-                for desired in self.output_values:
-                    output[desired] = subtree.get(desired, "")
-            return output
+    def walk(self, path="/", listing=None, deadline=None):
+        """Read the keyspace one directory at a time, depth first and without recursion.
+
+        Yields `(listing, key, children)` for every directory: the node listing it in its
+        parent (the given listing for path), its key and its children, which do not hold their
+        own children. Only the listings of the directories still to be read are kept between
+        two reads. A TimeoutError is raised once the time.monotonic() deadline is passed.
+        """
+        pending = [(listing, path)]
+        while pending:
+            listing, key = pending.pop()
+            key, children = self.read_directory(key, deadline)
+            yield listing, key, children
+            # reversed, so the subdirectories are read in their etcd order
+            pending.extend((child, child["key"]) for child in reversed(children)
+                           if child.get("dir"))
 
+    def read_directory(self, path, deadline=None):
+        """Return the key of a directory and its direct children."""
+        etcd_values = self._read(path, deadline, recursive=False)
         etcd_dict = etcd_values.__dict__
-        children = etcd_dict["_children"]
-        output = {"type": "directory", "path": etcd_dict["key"], "children": []}
-        for subdir in children:
-            output["children"].append(discover_nodes(subdir))
+        if self._nodes is not None:
+            self._nodes.update((child["key"], self._snapshot_node(child))
+                               for child in etcd_dict["_children"])
+        return etcd_dict["key"], etcd_dict["_children"]
+
+    def current_index(self):
+        """Return the current etcd index, the one of the latest change of the keyspace."""
+        return self._read("/").etcd_index
+
+    def collect(self):
+        """Collect data from ETCD, the top-level directories are read in parallel."""
+        snapshot = self._updated_snapshot()
+        if snapshot is not None:
+            return self._build_tree(_walk_nodes(snapshot["root_key"], snapshot["nodes"]))
+
+        index = self._start_snapshot()
+        root_key, children = self.read_directory("/")
+        subtrees = [child for child in children if child.get("dir")]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            trees = dict(zip([child["key"] for child in subtrees],
+                             executor.map(self._collect_subtree, subtrees)))
+
+        output = {"type": "directory", "path": root_key, "children": []}
+        for child in children:
+            output["children"].append(
+                trees[child["key"]] if child.get("dir") else self._key_output(child))
+        if output["children"]:
             output["children_count"] = len(output["children"])
+        self._save_snapshot(root_key, index,
+                            complete=not any("error" in tree for tree in trees.values()))
         return output
 
-    def get_etcd_values(self, path="/"):
-        """Obtain etdc values recursively."""
-        etcd_values = self.etcd.read(path, recursive=True)
-        return etcd_values
+    def iter_collect(self):
+        """Yield the keys of every directory as soon as it is read.
 
-    def collect(self):
-        """Collect data from ETCD."""
-        etcd_values = self.get_etcd_values()
-        return self.generate_output(etcd_values)
+        A directory is a title of its own, empty directories are written as a key like in
+        the tree returned by collect(). The top-level directories are read in parallel.
+        """
+        snapshot = self._updated_snapshot()
+        if snapshot is not None:
+            for directory in _walk_nodes(snapshot["root_key"], snapshot["nodes"]):
+                yield self._directory_output(*directory)
+            return
+
+        index = self._start_snapshot()
+        root_key, children = self.read_directory("/")
+        yield self._directory_output(None, root_key, children)
+        complete = True
+
+        subtrees = [child for child in children if child.get("dir")]
+        # every subtree puts its directories and then None once it is over, the queue is bounded
+        # so the subtrees do not read ahead of the caller
+        results = queue.Queue(maxsize=self.max_workers)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                for listing in subtrees:
+                    executor.submit(self._stream_subtree, listing, results, stop)
+                remaining = len(subtrees)
+                while remaining:
+                    result = results.get()
+                    if result is None:
+                        remaining -= 1
+                    else:
+                        complete = complete and not isinstance(result[1], dict)
+                        yield result
+            finally:
+                # the subtrees still being read stop if the caller does not read everything
+                stop.set()
+        self._save_snapshot(root_key, index, complete)
+
+    def _read(self, path, deadline=None, **kwargs):
+        """Read from the next peer, failing over to the others when it is down or too slow."""
+        with self._reads_lock:
+            first = next(self._reads)
+            now = time.monotonic()
+            peers = len(self.clients)
+            order = [(first + attempt) % peers for attempt in range(peers)]
+            # the peers that failed lately go last, they are probed again once their backoff
+            # is over
+            order.sort(key=lambda index: self._backoffs.get(index, 0) > now)
+        error = None
+        for index in order:
+            timeout = self.read_timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("{} not read, the {}s given to its top-level directory "
+                                       "are over".format(path, self.timeout))
+                timeout = min(timeout, remaining)
+            try:
+                etcd_values = self.clients[index].read(path, timeout=timeout, **kwargs)
+            except etcd.EtcdConnectionFailed as err:
+                print("Exception been caught, error:", err)
+                with self._reads_lock:
+                    self._backoffs[index] = time.monotonic() + self.peer_backoff
+                error = err
+                continue
+            with self._reads_lock:
+                self._backoffs.pop(index, None)
+            PROFILER.record_call()
+            return etcd_values
+        raise error
+
+    def _start_snapshot(self):
+        """Record the nodes read from now on, return the index they are at least as new as."""
+        if not self.incremental:
+            return None
+        index = self.current_index()
+        self._nodes = {}
+        return index
+
+    def _save_snapshot(self, root_key, index, complete):
+        """Save the nodes recorded by a full run, unless some of them could not be read."""
+        nodes, self._nodes = self._nodes, None
+        if nodes is None or not complete:
+            return
+        self._write_snapshot({"root_key": root_key, "etcd_index": index, "nodes": nodes})
+
+    def _updated_snapshot(self):
+        """Return the snapshot of the previous run with the changes made since then.
+
+        None means the keyspace must be read again: the incremental mode is off, there is no
+        snapshot yet or etcd does not keep the events since its index anymore.
+        """
+        if not self.incremental:
+            return None
+        snapshot = self._read_snapshot()
+        if snapshot is None:
+            return None
+        nodes = snapshot["nodes"]
+        index = snapshot["etcd_index"]
+        target = self.current_index()
+        try:
+            while index < target:
+                event = self._read("/", recursive=True, wait=True, waitIndex=index + 1)
+                _apply_event(nodes, event, self._snapshot_node)
+                index = event.modifiedIndex
+        except etcd.EtcdException as err:
+            # the events are cleared, the peers cannot be reached or are too slow to tell
+            # whether events are missing: only a full read is sure to be right
+            print("Exception been caught, error:", err)
+            return None
+        print("Etcd snapshot updated from index {} to {}".format(snapshot["etcd_index"], index))
+        snapshot["etcd_index"] = index
+        self._write_snapshot(snapshot)
+        return snapshot
+
+    def _snapshot_node(self, node):
+        """Return the values of a node kept in the snapshot, only the requested ones."""
+        kept = SNAPSHOT_VALUES + tuple(self.output_values)
+        # the values etcd leaves out of its listings are left out too, like false `dir`
+        return {name: node.get(name) for name in kept if node.get(name) not in (None, False)}
+
+    def _read_snapshot(self):
+        """Return the snapshot of the cluster, None if there is none."""
+        try:
+            with open(self._snapshot_path(), encoding='utf-8') as stream:
+                return json.load(stream)
+        except (IOError, ValueError):
+            return None
+
+    def _write_snapshot(self, snapshot):
+        """Replace the snapshot of the cluster."""
+        path = self._snapshot_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        # the snapshot may hold secrets stored in etcd, only the user can read it
+        descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(descriptor, 'w', encoding='utf-8') as stream:
+            json.dump(snapshot, stream, default=str)
+        # readers never see a partially written snapshot
+        os.replace(tmp_path, path)
+
+    def _snapshot_path(self):
+        """Snapshots are kept per cluster, given by its peers, and per requested values."""
+        digest = hashlib.sha1(json.dumps(
+            [self.protocol, sorted(self.peers), sorted(self.output_values)]).encode(
+                'utf8')).hexdigest()
+        return join(self.cache_folder, INVENTORY_NAME, "snapshot-{}.json".format(digest))
+
+    def _collect_subtree(self, listing):
+        """Build the tree of a top-level directory, capturing its error or timeout."""
+        with PROFILER.section(INVENTORY_NAME, listing["key"]):
+            try:
+                deadline = time.monotonic() + self.timeout
+                return self._build_tree(self.walk(listing["key"], listing, deadline))
+            except Exception as err:  # pylint: disable=broad-except
+                print("Exception been caught, error:", err)
+                return {"type": "directory", "path": listing["key"], "error": str(err)}
+
+    def _stream_subtree(self, listing, results, stop):
+        """Put the output of every directory of a top-level directory in results."""
+        with PROFILER.section(INVENTORY_NAME, listing["key"]):
+            try:
+                deadline = time.monotonic() + self.timeout
+                for directory in self.walk(listing["key"], listing, deadline):
+                    if not _put(results, self._directory_output(*directory), stop):
+                        break
+            except Exception as err:  # pylint: disable=broad-except
+                print("Exception been caught, error:", err)
+                _put(results, (listing["key"], {"error": str(err)}), stop)
+            finally:
+                _put(results, None, stop)
+
+    def _build_tree(self, directories):
+        """Build the output tree of the directories yielded by walk()."""
+        output = None
+        # output nodes of the directories listed but not read yet
+        unread = {}
+        for listing, key, children in directories:
+            node = {} if output is None else unread.pop(key)
+            if output is None:
+                output = node
+            if listing is not None and not children:  # Some directories are empty
+                node.update(self._key_output(listing))
+                continue
+            node.update({"type": "directory", "path": key, "children": []})
+            for child in children:
+                child_node = {} if child.get("dir") else self._key_output(child)
+                if child.get("dir"):
+                    unread[child["key"]] = child_node
+                node["children"].append(child_node)
+            if node["children"]:
+                node["children_count"] = len(node["children"])
+        return output
+
+    def _directory_output(self, listing, key, children):
+        """Return the title and keys of a directory, an empty one is a key itself."""
+        if listing is not None and not children:
+            return key, [self._key_output(listing)]
+        return key, [self._key_output(child) for child in children if not child.get("dir")]
+
+    def _key_output(self, node):
+        """Return the requested values of a key."""
+        return {desired: node.get(desired, "") for desired in self.output_values}
+
+
+def _parse_peers(etcd_peers):
+    """Return the protocol and the (host, port) of every peer of a comma separated list."""
+    urls = [urlparse(peer.strip()) for peer in str(etcd_peers).split(",") if peer.strip()]
+    if not urls:
+        raise ValueError("ETCDCTL_PEERS env variable has no peer.")
+    if len({url.scheme for url in urls}) > 1:
+        raise ValueError("ETCDCTL_PEERS must use the same protocol for every peer.")
+    return urls[0].scheme, [(url.hostname, url.port or DEFAULT_PORT) for url in urls]
+
+
+def _put(results, item, stop):
+    """Put the item in the bounded results, giving up once the caller stopped reading them."""
+    while not stop.is_set():
+        try:
+            results.put(item, timeout=PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _parent(key):
+    """Return the key of the directory holding key."""
+    return key.rsplit("/", 1)[0] or "/"
+
+
+def _apply_event(nodes, event, snapshot_node):
+    """Apply an etcd event (the result of a watch) to the nodes of a snapshot."""
+    if event.action in DELETE_ACTIONS:
+        nodes.pop(event.key, None)
+        prefix = event.key + "/"
+        for key in [key for key in nodes if key.startswith(prefix)]:
+            del nodes[key]
+        return
+    nodes[event.key] = snapshot_node(event.__dict__)
+    # directories created on the way to the key
+    parent = _parent(event.key)
+    while parent != "/" and parent not in nodes:
+        nodes[parent] = snapshot_node({"key": parent, "dir": True,
+                                       "modifiedIndex": event.modifiedIndex,
+                                       "createdIndex": event.modifiedIndex})
+        parent = _parent(parent)
+
+
+def _walk_nodes(root_key, nodes):
+    """Yield the directories of a snapshot like Etcd.walk(), their children sorted by key."""
+    children = {}
+    for key in sorted(nodes):
+        children.setdefault(_parent(key), []).append(nodes[key])
+    pending = [(None, "/")]
+    while pending:
+        listing, key = pending.pop()
+        directory_children = children.get(key, [])
+        yield listing, root_key if listing is None else key, directory_children
+        pending.extend((child, child["key"]) for child in reversed(directory_children)
+                       if child.get("dir"))
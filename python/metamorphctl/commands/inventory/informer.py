@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Watch based local store of a kubernetes list api."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import json
+import threading
+
+from kubernetes.watch.watch import iter_resp_lines
+
+from metamorphctl.utils.profiling import PROFILER
+
+# The api server ends every watch after this time, it is then started again from the last
+# resourceVersion seen
+WATCH_TIMEOUT_SECONDS = 300
+# Wait before watching again after a failed watch
+RETRY_SECONDS = 5
+# Status code of a watch whose resourceVersion is too old (etcd compacted it)
+GONE = 410
+
+
+class Informer():
+    """Keep the objects of a kubernetes list api current in a local store.
+
+    The api is listed once, then a background thread watches it from the resourceVersion of
+    the list and applies every event to the store. Objects are kept as the api json.
+    """
+
+    def __init__(self, api, lister):
+        """Init.
+
+        api is the kubernetes list method (e.g. CoreV1Api().list_pod_for_all_namespaces),
+        lister a function returning the raw json of a full list of it.
+        """
+        self.api = api
+        self.lister = lister
+        self.resource_version = None
+        self._store = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """List the api and start watching it, list errors are raised."""
+        self._relist()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop watching, the current watch ends when its next event or timeout arrives."""
+        self._stopped.set()
+
+    def items(self):
+        """Return the objects of the store."""
+        with self._lock:
+            return list(self._store.values())
+
+    def _relist(self):
+        out = self.lister()
+        store = {_key(item): item for item in out.get('items') or []}
+        with self._lock:
+            self._store = store
+            self.resource_version = (out.get('metadata') or {}).get('resourceVersion')
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._watch()
+            except Exception as err:  # pylint: disable=broad-except
+                print("Exception been caught, error:", err)
+                self._stopped.wait(RETRY_SECONDS)
+
+    def _watch(self):
+        """Apply the events of a single watch request to the store."""
+        response = self.api(
+            watch=True,
+            resource_version=self.resource_version,
+            allow_watch_bookmarks=True,
+            timeout_seconds=WATCH_TIMEOUT_SECONDS,
+            _preload_content=False)
+        PROFILER.record_call()
+        try:
+            for line in iter_resp_lines(response):
+                if self._stopped.is_set():
+                    return
+                if not self._apply(json.loads(line)):
+                    return
+        finally:
+            response.close()
+            response.release_conn()
+
+    def _apply(self, event):
+        """Apply a watch event, return False when the watch has to be started again."""
+        kind, obj = event.get('type'), event.get('object') or {}
+        if kind == 'ERROR':
+            if obj.get('code') != GONE:
+                raise RuntimeError("Watch error: {}".format(obj.get('message')))
+            # too old to resume, the store is rebuilt from a new list
+            self._relist()
+            return False
+        with self._lock:
+            if kind in ('ADDED', 'MODIFIED'):
+                self._store[_key(obj)] = obj
+            elif kind == 'DELETED':
+                self._store.pop(_key(obj), None)
+            self.resource_version = (obj.get('metadata') or {}).get(
+                'resourceVersion', self.resource_version)
+        return True
+
+
+def _key(obj):
+    metadata = obj.get('metadata') or {}
+    return metadata.get('uid') or "{}/{}".format(metadata.get('namespace'), metadata.get('name'))
@@ -20,38 +20,128 @@
 # express and approved by McAfee in writing
 
 import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import jmespath
 
 from kubernetes import client
 from kubernetes.client.rest import ApiException
 
 from metamorphctl.utils.config import Config
-from metamorphctl.utils.kubeutils import (find_api_in_kubernetes, load_kubernetes)
+from metamorphctl.commands.inventory.cache import TitleCache
+from metamorphctl.commands.inventory.informer import Informer
+from metamorphctl.utils.profiling import PROFILER
+from metamorphctl.utils.kubeutils import (find_api_in_kubernetes, load_kubeconfig,
+                                          reset_api_index, shared_api_client)
+
+# Titles collected at the same time, tuned in config.yaml under `inventory_settings.kubernetes`
+# with the connections kept open to the api server (defaults to max_workers).
+DEFAULT_MAX_WORKERS = 4
+
+# Times a chunked list is started again after its continue token expired
+MAX_LIST_RESTARTS = 3
 
 
 class Kubernetes():
     """Class to handle kubernetes collector."""
 
-    def collect(self):  # pylint: disable=no-self-use
+    def __init__(self):
+        """Init."""
+        settings = (Config().get("inventory_settings") or {}).get("kubernetes") or {}
+        self.max_workers = settings.get("max_workers", DEFAULT_MAX_WORKERS)
+        self.connection_pool_maxsize = settings.get("connection_pool_maxsize", self.max_workers)
+        # title -> Informer, only kept in informer mode
+        self.informers = {} if settings.get("informer") else None
+        self.cache = TitleCache()
+        # kubeconfig of the cluster, None for the one of the system. The titles are collected
+        # in threads without the click context, the inventory command sets it beforehand
+        self.kubeconfig = None
+
+    def collect(self):
         """Collect kubernetes resources."""
-        response = {}
-        k8s_resources = Config().get("inventory").get("kubernetes")
+        k8s_resources = Config().get("inventory").get("kubernetes") or []
+        results = dict(self.iter_collect(k8s_resources))
+        return {req['title']: results[req['title']] for req in k8s_resources}
+
+    def iter_collect(self, k8s_resources=None):
+        """Yield (title, items) as soon as each title is collected."""
+        if k8s_resources is None:
+            k8s_resources = Config().get("inventory").get("kubernetes") or []
         if not k8s_resources:
-            return response
-        load_kubernetes()
-        for req in k8s_resources:
+            return
+        # informers keep using the api client they were started with
+        if not self.informers:
+            load_kubeconfig(self.kubeconfig)
+            pool_size = self.connection_pool_maxsize
+            if self.informers is not None:
+                # every informer keeps a connection open for its watch
+                pool_size = max(pool_size, len(k8s_resources) + self.max_workers)
+            reset_api_index(pool_size)
+        # titles are cached per cluster, told apart by their api server
+        scope = shared_api_client().configuration.host
+        pending = list(k8s_resources)
+        running = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                # a finished title is only kept until it is yielded, so at most max_workers
+                # titles are in memory at once
+                while pending and len(running) < self.max_workers:
+                    running.add(executor.submit(_collect_title, pending.pop(0), self.informers,
+                                                self.cache, scope))
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                while done:
+                    yield done.pop().result()
+
+    def stop(self):
+        """Stop the informers, if any."""
+        for informer in (self.informers or {}).values():
+            informer.stop()
+        if self.informers:
+            self.informers.clear()
+
+
+def _collect_title(req, informers=None, cache=None, scope=None):
+    """Collect a single title, keeping its errors in its own entry."""
+    title = req['title']
+    watched = informers is not None and _can_watch(req)
+    with PROFILER.section("kubernetes", title):
+        res = cache.get("kubernetes", scope, req) if cache and not watched else None
+        if res is not None:
+            print('Using cached k8s: {}'.format(title))
+        else:
             try:
-                title = req['title']
                 print('Collecting k8s: {}'.format(title))
-                res = _handle_request(req)
-                response[title] = res
+                if watched:
+                    res = _informer_items(req, informers)
+                else:
+                    res = _handle_request(req)
             except ApiException as ex:
                 print("No data for {} to be collected".format(title))
-                response[title] = {'error': ex.reason}
+                res = {'error': ex.reason}
             except Exception as ex:  # pylint: disable=broad-except
                 print("Exception been caught, error:", ex)
-                response[title] = {'error': str(ex)}
-        return response
+                res = {'error': str(ex)}
+            if cache and not watched:
+                cache.put("kubernetes", scope, req, res)
+        PROFILER.record_items(res)
+    return title, res
+
+
+def _can_watch(req):
+    """Only the raw list apis can be watched, not the workarounds."""
+    return req['api'] not in globals() and req.get('raw', True)
+
+
+def _informer_items(req, informers):
+    """Return the items of the title informer, starting it on the first call."""
+    informer = informers.get(req['title'])
+    if informer is None:
+        informer = Informer(
+            find_api_in_kubernetes(req['api']),
+            lambda: _execute_k8s_api_raw(req['api'], req.get('limit'))).start()
+        # a title whose first list failed is tried again on the next collect
+        informers[req['title']] = informer
+    return informer.items()
 
 
 def _handle_request(req):
@@ -62,36 +152,36 @@ def _handle_request(req):
     # Invoke our workaround function if exists
     if resource in globals():
         out = globals()[resource]()
-    # Else, let k8s do the work
+    # Deserializing into kubernetes models and back costs far more than the request itself,
+    # so the json is read as is unless the title asks for the models with `raw: false`
+    elif req.get('raw', True):
+        # the items list built from the chunks is returned as is, without another copy
+        return _execute_k8s_api_raw(resource, req.get('limit')).get('items') or []
     else:
         k8s_api = find_api_in_kubernetes(resource)
-        out = client.ApiClient().sanitize_for_serialization(k8s_api())
+        out = shared_api_client().sanitize_for_serialization(k8s_api())
+        PROFILER.record_call()
     res += jmespath.search("items[]", out)
 
     return res
 
 
-def list_controller_revision_for_all_namespaces():
-    """Workaround for list_controller_revision_for_all_namespaces."""
-    return _execute_k8s_api_raw('list_controller_revision_for_all_namespaces')
-
-
-def list_api_service():
-    """Workaround for list_api_service."""
-    return _execute_k8s_api_raw('list_api_service')
-
-
 def list_cluster_custom_object():
     """Workaround for list_cluster_custom_object."""
-    custom_resources = client.ApiextensionsV1beta1Api().list_custom_resource_definition()
+    api_client = shared_api_client()
+    custom_resources = client.ApiextensionsV1beta1Api(
+        api_client).list_custom_resource_definition()
+    PROFILER.record_call()
     result = {}
     for resource in custom_resources.items:
         name = resource.metadata.name
         group = resource.spec.group
         version = resource.spec.version
         plural = resource.spec.names.plural
-        output = client.CustomObjectsApi().list_cluster_custom_object(group, version, plural)
-        sanitized_output = client.ApiClient().sanitize_for_serialization(output)
+        output = client.CustomObjectsApi(api_client).list_cluster_custom_object(
+            group, version, plural)
+        PROFILER.record_call()
+        sanitized_output = api_client.sanitize_for_serialization(output)
         result[name] = sanitized_output
     return {"items": [result]}
 
@@ -106,17 +196,46 @@ def list_node_metrics():
     return _execute_k8s_metrics_raw('/apis/metrics.k8s.io/v1beta1/nodes/')
 
 
-def _execute_k8s_api_raw(api_name):
+def _execute_k8s_api_raw(api_name, limit=None):
+    """Call a list api, following its continue tokens in chunks of limit items if set."""
     k8s_api = find_api_in_kubernetes(api_name)
-    result = k8s_api(_preload_content=False)
-    return json.loads(result.data)
+    kwargs = {'limit': limit} if limit else {}
+    items = []
+    restarts = 0
+    while True:
+        try:
+            result = k8s_api(_preload_content=False, **kwargs)
+        except ApiException as ex:
+            # 410 Gone: the continue token expired (etcd compacted the snapshot). Items already
+            # read belong to that snapshot, so the list starts over from the beginning
+            if ex.status != 410 or '_continue' not in kwargs or restarts >= MAX_LIST_RESTARTS:
+                raise
+            print("Continue token for {} expired, listing it again".format(api_name))
+            restarts += 1
+            items = []
+            kwargs.pop('_continue')
+            continue
+        PROFILER.record_call(len(result.data))
+        out = json.loads(result.data)
+        # the raw chunk is dropped before the next one is read, only its items are kept
+        result = None
+        if not limit:
+            return out
+        items.extend(out.get('items') or [])
+        metadata = out.get('metadata') or {}
+        next_token = metadata.pop('continue', None)
+        if not next_token:
+            # every chunk has the resourceVersion of the list snapshot
+            return {'metadata': metadata, 'items': items}
+        kwargs['_continue'] = next_token
 
 
 def _execute_k8s_metrics_raw(metric_name):
-    result = client.ApiClient().call_api(
+    result = shared_api_client().call_api(
         metric_name,
         'GET',
         auth_settings=['BearerToken'],
         response_type='json',
         _preload_content=False)
+    PROFILER.record_call(len(result[0].data))
     return json.loads(result[0].data)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Streaming inventory writer."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import json
+import threading
+
+from metamorphctl.utils.awsutils import REGION_KEY, is_region_error
+
+
+class NdjsonWriter():
+    """Write inventory records as newline delimited json, one line per resource.
+
+    Every line is `{"system": ..., "title": ..., "record": ...}`, or
+    `{"system": ..., "title": ..., "error": ...}` when a title could not be collected, with
+    the `region` it failed in when the others were collected.
+    """
+
+    def __init__(self, stream):
+        """Init."""
+        self.stream = stream
+        self.records = 0
+        self._lock = threading.Lock()
+
+    def write(self, system, title, items):
+        """Write the items of a title, collectors may call it from several threads."""
+        if isinstance(items, dict) and set(items.keys()) == {"error"}:
+            lines = [{"system": system, "title": title, "error": items["error"]}]
+        else:
+            records = items if isinstance(items, list) else [items]
+            lines = (_line(system, title, record) for record in records)
+        # a title is written at once so its lines are not interleaved with other titles
+        with self._lock:
+            for line in lines:
+                self.stream.write(json.dumps(line, default=str))
+                self.stream.write("\n")
+                self.records += 1
+            self.stream.flush()
+
+
+def _line(system, title, record):
+    if is_region_error(record):
+        return {"system": system, "title": title, "region": record[REGION_KEY],
+                "error": record["error"]}
+    return {"system": system, "title": title, "record": record}
@@ -21,57 +21,89 @@
 
 import json
 
-import jmespath
 import xlsxwriter
 
+from metamorphctl.utils.awsutils import REGION_KEY, is_region_error
 from metamorphctl.utils.printutils import print_success
-from metamorphctl.commands.inventory.report_handlers.jmespath_custom import CustomFunctions
+from metamorphctl.commands.inventory.report_handlers.jmespath_custom import (
+    JMESPATH_OPT, prefetch, search)
 
-JMESPATH_OPT = jmespath.Options(custom_functions=CustomFunctions())
+
+# Look of the "Table Style Medium 9" excel tables, which are not available in
+# constant_memory mode
+HEADER_FORMAT = {'bold': True, 'font_color': '#FFFFFF', 'bg_color': '#4472C4',
+                 'border': 1, 'border_color': '#8EA9DB'}
+BAND_FORMAT = {'bg_color': '#D9E1F2'}
+COLUMN_WIDTH = 40
 
 
 def handle(name, config, output):  # pragma: no cover
     """Handle excel report."""
     workbook_name = '{}.xlsx'.format(name)
-    workbook = xlsxwriter.Workbook(workbook_name)
+    # constant_memory flushes every row to disk once the next one is written, so the
+    # memory used does not grow with the number of rows
+    workbook = xlsxwriter.Workbook(workbook_name, {'constant_memory': True})
+    formats = {
+        'header': workbook.add_format(HEADER_FORMAT),
+        'band': workbook.add_format(BAND_FORMAT),
+    }
 
     for cfg in config:
         # Include it in the report by default unless `report` is defined with false
-        if cfg.get('report', True):
-            _handle_item(workbook, cfg, output[cfg['title']])
+        if not cfg.get('report', True):
+            continue
+        item = output.get(cfg['title'])
+        # Titles that failed, or are missing from an older saved inventory, have no rows
+        if not isinstance(item, list):
+            print("Skipping {} in the report, no items collected".format(cfg['title']))
+            continue
+        failed = [record for record in item if is_region_error(record)]
+        for error in failed:
+            print("Skipping {} of {} in the report, error: {}".format(
+                cfg['title'], error[REGION_KEY], error['error']))
+        if failed:
+            item = [record for record in item if not is_region_error(record)]
+        _handle_item(workbook, formats, cfg, item)
 
     workbook.close()
     print_success("Excel report available at {}".format(workbook_name))
+    stats = JMESPATH_OPT.custom_functions.memo_stats()
+    print("Enrichment calls of the run so far: {hits} served from cache, {misses} "
+          "computed".format(**stats))
 
 
-def _handle_item(workbook, cfg, item):  # pragma: no cover
-    # pylint: disable=too-many-branches
+def _handle_item(workbook, formats, cfg, item):
     worksheet = workbook.add_worksheet(cfg['title'])
 
     header = []
+    expressions = []
     for field in cfg['fields']:
         if isinstance(field, str):
-            header.append({"header": field})
+            header.append(field)
+            expressions.append(field)
         else:
-            header.append({"header": list(field.keys())[0]})
-
-    rows = []
-    for subitem in item:
-        row = []
-        for field in cfg['fields']:
-            if isinstance(field, str):
-                val = jmespath.search(field, subitem, options=JMESPATH_OPT)
-            else:
-                val = jmespath.search(list(field.values())[0], subitem, options=JMESPATH_OPT)
-            row.append(_parse_value(val))
-        rows.append(row)
-
-    # Add a fake row in case no resources were found
-    # Otherwise the excel table will fail with errors
-    if not rows:
-        rows.append(['Empty'] * len(header))
-    worksheet.set_column(0, len(header) - 1, 40)  # column length
-    worksheet.add_table(0, 0, len(rows), len(header) - 1, {'data': rows, 'columns': header})
+            header.append(list(field.keys())[0])
+            expressions.append(list(field.values())[0])
+
+    # resolve enrichment calls shared by many rows (e.g. AMIs) in bulk first
+    prefetch(expressions, item)
+
+    last_row = max(len(item), 1)
+    last_col = len(header) - 1
+    worksheet.set_column(0, last_col, COLUMN_WIDTH)  # column length
+    # rows must be written in order in constant_memory mode, header first
+    worksheet.write_row(0, 0, header, formats['header'])
+    for row, subitem in enumerate(item, start=1):
+        worksheet.write_row(
+            row, 0, [_parse_value(search(expression, subitem)) for expression in expressions])
+    # Add a fake row in case no resources were found, so the sheet still has a data row
+    if not item:
+        worksheet.write_row(1, 0, ['Empty'] * len(header))
+
+    worksheet.autofilter(0, 0, last_row, last_col)
+    worksheet.freeze_panes(1, 0)
+    worksheet.conditional_format(1, 0, last_row, last_col, {
+        'type': 'formula', 'criteria': '=MOD(ROW(),2)=0', 'format': formats['band']})
 
 
 def _parse_value(val):  # pragma: no cover
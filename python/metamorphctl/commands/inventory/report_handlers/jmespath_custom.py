@@ -19,8 +19,39 @@
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
 
-import boto3
-from jmespath import functions
+import functools
+import json
+import threading
+from collections import OrderedDict
+
+import jmespath
+from botocore.exceptions import ClientError
+from jmespath import functions, visitor
+
+from metamorphctl.utils.awsutils import REGION_KEY, get_client
+
+# Distinct expressions kept compiled, config.yaml holds a few hundred of them
+EXPRESSION_CACHE_SIZE = 1024
+
+# Enrichment results kept during a run, most recently used first
+MEMO_SIZE = 4096
+
+# AMIs resolved by a single describe_images call when prefetching
+AMI_BATCH_SIZE = 100
+
+# Custom functions able to resolve the arguments of a whole title at once,
+# mapped to the CustomFunctions method doing it
+BATCH_FUNCTIONS = {'aws_ami': 'prefetch_aws_ami'}
+
+# Nodes whose first child is evaluated against the same value as the node itself
+_FIRST_CHILD_SCOPED = ('subexpression', 'pipe', 'projection', 'value_projection',
+                       'filter_projection', 'flatten', 'index_expression')
+# Nodes whose children are all evaluated against the same value as the node itself
+_ALL_CHILDREN_SCOPED = ('function_expression', 'multi_select_list', 'comparator',
+                        'and_expression', 'or_expression', 'not_expression')
+
+# Region of the record being searched by each thread, the enrichment functions call AWS there
+_LOCAL = threading.local()
 
 
 # https://pypi.org/project/jmespath/
@@ -29,44 +60,111 @@ class CustomFunctions(functions.Functions):  # pragma: no cover
 
     # pylint: disable=no-self-use
 
+    def __init__(self):
+        """Init."""
+        self._memo = OrderedDict()
+        self._memo_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def call_function(self, function_name, resolved_args):
+        """Call a function, memoizing the results of the enrichment ones."""
+        if function_name in functions.Functions.FUNCTION_TABLE:
+            # builtin jmespath functions are cheap, do not fill the memo with them
+            return super().call_function(function_name, resolved_args)
+
+        key = _memo_key(function_name, resolved_args, _current_region())
+        with self._memo_lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.hits += 1
+                return self._memo[key]
+            self.misses += 1
+        result = super().call_function(function_name, resolved_args)
+        self._remember(key, result)
+        return result
+
+    def memo_stats(self):
+        """Return how many enrichment calls were served from the memo."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._memo)}
+
+    def clear_memo(self):
+        """Forget memoized results and reset the counters."""
+        with self._memo_lock:
+            self._memo.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _remember(self, key, result):
+        with self._memo_lock:
+            self._memo[key] = result
+            self._memo.move_to_end(key)
+            while len(self._memo) > MEMO_SIZE:
+                self._memo.popitem(last=False)
+
+    def prefetch_aws_ami(self, ami_ids, region=None):
+        """Resolve AMIs of a region with bulk describe_images calls.
+
+        The results are memoized, so later aws_ami() calls for these ids do not call AWS again.
+        """
+        unique = {ami for ami in ami_ids if isinstance(ami, str)}
+        missing = sorted(ami for ami in unique
+                         if _memo_key('aws_ami', [ami], region) not in self._memo)
+        client = get_client('ec2', region_name=region)
+        for start in range(0, len(missing), AMI_BATCH_SIZE):
+            batch = missing[start:start + AMI_BATCH_SIZE]
+            try:
+                # ImageIds would fail the whole batch for a single deregistered AMI, the filter
+                # only returns the images that still exist
+                images = client.describe_images(
+                    Filters=[{'Name': 'image-id', 'Values': batch}])['Images']
+            except ClientError as err:
+                # leave this batch to be resolved one by one
+                print("AMI prefetch failed, error:", err)
+                continue
+            found = {image['ImageId']: image for image in images}
+            for ami_id in batch:
+                self._remember(_memo_key('aws_ami', [ami_id], region),
+                               {'Images': [found[ami_id]] if ami_id in found else []})
+
     @functions.signature({'types': ['string']})
     def _func_aws_ami(self, ami_id):
-        client = boto3.client('ec2')
+        client = _client('ec2')
         return client.describe_images(ImageIds=[ami_id])
 
     @functions.signature({'types': ['string']})
     def _func_aws_attached_policy(self, role_name):
-        client = boto3.client('iam')
+        client = _client('iam')
         return client.list_attached_role_policies(RoleName=role_name)
 
     @functions.signature({'types': ['array']})
     def _func_aws_policy_document(self, policy):
-        client = boto3.client('iam')
+        client = _client('iam')
         return client.get_policy_version(PolicyArn=policy[0], VersionId=policy[1])
 
     @functions.signature({'types': ['string']})
     def _func_aws_elb_tags(self, elb_name):
-        client = boto3.client('elb')
+        client = _client('elb')
         return client.describe_tags(LoadBalancerNames=[elb_name])
 
     @functions.signature({'types': ['string']})
     def _func_aws_elbv2_tags(self, elb_arn):
-        client = boto3.client('elbv2')
+        client = _client('elbv2')
         return client.describe_tags(ResourceArns=[elb_arn])
 
     @functions.signature({'types': ['string']})
     def _func_aws_elbv2_listeners(self, elb_arn):
-        client = boto3.client('elbv2')
+        client = _client('elbv2')
         return client.describe_listeners(LoadBalancerArn=elb_arn)
 
     @functions.signature({'types': ['string']})
     def _func_aws_s3_location(self, bucket):
-        client = boto3.client('s3')
+        client = _client('s3')
         return client.get_bucket_location(Bucket=bucket)
 
     @functions.signature({'types': ['string']})
     def _func_aws_s3_lifecycle(self, bucket):
-        client = boto3.client('s3')
+        client = _client('s3')
         try:
             return client.get_bucket_lifecycle(Bucket=bucket)
         except Exception:  # pylint: disable=broad-except
@@ -74,12 +172,12 @@ class CustomFunctions(functions.Functions):  # pragma: no cover
 
     @functions.signature({'types': ['string']})
     def _func_aws_s3_versioning(self, bucket):
-        client = boto3.client('s3')
+        client = _client('s3')
         return client.get_bucket_versioning(Bucket=bucket)
 
     @functions.signature({'types': ['string']})
     def _func_aws_s3_encryption(self, bucket):
-        client = boto3.client('s3')
+        client = _client('s3')
         try:
             return client.get_bucket_encryption(Bucket=bucket)
         except Exception:  # pylint: disable=broad-except
@@ -87,7 +185,7 @@ class CustomFunctions(functions.Functions):  # pragma: no cover
 
     @functions.signature({'types': ['string']})
     def _func_aws_s3_public_access_block(self, bucket):
-        client = boto3.client('s3')
+        client = _client('s3')
         try:
             return client.get_public_access_block(Bucket=bucket)
         except Exception:  # pylint: disable=broad-except
@@ -95,15 +193,90 @@ class CustomFunctions(functions.Functions):  # pragma: no cover
 
     @functions.signature({'types': ['string']})
     def _func_aws_s3_acl(self, bucket):
-        client = boto3.client('s3')
+        client = _client('s3')
         return client.get_bucket_acl(Bucket=bucket)
 
     @functions.signature({'types': ['string']})
     def _func_aws_ecr_images(self, repo_name):
-        client = boto3.client('ecr')
+        client = _client('ecr')
         return client.list_images(repositoryName=repo_name)
 
     @functions.signature({'types': ['string']})
     def _func_aws_eks_cluster(self, cluster_name):
-        client = boto3.client('eks')
+        client = _client('eks')
         return client.describe_cluster(name=cluster_name)
+
+
+JMESPATH_OPT = jmespath.Options(custom_functions=CustomFunctions())
+
+
+def clear_memo():
+    """Forget the enrichment results, a run must not report those of a previous one."""
+    JMESPATH_OPT.custom_functions.clear_memo()
+
+
+@functools.lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_expression(expression):
+    """Compile a jmespath expression only once per process."""
+    return jmespath.compile(expression)
+
+
+def search(expression, data):
+    """Search data with a cached compiled expression and the custom functions.
+
+    The enrichment functions called for a record tagged with a region call AWS in it.
+    """
+    previous = _current_region()
+    _LOCAL.region = _record_region(data)
+    try:
+        return compile_expression(expression).search(data, options=JMESPATH_OPT)
+    finally:
+        _LOCAL.region = previous
+
+
+def _current_region():
+    return getattr(_LOCAL, 'region', None)
+
+
+def _record_region(record):
+    """Return the region a record was collected in, None for the default one."""
+    return record.get(REGION_KEY) if isinstance(record, dict) else None
+
+
+def _client(service):
+    """Return the client of the region of the record being searched."""
+    return get_client(service, region_name=_current_region())
+
+
+def _memo_key(function_name, args, region=None):
+    """Build a hashable key from a function call, arguments may be lists."""
+    return function_name, region, json.dumps(args, sort_keys=True, default=str)
+
+
+def prefetch(expressions, items):
+    """Resolve in bulk the batchable custom function calls the expressions make for the items."""
+    interpreter = visitor.TreeInterpreter(JMESPATH_OPT)
+    for expression in expressions:
+        for node in _row_scoped_calls(compile_expression(expression).parsed):
+            loader = BATCH_FUNCTIONS.get(node['value'])
+            if loader and len(node['children']) == 1:
+                values = {}
+                for item in items:
+                    values.setdefault(_record_region(item), []).append(
+                        interpreter.visit(node['children'][0], item))
+                for region, region_values in values.items():
+                    getattr(JMESPATH_OPT.custom_functions, loader)(region_values, region)
+
+
+def _row_scoped_calls(node):
+    """Yield the function calls of an expression evaluated directly against each item."""
+    if node['type'] == 'function_expression':
+        yield node
+    if node['type'] in _FIRST_CHILD_SCOPED:
+        yield from _row_scoped_calls(node['children'][0])
+    elif node['type'] in _ALL_CHILDREN_SCOPED:
+        for child in node['children']:
+            yield from _row_scoped_calls(child)
+    elif node['type'] == 'multi_select_hash':
+        for pair in node['children']:
+            yield from _row_scoped_calls(pair['children'][0])
@@ -22,14 +22,25 @@
 import datetime
 import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from importlib import import_module
 
 import click
 from ruamel import yaml
 
+from metamorphctl.cli import Environment
 from metamorphctl.utils.config import Config
-from metamorphctl.utils.printutils import print_success, print_warn
+from metamorphctl.utils.kubeutils import current_kubeconfig
+from metamorphctl.utils.printutils import print_error, print_success, print_warn
+from metamorphctl.utils.profiling import PROFILER
+from metamorphctl.utils.throttling import SCHEDULER
+from metamorphctl.commands.inventory import delta
+from metamorphctl.commands.inventory.ndjson import NdjsonWriter
+# pylint: disable=cyclic-import
+from metamorphctl.commands.kernels.k8s_certified import K8sCertifiedOperator
 from metamorphctl.commands.inventory.report_handlers import excel
+from metamorphctl.commands.inventory.report_handlers.jmespath_custom import clear_memo
 
 OUTPUT_FORMATS = {
     "json": lambda c, s: json.dump(c, s, indent=2, default=str),
@@ -43,36 +54,348 @@ REPORT_HANDLERS = {
 
 @click.command()
 @click.option('--systems', default='awsv2,kubernetes')
-@click.option('--output', type=click.Choice(['json', 'yaml']), default='json')
+@click.option(
+    '--output',
+    type=click.Choice(['json', 'yaml', 'ndjson']),
+    default='json',
+    help='ndjson writes one line per resource as soon as each title is collected')
 @click.option('--file')
 @click.option(
     '--report',
     type=click.Choice(['excel']),
     default=None,
     help='summary report in the specified format')
-def cli(systems, output, file=None, report=None):
+@click.option(
+    '--parallel',
+    type=click.IntRange(min=1),
+    default=1,
+    help='number of collectors to run concurrently')
+@click.option(
+    '--since',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='previous json/yaml inventory, only write what changed since then')
+@click.option(
+    '--from-file',
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help='saved json/yaml inventory to build the --report from, nothing is collected. '
+    'Inventories of --kernels get a report per kernel')
+@click.option(
+    '--profile',
+    is_flag=True,
+    default=False,
+    help='write the time, api calls, bytes, items and peak memory of every title '
+    'to a <file>.profile.json sidecar')
+@click.option(
+    '--repeat',
+    type=click.IntRange(min=1),
+    default=None,
+    metavar='SECONDS',
+    help='keep running and write a new inventory every SECONDS. With `informer: true` in '
+    'inventory_settings.kubernetes, kubernetes objects are watched instead of listed again')
+@click.option(
+    '--max-age',
+    type=click.IntRange(min=0),
+    default=None,
+    metavar='SECONDS',
+    help='reuse the awsv2 and kubernetes titles cached under ~/.metamorphctl/cache when they '
+    'are younger than SECONDS, overriding the `max_age` of the titles having one. Titles without '
+    '`max_age` are never cached. 0 collects everything')
+@click.option(
+    '--kernels',
+    default=None,
+    help='comma separated kernel namespaces, or a file with one per line, to initialize and '
+    'collect in parallel processes instead of the current shell-init\'ed kernel')
+@click.option('--key', envvar='AWS_ACCESS_KEY_ID', default=None, help='AWS Key of the --kernels')
+@click.option(
+    '--secret', envvar='AWS_SECRET_ACCESS_KEY', default=None, help='AWS Secret of the --kernels')
+@click.option(
+    '--region', envvar='AWS_DEFAULT_REGION', default=None, help='AWS Region of the --kernels')
+@click.option(
+    '--kernel-workers',
+    type=click.IntRange(min=1),
+    default=4,
+    help='number of --kernels collected concurrently, each in its own process')
+@click.option(
+    '--shard',
+    is_flag=True,
+    default=False,
+    help='write one output file per kernel of --kernels instead of a combined one')
+# pylint: disable=too-many-arguments,too-many-locals
+def cli(systems, output, file=None, report=None, parallel=1, since=None, from_file=None,
+        profile=False, repeat=None, max_age=None, kernels=None, key=None, secret=None,
+        region=None, kernel_workers=4, shard=False):
     """Write an inventory of the system."""
+    if from_file:
+        if not report:
+            raise click.UsageError("--from-file requires --report")
+        _report_from_file(from_file, systems, report)
+        return
+    if since and output == 'ndjson':
+        raise click.UsageError("--since cannot be used with --output ndjson")
+    # the previous inventory can be big, it is read once for every --repeat run
+    previous = _load_inventory(since) if since else None
+    if previous is not None and "kernels" in previous:
+        raise click.UsageError("--since requires the inventory of a single kernel, {} holds "
+                               "several. Use one of its --shard files instead".format(since))
+    if kernels:
+        if output == 'ndjson' or since or profile or repeat:
+            raise click.UsageError(
+                "--kernels cannot be used with --output ndjson, --since, --profile or --repeat")
+        if not (key and secret and region):
+            raise click.UsageError("--kernels requires --key, --secret and --region, or the "
+                                   "AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and "
+                                   "AWS_DEFAULT_REGION environment variables")
+        namespaces = _read_kernels(kernels)
+        if not namespaces:
+            raise click.UsageError("No kernel namespace found in --kernels")
+        _inventory_kernels(namespaces, (key, secret, region), systems, output, file, report,
+                           parallel, max_age, kernel_workers, shard)
+        return
+    if shard:
+        raise click.UsageError("--shard requires --kernels")
+
     collectors = _build_collectors(systems, Config().get("inventory").keys())
-    items = {}
+    _apply_max_age(collectors, max_age)
+    # the collectors run in threads, without the click context holding the kubeconfig
+    _apply_kubeconfig(collectors, current_kubeconfig())
+    try:
+        while True:
+            _run_inventory(collectors, output, file, report, parallel, (since, previous),
+                           profile)
+            if not repeat:
+                break
+            time.sleep(repeat)
+    finally:
+        _stop_collectors(collectors)
+
+
+def _apply_max_age(collectors, max_age):
+    """Override the max age of the titles cached by the collectors."""
+    if max_age is None:
+        return
     for col in collectors:
+        if hasattr(col["instance"], "cache"):
+            col["instance"].cache.max_age = max_age
+
+
+def _apply_kubeconfig(collectors, kubeconfig):
+    """Set the kubeconfig of the cluster collected by the collectors."""
+    for col in collectors:
+        if hasattr(col["instance"], "kubeconfig"):
+            col["instance"].kubeconfig = kubeconfig
+
+
+def _stop_collectors(collectors):
+    """Release what the collectors keep between runs (kubernetes informers)."""
+    for col in collectors:
+        if hasattr(col["instance"], "stop"):
+            col["instance"].stop()
+
+
+def _run_inventory(collectors, output, file, report, parallel, since, profile):
+    """Run the collectors once and write their output.
+
+    since is the (file, content) of the previous inventory, its file is None to write
+    everything.
+    """
+    file = _output_file(output, file)
+    clear_memo()
+    if profile:
+        PROFILER.start()
+    try:
+        if output == 'ndjson':
+            _stream_output(file, collectors, report, parallel)
+        else:
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                # map keeps the collectors order so the output is the same as a sequential run
+                items = dict(executor.map(lambda col: _run_collector(col, report), collectors))
+
+            content = {"dateUtc": datetime.datetime.utcnow().isoformat(), "systems": items}
+            if since[0]:
+                content = _delta_since(*since, content)
+            _write_output(output, file, content)
+    finally:
+        if profile:
+            PROFILER.stop()
+    if profile:
+        _write_profile(file)
+    _print_aws_scheduling()
+
+
+def _run_collector(col, report, kernel=None):
+    """Run a single collector and its report, capturing any error."""
+    name = col["name"]
+    with PROFILER.section(name):
+        try:
+            print_warn("Running collector: {}".format(name))
+            items = col["instance"].collect()
+        except Exception as err:  # pylint: disable=broad-except
+            print("Exception been caught, error:", err)
+            return name, {'error': str(err)}
+        if report:
+            try:
+                _generate_report(report, name, items, kernel)
+            except Exception as err:  # pylint: disable=broad-except
+                # the collected items are still written without their report
+                print("Exception been caught, error:", err)
+    return name, items
+
+
+def _stream_output(file, collectors, report, parallel):
+    """Write each title of every collector as soon as it is collected."""
+    with open(file, 'w', encoding='utf-8') as stream:
+        writer = NdjsonWriter(stream)
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            list(executor.map(lambda col: _stream_collector(col, report, writer), collectors))
+    print_success("Full inventory output ({} records) available at {}".format(
+        writer.records, file))
+
+
+def _stream_collector(col, report, writer):
+    """Stream a single collector and its report, capturing any error."""
+    name = col["name"]
+    # the report needs all the titles of the collector, otherwise nothing is kept
+    report_items = {} if report else None
+    with PROFILER.section(name):
         try:
-            name = col["name"]
             print_warn("Running collector: {}".format(name))
-            items[col["name"]] = col["instance"].collect()
+            for title, items in col["instance"].iter_collect():
+                writer.write(name, title, items)
+                if report:
+                    report_items[title] = items
             if report:
-                print_warn("Generating report for: {}. Please wait.".format(name))
-                now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H_%M_%S")
-                filename = "{}_report-{}".format(name, now)
-                cfg = Config().get("inventory").get(name)
-                REPORT_HANDLERS[report].handle(filename, cfg, items[name])
+                _generate_report(report, name, report_items)
         except Exception as err:  # pylint: disable=broad-except
             print("Exception been caught, error:", err)
-            items[col["name"]] = {'error': str(err)}
+            writer.write(name, None, {'error': str(err)})
 
-    _write_output(output, file, {
-        "dateUtc": datetime.datetime.utcnow().isoformat(),
-        "systems": items
-    })
+
+def _generate_report(report, name, items, kernel=None):
+    """Generate the report of a system from its collected items."""
+    print_warn("Generating report for: {}. Please wait.".format(name))
+    now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H_%M_%S")
+    # kernels collected together would otherwise write their reports to the same file
+    prefix = "{}_{}".format(kernel, name) if kernel else name
+    filename = "{}_report-{}".format(prefix, now)
+    cfg = Config().get("inventory").get(name)
+    REPORT_HANDLERS[report].handle(filename, cfg, items)
+
+
+def _report_from_file(from_file, systems, report):
+    """Generate the reports of a saved inventory without collecting anything.
+
+    An inventory of several kernels gets the reports of every kernel, prefixed by its name.
+    """
+    content = _load_inventory(from_file)
+    clear_memo()
+    if "kernels" not in content:
+        _reports_of_kernel(content, from_file, systems, report, content.get("kernel"))
+        return
+    for kernel, kernel_content in content["kernels"].items():
+        if "error" in kernel_content:
+            print_warn("No inventory of kernel {} in {}: {}".format(
+                kernel, from_file, kernel_content["error"]))
+            continue
+        _reports_of_kernel(kernel_content, from_file, systems, report, kernel)
+
+
+def _reports_of_kernel(content, from_file, systems, report, kernel=None):
+    """Generate the reports of the requested systems of a saved kernel inventory."""
+    saved = content.get("systems", {})
+    requested = list(saved.keys()) if systems == "all" else systems.split(",")
+    for name in requested:
+        if name not in saved:
+            print_warn("No {} inventory found in {}".format(name, from_file))
+            continue
+        try:
+            _generate_report(report, name, saved[name], kernel)
+        except Exception as err:  # pylint: disable=broad-except
+            print("Exception been caught, error:", err)
+
+
+def _read_kernels(kernels):
+    """Return the kernel namespaces of a comma separated list or of a file, one per line."""
+    if os.path.isfile(kernels):
+        with open(kernels, encoding='utf-8') as stream:
+            names = [line.split("#")[0] for line in stream]
+    else:
+        names = kernels.split(",")
+    # keep the given order, dropping blank lines and repeated kernels
+    return list(dict.fromkeys(name.strip() for name in names if name.strip()))
+
+
+def _inventory_kernels(kernels, credentials, systems, output, file, report, parallel, max_age,
+                       workers, shard):
+    """Collect several kernels at once, each in a process with its own kubeconfig and env."""
+    file = _output_file(output, file)
+    with ProcessPoolExecutor(max_workers=min(workers, len(kernels))) as executor:
+        futures = [
+            executor.submit(_collect_kernel, kernel, credentials, systems, output, report,
+                            parallel, max_age, _shard_file(file, kernel) if shard else None)
+            for kernel in kernels
+        ]
+        results = dict(future.result() for future in futures)
+
+    if shard:
+        for kernel, result in results.items():
+            if "error" in result:
+                print_error("Kernel {} failed: {}".format(kernel, result["error"]))
+            else:
+                print_success("Inventory of kernel {} available at {}".format(
+                    kernel, result["file"]))
+        return
+    content = {"dateUtc": datetime.datetime.utcnow().isoformat(), "kernels": results}
+    _write_output(output, file, content)
+
+
+def _collect_kernel(kernel, credentials, systems, output, report, parallel, max_age,
+                    shard_file=None):
+    """Initialize a kernel and collect its systems, run in a worker process.
+
+    Initializing a kernel exports its namespace and AWS credentials to the process environment,
+    hence every kernel needs its own process.
+    """
+    print_warn("Initializing kernel: {}".format(kernel))
+    env = Environment()
+    # initialize loads the kubeconfig of the kernel from the environment of the click context,
+    # the collectors run in threads without it and are given that kubeconfig
+    with click.Context(cli, obj=env):
+        try:
+            K8sCertifiedOperator(env, kernel, *credentials).initialize()
+            content = {
+                "dateUtc": datetime.datetime.utcnow().isoformat(),
+                "systems": _collect_systems(systems, report, parallel, max_age, kernel,
+                                            env.kubeconfig)
+            }
+        except Exception as err:  # pylint: disable=broad-except
+            print("Exception been caught, error:", err)
+            return kernel, {'error': str(err)}
+    if shard_file is None:
+        return kernel, content
+    _write_output(output, shard_file, dict(content, kernel=kernel))
+    return kernel, {"file": shard_file}
+
+
+def _collect_systems(systems, report, parallel, max_age, kernel, kubeconfig):
+    """Collect the systems of the current kernel once."""
+    # a process collects several kernels, of other accounts
+    clear_memo()
+    collectors = _build_collectors(systems, Config().get("inventory").keys())
+    _apply_max_age(collectors, max_age)
+    _apply_kubeconfig(collectors, kubeconfig)
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            return dict(executor.map(lambda col: _run_collector(col, report, kernel), collectors))
+    finally:
+        _stop_collectors(collectors)
+
+
+def _shard_file(file, kernel):
+    """Return the output file of a kernel, next to the combined one."""
+    root, ext = os.path.splitext(file)
+    return "{}-{}{}".format(root, kernel, ext)
 
 
 def _build_collectors(requested_collectors, available_collectors):
@@ -89,11 +412,52 @@ def _build_collectors(requested_collectors, available_collectors):
     return classes
 
 
-def _write_output(output, file, content):
-    report_dumper = OUTPUT_FORMATS.get(output, OUTPUT_FORMATS["json"])
+def _delta_since(since, previous, content):
+    """Replace the inventory content by its changes since the previous inventory of a file."""
+    changes = delta.compute(previous.get("systems", {}), content["systems"],
+                            Config().get("inventory"))
+    print_warn("Changes since {}: {added} added, {removed} removed, {changed} changed, "
+               "{unchanged} unchanged".format(since, **changes["summary"]))
+    return {
+        "dateUtc": content["dateUtc"],
+        "since": {"file": since, "dateUtc": previous.get("dateUtc")},
+        "summary": changes["summary"],
+        "systems": changes["systems"]
+    }
+
+
+def _write_profile(file):
+    """Write the profile of the run next to the inventory output."""
+    profile_file = "{}.profile.json".format(file)
+    with open(profile_file, 'w', encoding='utf-8') as stream:
+        json.dump(PROFILER.report(), stream, indent=2)
+    print_success("Inventory profile available at {}".format(profile_file))
+
+
+def _print_aws_scheduling():
+    """Print how much the AWS requests were slowed down by throttling."""
+    for service, stats in sorted(SCHEDULER.stats().items()):
+        print("AWS {}: {requests} requests, {throttled} throttled, "
+              "{waited_seconds}s waiting, final rate {rate}/s".format(service, **stats))
+
+
+def _load_inventory(file):
+    """Load an inventory written by this command, in json or yaml."""
+    with open(file, encoding='utf-8') as stream:
+        if file.endswith((".yaml", ".yml")):
+            return yaml.safe_load(stream)
+        return json.load(stream)
+
+
+def _output_file(output, file):
+    """Return the requested output file or a dated one in the current folder."""
     now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H_%M_%S")
-    file = file if file else os.path.join(
+    return file if file else os.path.join(
         os.getcwd(), "inventory-{date}.{format}".format(date=now, format=output))
+
+
+def _write_output(output, file, content):
+    report_dumper = OUTPUT_FORMATS.get(output, OUTPUT_FORMATS["json"])
     with open(file, 'w', encoding='utf-8') as stream:
         report_dumper(content, stream)
     print_success("Full inventory output available at {}".format(file))
@@ -22,10 +22,10 @@
 import os
 import tempfile
 
-import boto3
 from jinja2 import Template
 from kubernetes import client
 
+from metamorphctl.utils.awsutils import get_client
 from metamorphctl.utils.kubeutils import load_kubernetes
 
 # Template from https://docs.aws.amazon.com/eks/latest/userguide/create-kubeconfig.html
@@ -76,7 +76,7 @@ class K8sCertifiedOperator():
         os.environ['AWS_SECRET_ACCESS_KEY'] = self.secret
         os.environ['AWS_DEFAULT_REGION'] = self.region
 
-        eks = boto3.client('eks')
+        eks = get_client('eks')
 
         cluster = eks.describe_cluster(name=self.kernel_namespace)
         certificate = cluster["cluster"]["certificateAuthority"]["data"]
@@ -107,7 +107,7 @@ def _get_kubeconfig_file(namespace):
 def _validate_aws():
     """Test with a simple AWS API."""
     try:
-        iam_client = boto3.client('iam')
+        iam_client = get_client('iam')
         iam_client.get_user()
         return True
     except Exception:  # pylint: disable=broad-except
@@ -24,8 +24,8 @@ import subprocess
 import sys
 
 import click
-import boto3
 
+from metamorphctl.utils.awsutils import get_client
 from metamorphctl.utils.printutils import print_error, print_success
 
 
@@ -64,7 +64,7 @@ def cli(registry, images_file):
     """
     print("Starting to move images")
     images = read_images_from_file(images_file)
-    ecr = boto3.client("ecr")
+    ecr = get_client("ecr")
     ecr_repositories = ecr.describe_repositories()["repositories"]
 
     # check that we are using the correct registry (just in case)
@@ -21,10 +21,9 @@
 
 from datetime import datetime
 
-import boto3
 import click
 
-from metamorphctl.utils.awsutils import find_ec2_instance
+from metamorphctl.utils.awsutils import find_ec2_instance, get_client
 from metamorphctl.utils.printutils import confirm, print_success
 
 # 15 * 40 = 600 sec = 10 min (boto3 default)
@@ -53,7 +52,7 @@ def cli(node):
 
 
 def _create_ec2_image(ec2_instance):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
     waiter = ec2.get_waiter('image_available')
 
     instance_id = ec2_instance['InstanceId']
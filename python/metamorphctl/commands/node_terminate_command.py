@@ -19,10 +19,9 @@
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
 
-import boto3
 import click
 
-from metamorphctl.utils.awsutils import find_ec2_instance
+from metamorphctl.utils.awsutils import find_ec2_instance, get_client
 from metamorphctl.utils.printutils import confirm, print_success
 
 # 15 * 40 = 600 sec = 10 min (boto3 default)
@@ -51,7 +50,7 @@ def cli(node):
 
 
 def _terminate_ec2_instance(ec2_instance):
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
     waiter = ec2.get_waiter('instance_terminated')
     instance_id = ec2_instance['InstanceId']
 
@@ -20,9 +20,10 @@
 # express and approved by McAfee in writing
 
 import json
-import boto3
 import jsonschema
 
+from metamorphctl.utils.awsutils import get_client, get_resource
+
 DEFAULT_RULE_NUMBER = 32767  # AWS DEFAULT RULE NUMBER
 
 NACL_ENTRY_SCHEMA = {
@@ -56,8 +57,8 @@ class OperationUtil():
         """Init."""
 
         self.vpc_id = vpc_id
-        self.client = boto3.client("ec2")
-        self.vpc_client = boto3.resource("ec2").Vpc(self.vpc_id)
+        self.client = get_client("ec2")
+        self.vpc_client = get_resource("ec2").Vpc(self.vpc_id)
         self.network_acl_id = self.client.describe_network_acls(Filters=[{
             "Name": "default",
             "Values": ["true"]
@@ -0,0 +1 @@
+"""Test module."""
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Excel report handler tests."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import zipfile
+
+import xlsxwriter
+
+from metamorphctl.commands.inventory.report_handlers import excel
+
+
+def _write_sheet(tmp_path, item):
+    path = str(tmp_path / "report.xlsx")
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    formats = {'header': workbook.add_format(excel.HEADER_FORMAT),
+               'band': workbook.add_format(excel.BAND_FORMAT)}
+    cfg = {"title": "VPC", "fields": ["VpcId", {"Cidr": "CidrBlock"}]}
+    excel._handle_item(workbook, formats, cfg, item)
+    workbook.close()
+    with zipfile.ZipFile(path) as xlsx:
+        return xlsx.read("xl/worksheets/sheet1.xml").decode()
+
+
+def test_rows_are_streamed_with_table_formatting(tmp_path):
+    """Test rows are written in constant_memory mode with filter and header."""
+    item = [{"VpcId": "vpc-{}".format(i), "CidrBlock": "10.0.{}.0/24".format(i)}
+            for i in range(3)]
+
+    sheet = _write_sheet(tmp_path, item)
+
+    for value in ["VpcId", "Cidr", "vpc-0", "vpc-2", "10.0.2.0/24"]:
+        assert ">{}<".format(value) in sheet
+    assert '<autoFilter ref="A1:B4"/>' in sheet
+    assert 'ySplit="1"' in sheet
+    assert "MOD(ROW(),2)=0" in sheet
+
+
+def test_empty_title_has_placeholder_row(tmp_path):
+    """Test a title without resources still gets a data row."""
+    sheet = _write_sheet(tmp_path, [])
+
+    assert sheet.count(">Empty<") == 2
+    assert '<autoFilter ref="A1:B2"/>' in sheet
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Jmespath custom functions tests."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2019 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+from unittest import mock
+
+import jmespath
+from botocore.exceptions import ClientError
+
+from metamorphctl.commands.inventory.report_handlers import jmespath_custom
+
+
+def test_search_compiles_each_expression_once():
+    """Test repeated searches reuse the compiled expression."""
+    jmespath_custom.compile_expression.cache_clear()
+    rows = [{"Tags": [{"Key": "Name", "Value": str(i)}]} for i in range(50)]
+
+    with mock.patch.object(jmespath, "compile", wraps=jmespath.compile) as mocked_compile:
+        values = [
+            jmespath_custom.search("Tags[?Key=='Name'] | [0].Value", row) for row in rows
+        ]
+
+    assert values == [str(i) for i in range(50)]
+    mocked_compile.assert_called_once_with("Tags[?Key=='Name'] | [0].Value")
+
+
+def test_search_uses_custom_functions():
+    """Test the shared options expose the custom functions."""
+    jmespath_custom.JMESPATH_OPT.custom_functions.clear_memo()
+    with mock.patch.object(jmespath_custom, "get_client") as mocked_client:
+        mocked_client.return_value.describe_cluster.return_value = {"cluster": {"version": "1.16"}}
+
+        assert jmespath_custom.search("aws_eks_cluster(@).cluster.version", "kernel") == "1.16"
+
+    mocked_client.return_value.describe_cluster.assert_called_once_with(name="kernel")
+
+
+def test_prefetch_resolves_amis_in_bulk():
+    """Test aws_ami rows are served from a single describe_images call."""
+    rows = [{"ImageId": "ami-{}".format(i % 3)} for i in range(30)]
+    expressions = ["InstanceId", "aws_ami(ImageId).Images[].Name"]
+
+    jmespath_custom.JMESPATH_OPT.custom_functions.clear_memo()
+    with mock.patch.object(jmespath_custom, "get_client") as mocked_client:
+        describe_images = mocked_client.return_value.describe_images
+        describe_images.return_value = {
+            "Images": [{"ImageId": "ami-0", "Name": "zero"}, {"ImageId": "ami-1", "Name": "one"}]
+        }
+
+        jmespath_custom.prefetch(expressions, rows)
+        names = [jmespath_custom.search(expressions[1], row) for row in rows]
+
+    describe_images.assert_called_once_with(
+        Filters=[{"Name": "image-id", "Values": ["ami-0", "ami-1", "ami-2"]}])
+    assert names[:3] == [["zero"], ["one"], []]
+
+
+def test_prefetch_keeps_the_batch_when_an_ami_is_deregistered():
+    """Test an AMI missing from its batch is memoized as without images, the others resolved."""
+    rows = [{"ImageId": "ami-{}".format(i)} for i in range(150)]
+    expression = "aws_ami(ImageId).Images[].Name"
+
+    def describe_images(Filters):  # pylint: disable=invalid-name
+        # ami-42 has been deregistered
+        return {"Images": [{"ImageId": ami, "Name": ami} for ami in Filters[0]["Values"]
+                           if ami != "ami-42"]}
+
+    jmespath_custom.JMESPATH_OPT.custom_functions.clear_memo()
+    with mock.patch.object(jmespath_custom, "get_client") as mocked_client:
+        mocked_client.return_value.describe_images.side_effect = describe_images
+
+        jmespath_custom.prefetch([expression], rows)
+        names = [jmespath_custom.search(expression, row) for row in rows]
+
+    assert mocked_client.return_value.describe_images.call_count == 2
+    assert names[42] == []
+    assert names[41] == ["ami-41"] and names[149] == ["ami-149"]
+
+
+def test_prefetch_failed_batch_falls_back_to_single_calls():
+    """Test a failing batch leaves the AMIs to be resolved row by row."""
+    error = ClientError({"Error": {"Code": "RequestLimitExceeded"}}, "DescribeImages")
+
+    jmespath_custom.JMESPATH_OPT.custom_functions.clear_memo()
+    with mock.patch.object(jmespath_custom, "get_client") as mocked_client:
+        describe_images = mocked_client.return_value.describe_images
+        describe_images.side_effect = [error, {"Images": [{"Name": "zero"}]}]
+
+        jmespath_custom.prefetch(["aws_ami(ImageId).Images[].Name"], [{"ImageId": "ami-0"}])
+        name = jmespath_custom.search("aws_ami(ImageId).Images[].Name", {"ImageId": "ami-0"})
+
+    assert name == ["zero"]
+    assert describe_images.call_count == 2
+
+
+def test_custom_functions_are_memoized():
+    """Test repeated enrichment calls with the same arguments only call AWS once."""
+    custom_functions = jmespath_custom.JMESPATH_OPT.custom_functions
+    custom_functions.clear_memo()
+    rows = [{"Arn": "arn:policy", "DefaultVersionId": "v1"}] * 3
+    expression = "aws_policy_document([Arn, DefaultVersionId]).PolicyVersion.VersionId"
+
+    with mock.patch.object(jmespath_custom, "get_client") as mocked_client:
+        get_policy_version = mocked_client.return_value.get_policy_version
+        get_policy_version.return_value = {"PolicyVersion": {"VersionId": "v1"}}
+
+        values = [jmespath_custom.search(expression, row) for row in rows]
+        # builtin functions are not memoized
+        jmespath_custom.search("length(@)", rows)
+
+    assert values == ["v1"] * 3
+    get_policy_version.assert_called_once_with(PolicyArn="arn:policy", VersionId="v1")
+    assert custom_functions.memo_stats() == {"hits": 2, "misses": 1, "size": 1}
+
+
+def test_memo_is_bounded():
+    """Test the least recently used results are evicted."""
+    custom_functions = jmespath_custom.JMESPATH_OPT.custom_functions
+    custom_functions.clear_memo()
+
+    with mock.patch.object(jmespath_custom, "MEMO_SIZE", 2), \
+            mock.patch.object(jmespath_custom, "get_client"):
+        for bucket in ["one", "two", "one", "three", "one"]:
+            jmespath_custom.search("aws_s3_location(@)", bucket)
+
+    assert custom_functions.memo_stats() == {"hits": 2, "misses": 3, "size": 2}
+
+
+def test_enrichment_calls_aws_in_the_record_region():
+    """Test records tagged with a region are enriched from it, and memoized apart."""
+    custom_functions = jmespath_custom.JMESPATH_OPT.custom_functions
+    custom_functions.clear_memo()
+    rows = [{"ImageId": "ami-0"}, {"ImageId": "ami-0", "_region": "eu-west-1"}]
+    expression = "aws_ami(ImageId).Images[].Name"
+
+    def client(service, region_name=None):
+        ec2 = mock.MagicMock()
+        ec2.describe_images.return_value = {
+            "Images": [{"ImageId": "ami-0", "Name": "ami in {}".format(region_name)}]}
+        return ec2
+
+    with mock.patch.object(jmespath_custom, "get_client", side_effect=client) as mocked_client:
+        jmespath_custom.prefetch([expression], rows)
+        names = [jmespath_custom.search(expression, row) for row in rows]
+        eks = jmespath_custom.search("aws_eks_cluster(name)", {"name": "kernel",
+                                                               "_region": "eu-west-1"})
+
+    assert names == [["ami in None"], ["ami in eu-west-1"]]
+    assert mocked_client.call_args_list[:2] == [mock.call("ec2", region_name=None),
+                                                mock.call("ec2", region_name="eu-west-1")]
+    assert mocked_client.call_args_list[2] == mock.call("eks", region_name="eu-west-1")
+    assert eks is not None
+    assert custom_functions.memo_stats()["hits"] == 2
@@ -19,9 +19,12 @@
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
 
+import threading
+import time
 from unittest import mock
 import pytest
-from metamorphctl.commands.inventory.aws import Aws
+from metamorphctl.commands.inventory import aws
+from metamorphctl.commands.inventory.aws import Aws, Awsv2
 from metamorphctl.commands.inventory.aws_handlers.resource_tag import ResourceTag
 from metamorphctl.utils.config import Config
 
@@ -101,3 +104,117 @@ def test_collect_error_with_handler():
         assert len(actual) == 1
         assert len(actual["ResourceTagMappingList"]) == 1
         assert actual["ResourceTagMappingList"]["error"] == expected
+
+
+def _awsv2_config(key):
+    if key == "inventory":
+        return {
+            "awsv2": [
+                {"service": "ec2", "title": "VPC"},
+                {"service": "ec2", "title": "Subnets"},
+                {"service": "ec2", "title": "EC2_Instances"},
+                {"service": "s3", "title": "S3_Buckets"},
+            ]
+        }
+    return {"awsv2": {"max_workers": 4, "max_workers_per_service": 2}}
+
+
+def test_awsv2_collect_keeps_errors_per_title():
+    """Test a failing title does not abort the other awsv2 titles."""
+    def handle(req, region=None):
+        if req["title"] == "Subnets":
+            raise RuntimeError("throttled")
+        return [req["title"]]
+
+    with mock.patch.object(Config, "__init__", lambda x: None), \
+            mock.patch.object(Config, "get", side_effect=_awsv2_config), \
+            mock.patch.object(aws, "_handle_request", side_effect=handle):
+        actual = Awsv2().collect()
+
+    assert list(actual.keys()) == ["VPC", "Subnets", "EC2_Instances", "S3_Buckets"]
+    assert actual["VPC"] == ["VPC"]
+    assert actual["Subnets"] == {"error": "throttled"}
+    assert actual["EC2_Instances"] == ["EC2_Instances"]
+    assert actual["S3_Buckets"] == ["S3_Buckets"]
+
+
+def test_awsv2_collect_caps_concurrency_per_service():
+    """Test no more than max_workers_per_service titles of a service run at once."""
+    lock = threading.Lock()
+    running = {}
+    peak = {}
+
+    def handle(req, region=None):
+        service = req["service"]
+        with lock:
+            running[service] = running.get(service, 0) + 1
+            peak[service] = max(peak.get(service, 0), running[service])
+        time.sleep(0.05)
+        with lock:
+            running[service] -= 1
+        return []
+
+    with mock.patch.object(Config, "__init__", lambda x: None), \
+            mock.patch.object(Config, "get", side_effect=_awsv2_config), \
+            mock.patch.object(aws, "_handle_request", side_effect=handle):
+        Awsv2().collect()
+
+    assert peak["ec2"] == 2
+    assert peak["s3"] == 1
+
+
+def test_awsv2_collect_fans_out_regions():
+    """Test titles run in every configured region and their records are tagged with it."""
+    def config(key):
+        if key == "inventory":
+            return {"awsv2": [
+                {"service": "ec2", "title": "VPC"},
+                {"service": "iam", "title": "IAM_Roles"},
+                {"service": "rds", "title": "RDS", "regions": ["eu-west-1"]},
+                {"service": "ec2", "title": "Subnets", "regions": ["us-east-1", "eu-west-1"]},
+            ]}
+        return {"awsv2": {"regions": ["us-east-1", "us-west-2"]}}
+
+    def handle(req, region=None):
+        if req["title"] == "Subnets" and region == "eu-west-1":
+            raise RuntimeError("denied")
+        if req["title"] == "RDS":
+            raise RuntimeError("not enabled")
+        return [{"Id": "{}-{}".format(req["title"], region)}]
+
+    with mock.patch.object(Config, "__init__", lambda x: None), \
+            mock.patch.object(Config, "get", side_effect=config), \
+            mock.patch.object(aws, "_handle_request", side_effect=handle):
+        actual = Awsv2().collect()
+
+    assert actual["VPC"] == [{"Id": "VPC-us-east-1", "_region": "us-east-1"},
+                             {"Id": "VPC-us-west-2", "_region": "us-west-2"}]
+    # global services ignore the global regions setting
+    assert actual["IAM_Roles"] == [{"Id": "IAM_Roles-None"}]
+    # the title is an error once all its regions failed
+    assert actual["RDS"] == {"error": "eu-west-1: not enabled"}
+    # a failed region does not lose the records of the others
+    assert actual["Subnets"] == [{"Id": "Subnets-us-east-1", "_region": "us-east-1"},
+                                 {"error": "denied", "_region": "eu-west-1"}]
+
+
+def test_awsv2_collect_isolates_region_lookup_and_wraps_scalars():
+    """Test a failing describe_regions only fails its titles and scalar records get a region."""
+    def config(key):
+        if key == "inventory":
+            return {"awsv2": [
+                {"service": "ec2", "title": "VPC", "regions": "all"},
+                {"service": "eks", "title": "EKS", "regions": ["us-east-1", "eu-west-1"]},
+            ]}
+        return {}
+
+    with mock.patch.object(Config, "__init__", lambda x: None), \
+            mock.patch.object(Config, "get", side_effect=config), \
+            mock.patch.object(aws, "get_client") as client_mock, \
+            mock.patch.object(aws, "_handle_request", return_value=["kernel"]):
+        client_mock.return_value.describe_regions.side_effect = RuntimeError("denied")
+        actual = Awsv2().collect()
+
+    assert actual["VPC"] == {"error": "denied"}
+    assert actual["EKS"] == [{"name": "kernel", "_region": "us-east-1"},
+                             {"name": "kernel", "_region": "eu-west-1"}]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Title cache tests."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import os
+import stat
+from unittest import mock
+
+from metamorphctl.commands.inventory import aws
+from metamorphctl.commands.inventory.cache import TitleCache
+
+REQ = {"service": "iam", "api": "list_policies", "objects": "Policies", "title": "IAM_Policies",
+       "max_age": 60, "fields": ["PolicyName"]}
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_items_are_reused_until_max_age(tmp_path):
+    """Test cached items are returned while younger than the title max_age."""
+    clock = _Clock()
+    cache = TitleCache(str(tmp_path), clock=clock)
+    cache.put("awsv2", "123/us-east-1", REQ, [{"PolicyName": "admin"}])
+
+    clock.now += 60
+    assert cache.get("awsv2", "123/us-east-1", REQ) == [{"PolicyName": "admin"}]
+    assert cache.get("awsv2", "456/us-east-1", REQ) is None
+    clock.now += 1
+    assert cache.get("awsv2", "123/us-east-1", REQ) is None
+
+
+def test_key_ignores_presentation_settings(tmp_path):
+    """Test report fields do not change the entry, but api params do."""
+    cache = TitleCache(str(tmp_path))
+    cache.put("awsv2", "scope", REQ, ["policy"])
+
+    assert cache.get("awsv2", "scope", dict(REQ, fields=["Arn"], report=False)) == ["policy"]
+    assert cache.get("awsv2", "scope", dict(REQ, params={"OnlyAttached": True})) is None
+
+
+def test_max_age_override_and_errors(tmp_path):
+    """Test the override replaces the title max_age and errors are not stored."""
+    cache = TitleCache(str(tmp_path), max_age=0)
+    cache.put("awsv2", "scope", REQ, ["policy"])
+    assert cache.get("awsv2", "scope", REQ) is None
+
+    cache.max_age = 3600
+    cache.put("awsv2", "scope", dict(REQ, title="VPC"), {"error": "denied"})
+    assert cache.get("awsv2", "scope", dict(REQ, title="VPC")) is None
+    assert cache.get("awsv2", "scope", REQ) == ["policy"]
+
+
+def test_titles_without_max_age_are_never_cached(tmp_path):
+    """Test the override does not write titles without max_age, and entries are private."""
+    cache = TitleCache(str(tmp_path), max_age=3600)
+    secrets = {"api": "list_secret_for_all_namespaces", "title": "Secrets"}
+    cache.put("kubernetes", "scope", secrets, ["secret"])
+    cache.put("awsv2", "scope", REQ, ["policy"])
+
+    assert cache.get("kubernetes", "scope", secrets) is None
+    entries = [path for path in tmp_path.rglob("*.json")]
+    assert [path.parent.name for path in entries] == ["awsv2"]
+    assert stat.S_IMODE(os.stat(str(entries[0])).st_mode) == 0o600
+
+
+def test_awsv2_title_served_from_cache(tmp_path):
+    """Test a cached awsv2 title does not call the api again."""
+    cache = TitleCache(str(tmp_path))
+
+    with mock.patch.object(aws, "_handle_request", return_value=["policy"]) as handle:
+        first = aws._collect_title(REQ, cache, "123/us-east-1")
+        second = aws._collect_title(REQ, cache, "123/us-east-1")
+
+    assert first == second == ("IAM_Policies", ["policy"])
+    handle.assert_called_once_with(REQ, None)
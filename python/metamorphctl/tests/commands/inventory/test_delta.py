@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""Inventory delta tests."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import datetime
+import json
+
+from metamorphctl.commands.inventory import delta
+
+CONFIG = {"awsv2": [{"title": "VPC", "id": "VpcId"}], "kubernetes": [{"title": "pods"}]}
+
+
+def test_delta_added_removed_changed():
+    """Test records are matched by id and compared by content."""
+    previous = {
+        "awsv2": {
+            "VPC": [{"VpcId": "vpc-1", "CidrBlock": "10.0.0.0/16"},
+                    {"VpcId": "vpc-2", "CidrBlock": "10.1.0.0/16"},
+                    {"VpcId": "vpc-3", "CidrBlock": "10.2.0.0/16"}]
+        }
+    }
+    current = {
+        "awsv2": {
+            "VPC": [{"CidrBlock": "10.0.0.0/16", "VpcId": "vpc-1"},
+                    {"VpcId": "vpc-2", "CidrBlock": "10.9.0.0/16"},
+                    {"VpcId": "vpc-4", "CidrBlock": "10.3.0.0/16"}]
+        }
+    }
+
+    result = delta.compute(previous, current, CONFIG)
+
+    assert result["summary"] == {"added": 1, "removed": 1, "changed": 1, "unchanged": 1}
+    vpc = result["systems"]["awsv2"]["VPC"]
+    assert vpc["added"] == [{"VpcId": "vpc-4", "CidrBlock": "10.3.0.0/16"}]
+    assert vpc["removed"] == [{"VpcId": "vpc-3", "CidrBlock": "10.2.0.0/16"}]
+    assert vpc["changed"] == [{"VpcId": "vpc-2", "CidrBlock": "10.9.0.0/16"}]
+
+
+def test_delta_matches_records_loaded_from_json():
+    """Test values serialized in the previous file (e.g. dates) are not reported as changes."""
+    record = {"metadata": {"uid": "1", "creationTimestamp": datetime.datetime(2020, 1, 1)}}
+    previous = json.loads(json.dumps({"kubernetes": {"pods": [record]}}, default=str))
+
+    result = delta.compute(previous, {"kubernetes": {"pods": [record]}}, CONFIG)
+
+    assert result["summary"]["unchanged"] == 1
+    assert not result["systems"]
+
+
+def test_delta_keeps_errors_and_reports_new_and_gone_titles():
+    """Test a failing title is reported as such, new titles as added and gone ones as removed."""
+    previous = {"kubernetes": {"pods": [{"metadata": {"uid": "1"}}],
+                               "secrets": [{"metadata": {"uid": "2"}}]}}
+    current = {"kubernetes": {"pods": {"error": "Forbidden"},
+                              "nodes": [{"metadata": {"uid": "3"}}]},
+               "awsv2": {"VPC": [{"VpcId": "vpc-1"}]}, "etcd": {"error": "timeout"}}
+
+    result = delta.compute(previous, current, CONFIG)
+
+    assert result["systems"] == {
+        "kubernetes": {
+            "pods": {"error": "Forbidden"},
+            "nodes": {"added": [{"metadata": {"uid": "3"}}], "removed": [], "changed": []},
+            "secrets": {"added": [], "removed": [{"metadata": {"uid": "2"}}], "changed": []},
+        },
+        "awsv2": {"VPC": {"added": [{"VpcId": "vpc-1"}], "removed": [], "changed": []}},
+        "etcd": {"error": "timeout"},
+    }
+    assert result["summary"] == {"added": 2, "removed": 1, "changed": 0, "unchanged": 0}
+
+
+def test_delta_records_without_id_use_their_content():
+    """Test records without id are added/removed as a whole and etcd trees are flattened."""
+    tree = {
+        "type": "directory", "path": "/", "children": [
+            {"type": "directory", "path": "/kernel", "children": [
+                {"key": "/kernel/a", "value": "1"}, {"key": "/kernel/b", "value": "2"}]}]
+    }
+    changed_tree = json.loads(json.dumps(tree))
+    changed_tree["children"][0]["children"][1]["value"] = "3"
+
+    result = delta.compute({"etcd": tree}, {"etcd": changed_tree}, {})
+    assert result["systems"]["etcd"]["nodes"]["changed"] == [{"key": "/kernel/b", "value": "3"}]
+
+    result = delta.compute({"aws": {"Eks": {"name": "a"}}}, {"aws": {"Eks": {"name": "b"}}}, {})
+    assert result["systems"]["aws"]["Eks"]["added"] == [{"name": "b"}]
+    assert result["systems"]["aws"]["Eks"]["removed"] == [{"name": "a"}]
+
+
+def test_delta_tells_regions_apart():
+    """Test records with the same id in two regions are different records."""
+    previous = {"awsv2": {"EKS": [{"name": "kernel", "_region": "us-east-1"}]}}
+    current = {"awsv2": {"EKS": [{"name": "kernel", "_region": "us-east-1"},
+                                 {"name": "kernel", "_region": "eu-west-1"}]}}
+    config = {"awsv2": [{"title": "EKS", "id": "name || @"}]}
+
+    changes = delta.compute(previous, current, config)
+
+    assert changes["summary"]["added"] == 1
+    assert changes["systems"]["awsv2"]["EKS"]["added"] == [{"name": "kernel",
+                                                            "_region": "eu-west-1"}]
+
+
+def test_delta_leaves_failed_regions_out():
+    """Test the records of a region that failed are not removed, its error is reported."""
+    previous = {"awsv2": {"VPC": [{"VpcId": "vpc-1", "_region": "us-east-1"},
+                                  {"VpcId": "vpc-2", "_region": "eu-west-1"}]}}
+    current = {"awsv2": {"VPC": [{"VpcId": "vpc-1", "_region": "us-east-1"},
+                                 {"VpcId": "vpc-3", "_region": "us-east-1"},
+                                 {"error": "denied", "_region": "eu-west-1"}]}}
+    config = {"awsv2": [{"title": "VPC", "id": "VpcId"}]}
+
+    changes = delta.compute(previous, current, config)
+
+    assert changes["summary"] == {"added": 1, "removed": 0, "changed": 0, "unchanged": 1}
+    assert changes["systems"]["awsv2"]["VPC"] == {
+        "added": [{"VpcId": "vpc-3", "_region": "us-east-1"}], "removed": [], "changed": [],
+        "errors": [{"error": "denied", "_region": "eu-west-1"}]}
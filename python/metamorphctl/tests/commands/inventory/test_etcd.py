@@ -19,42 +19,74 @@
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
 
+import json
+import os
+import stat
+import sys
+import time
+import threading
 from unittest import mock
 
 import pytest
+from etcd import (EtcdConnectionFailed, EtcdEventIndexCleared, EtcdException, EtcdResult,
+                  EtcdWatchTimedOut)
 
 from metamorphctl.utils.config import Config
 from metamorphctl.commands.inventory.etcd import Etcd
 
 
 # pylint: disable=unused-argument, missing-docstring
-class _Child:
-    def __init__(self, key, value):
-        self.key = key
-        self.value = value
-        self.dir = False
+class _FakeClient:
+    """Serve the directories of a raw etcd tree, one level at a time."""
 
-    def get(self, value, default=None):
-        return getattr(self, value)
+    def __init__(self, tree):
+        self.tree = tree
+        self.reads = []
 
-    def __getitem__(self, value):
-        return getattr(self, value)
+    def read(self, key, recursive=False, timeout=None):
+        self.reads.append(key)
+        node = self.tree
+        for part in [part for part in key.split("/") if part]:
+            node = next(child for child in node["nodes"]
+                        if child["key"].rsplit("/", 1)[-1] == part)
+        children = [{name: value for name, value in child.items() if name != "nodes"}
+                    for child in node.get("nodes", [])]
+        return EtcdResult("get", dict(node, nodes=children))
 
 
-class _DirectoriesMock:
-    def __init__(self, children=None, nodes=None, key="/kernel"):
-        self._children = children
-        self.nodes = nodes
-        self.action = 'get'
-        self.dir = True
-        self.value = None
-        self.key = key
+class _WatchedClient(_FakeClient):
+    """Serve the events of the keyspace after its snapshot from etcd_index on."""
 
-    def get(self, value, default=None):
-        return getattr(self, value)
+    def __init__(self, tree, etcd_index, events=(), oldest_index=1):
+        super().__init__(tree)
+        self.etcd_index = etcd_index
+        self.events = list(events)
+        self.oldest_index = oldest_index
 
-    def __getitem__(self, value):
-        return getattr(self, value)
+    def read(self, key, recursive=False, timeout=None, wait=False, waitIndex=None):
+        if not wait:
+            result = super().read(key, recursive, timeout)
+            result.etcd_index = self.etcd_index
+            return result
+        if waitIndex < self.oldest_index:
+            raise EtcdEventIndexCleared("The event in requested index is outdated and cleared")
+        for action, node in self.events:
+            if node["modifiedIndex"] >= waitIndex:
+                return EtcdResult(action, node)
+        raise EtcdWatchTimedOut("Watch timed out")
+
+
+def _config(values, settings=None):
+    return lambda key: {"inventory": {"etcd": values},
+                        "inventory_settings": {"etcd": settings or {}}}[key]
+
+
+def _directory(key, *nodes):
+    return {"key": key, "dir": True, "nodes": list(nodes), "modifiedIndex": 1}
+
+
+def _key(key, value):
+    return {"key": key, "value": value, "modifiedIndex": 2, "createdIndex": 2}
 
 
 def test_collect_etcd_with_empty_env():
@@ -88,7 +120,7 @@ def test_collect_etcd_with_empty_resources(etcd):
 
 
 @pytest.mark.parametrize(
-    "etcd_inventory_output, read_side_effect",
+    "etcd_inventory_output, tree",
     [
         (
             {
@@ -99,13 +131,7 @@ def test_collect_etcd_with_empty_resources(etcd):
                 }],
                 'children_count': 1
             },
-            [
-                _DirectoriesMock(children=[
-                    _Child(
-                        "/kernel/KERNEL_NAMESPACE",  # noqa: E501;
-                        "tfseks")
-                ])
-            ]),
+            _directory("/kernel", _key("/kernel/KERNEL_NAMESPACE", "tfseks"))),
         (
             {
                 "type":
@@ -124,41 +150,336 @@ def test_collect_etcd_with_empty_resources(etcd):
                     }],
                     "children_count":
                     2
+                }, {
+                    "key": "/empty"
                 }],
                 "children_count":
-                1
+                2
             },
-            [
-                _DirectoriesMock(
-                    children=[
-                        _DirectoriesMock(
-                            nodes=[
-                                _Child(
-                                    "/kernel/KERNEL_NAMESPACE",  # noqa: E501;
-                                    "tfseks"),
-                                _Child(
-                                    "/kernel/KERNEL_DOMAIN",  # noqa: E501;
-                                    "mcafee.soc")
-                            ],
-                            key="/kernel")
-                    ],
-                    key="/")
-            ])
+            _directory(
+                "/",
+                _directory("/kernel", _key("/kernel/KERNEL_NAMESPACE", "tfseks"),
+                           _key("/kernel/KERNEL_DOMAIN", "mcafee.soc")),
+                _directory("/empty")))
     ])
 @mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
                  {'ETCDCTL_PEERS': 'http://localhost:2373'})
-def test_collect_with_single_resource(etcd_inventory_output, read_side_effect):
+def test_collect_with_single_resource(etcd_inventory_output, tree):
     """Test when there are resources to collect from."""
     with mock.patch.object(Config, '__init__', lambda x: None), \
             mock.patch.object(Config, 'get') as mocked_config, \
-            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd, \
-            mock.patch('metamorphctl.commands.inventory.etcd.Etcd') as mock_etcd:
-
-        mocked_config.return_value = {"etcd": ["key"]}
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
 
-        mock_etcd.generate_output.return_value = etcd_inventory_output
+        mocked_config.side_effect = _config(["key"])
+        etcd.Client.return_value = _FakeClient(tree)
 
-        etcd.Client().read.side_effect = read_side_effect
         result = Etcd().collect()
 
         assert result == etcd_inventory_output
+
+
+@mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
+                 {'ETCDCTL_PEERS': 'http://localhost:2373'})
+def test_collect_deep_keyspace_one_directory_at_a_time():
+    """Test deep directories are read one by one, without recursion."""
+    depth = sys.getrecursionlimit() + 100
+    tree = leaf = _directory("/")
+    for level in range(depth):
+        child = _directory("{}/d{}".format(leaf["key"].rstrip("/"), level))
+        leaf["nodes"].append(child)
+        leaf = child
+    leaf["nodes"].append(_key(leaf["key"] + "/last", "value"))
+    client = _FakeClient(tree)
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', side_effect=_config(["key", "value"])), \
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
+        etcd.Client.return_value = client
+        result = Etcd().collect()
+
+    assert len(client.reads) == depth + 1
+    for _ in range(depth):
+        result = result["children"][0]
+    assert result["children"] == [{"key": leaf["key"] + "/last", "value": "value"}]
+
+
+@mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
+                 {'ETCDCTL_PEERS': 'http://localhost:2373'})
+def test_iter_collect_yields_every_directory():
+    """Test iter_collect streams the keys of each directory, empty ones as a key."""
+    tree = _directory(
+        "/",
+        _directory("/kernel", _key("/kernel/KERNEL_NAMESPACE", "tfseks")),
+        _directory("/empty"),
+        _key("/version", "3"))
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', side_effect=_config(["key"])), \
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
+        etcd.Client.return_value = _FakeClient(tree)
+        result = list(Etcd().iter_collect())
+
+    # the root comes first, the top-level directories as soon as they are read
+    assert result[0] == ("/", [{"key": "/version"}])
+    assert sorted(result[1:]) == [
+        ("/empty", [{"key": "/empty"}]),
+        ("/kernel", [{"key": "/kernel/KERNEL_NAMESPACE"}]),
+    ]
+
+
+class _SlowClient(_FakeClient):
+    """Time out the reads under a directory."""
+
+    def __init__(self, tree, slow, max_timeout=5):
+        super().__init__(tree)
+        self.slow = slow
+        self.max_timeout = max_timeout
+
+    def read(self, key, recursive=False, timeout=None):
+        if key.startswith(self.slow):
+            assert 0 < timeout <= self.max_timeout
+            raise EtcdConnectionFailed("read timed out")
+        return super().read(key, recursive, timeout)
+
+
+@mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
+                 {'ETCDCTL_PEERS': 'http://localhost:2373'})
+def test_collect_reads_top_level_directories_in_parallel():
+    """Test every top-level directory is read on its own, a timeout only loses its subtree."""
+    tree = _directory(
+        "/",
+        _directory("/kernel", _key("/kernel/KERNEL_NAMESPACE", "tfseks")),
+        _directory("/registry", _directory("/registry/pods", _key("/registry/pods/a", "1"))),
+        _key("/version", "3"),
+        _directory("/flannel", _key("/flannel/config", "{}")))
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', side_effect=_config(
+                ["key"], {"max_workers": 3, "timeout": 5})), \
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
+        etcd.EtcdConnectionFailed = EtcdConnectionFailed
+        etcd.Client.return_value = _SlowClient(tree, "/registry")
+        collector = Etcd()
+        result = collector.collect()
+        streamed = dict(collector.iter_collect())
+
+    assert etcd.Client.call_args[1]["per_host_pool_size"] == 3
+    assert [child.get("path", child.get("key")) for child in result["children"]] == [
+        "/kernel", "/registry", "/version", "/flannel"]
+    assert result["children"][0]["children"] == [{"key": "/kernel/KERNEL_NAMESPACE"}]
+    assert result["children"][1] == {"type": "directory", "path": "/registry",
+                                     "error": "read timed out"}
+    assert result["children"][3]["children"] == [{"key": "/flannel/config"}]
+    assert streamed == {
+        "/": [{"key": "/version"}],
+        "/kernel": [{"key": "/kernel/KERNEL_NAMESPACE"}],
+        "/registry": {"error": "read timed out"},
+        "/flannel": [{"key": "/flannel/config"}],
+    }
+
+
+@mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
+                 {'ETCDCTL_PEERS': 'http://localhost:2373'})
+def test_iter_collect_reads_ahead_of_the_caller_in_a_bounded_queue():
+    """Test the subtrees wait for the caller, and stop when it does not read everything."""
+    tree = _directory("/", *[
+        _directory("/top{}".format(top), *[_directory("/top{}/d{}".format(top, level))
+                                           for level in range(50)])
+        for top in range(3)])
+    client = _FakeClient(tree)
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', side_effect=_config(["key"], {"max_workers": 2})), \
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
+        etcd.Client.return_value = client
+        streamed = Etcd().iter_collect()
+        first = [next(streamed) for _ in range(3)]
+        closing = threading.Thread(target=streamed.close)
+        closing.start()
+        closing.join(timeout=5)
+
+    assert not closing.is_alive()
+    assert first[0] == ("/", [])
+    # only the directories the queue has room for are read ahead of the caller
+    assert len(client.reads) < 20
+
+
+@mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
+                 {'ETCDCTL_PEERS': 'https://etcd-0:2379, https://etcd-1:2379,https://etcd-2'})
+def test_reads_spread_over_every_peer():
+    """Test a client is built per peer and reads take turns, failing over when one is down."""
+    tree = _directory("/", *[_directory("/dir-{}".format(index), _key(
+        "/dir-{}/key".format(index), "value")) for index in range(6)])
+    clients = []
+
+    def _client(**kwargs):
+        clients.append(_SlowClient(tree, "/", 10) if kwargs["host"] == "etcd-1" else
+                       _FakeClient(tree))
+        return clients[-1]
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', side_effect=_config(["key"])), \
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
+        etcd.EtcdConnectionFailed = EtcdConnectionFailed
+        etcd.Client.side_effect = _client
+        result = Etcd().collect()
+
+    assert result["children_count"] == 6
+    assert [(call[1]["host"], call[1]["port"]) for call in etcd.Client.call_args_list] == [
+        ("etcd-0", 2379), ("etcd-1", 2379), ("etcd-2", 2379)]
+    assert all(call[1]["protocol"] == "https" and not call[1]["allow_reconnect"]
+               for call in etcd.Client.call_args_list)
+    # the reads of etcd-1 are retried on etcd-2, etcd-0 keeps its own share
+    assert [len(client.reads) for client in clients] == [3, 0, 4]
+
+
+class _BlackholedClient(_SlowClient):
+    """Time out every read, counting them."""
+
+    def __init__(self, tree):
+        super().__init__(tree, "/", 10)
+        self.attempts = 0
+
+    def read(self, key, recursive=False, timeout=None):
+        self.attempts += 1
+        return super().read(key, recursive, timeout)
+
+
+@mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
+                 {'ETCDCTL_PEERS': 'https://etcd-0:2379,https://etcd-1:2379'})
+def test_failed_peer_is_skipped_until_its_backoff_is_over():
+    """Test a peer timing out is tried last for peer_backoff seconds, then probed again."""
+    tree = _directory("/", *[_directory("/dir-{}".format(index)) for index in range(6)])
+    blackholed = _BlackholedClient(tree)
+    healthy = _FakeClient(tree)
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', side_effect=_config(
+                ["key"], {"max_workers": 1, "peer_backoff": 0.2})), \
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
+        etcd.EtcdConnectionFailed = EtcdConnectionFailed
+        etcd.Client.side_effect = [healthy, blackholed]
+        collector = Etcd()
+        first = collector.collect()
+        attempts = blackholed.attempts
+        time.sleep(0.3)
+        collector.collect()
+
+    assert first["children_count"] == 6
+    assert len(healthy.reads) == 14
+    # only the first read of its share went to the blackholed peer, the next ones skipped it
+    assert attempts == 1
+    assert blackholed.attempts == 2
+
+
+@mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
+                 {'ETCDCTL_PEERS': 'http://localhost:2373'})
+def test_incremental_only_reads_the_changes(tmp_path):
+    """Test the incremental mode merges the events since the previous run into its snapshot."""
+    tree = _directory(
+        "/",
+        _directory("/kernel", _key("/kernel/a", "1"), _key("/kernel/b", "2")),
+        _directory("/registry", _key("/registry/x", "3")))
+    events = [
+        ("set", {"key": "/kernel/c", "value": "4", "modifiedIndex": 11, "createdIndex": 11}),
+        ("set", {"key": "/kernel/a", "value": "5", "modifiedIndex": 12, "createdIndex": 2}),
+        ("delete", {"key": "/registry", "dir": True, "modifiedIndex": 14, "createdIndex": 1}),
+        ("set", {"key": "/new/deep/key", "value": "6", "modifiedIndex": 15,
+                 "createdIndex": 15}),
+    ]
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', side_effect=_config(
+                ["key", "value"], {"incremental": True})), \
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
+        etcd.EtcdException = EtcdException
+        etcd.EtcdConnectionFailed = EtcdConnectionFailed
+        etcd.Client.return_value = _WatchedClient(tree, 10)
+        collector = Etcd()
+        collector.cache_folder = str(tmp_path)
+        full = collector.collect()
+
+        client = _WatchedClient(tree, 15, events)
+        etcd.Client.return_value = client
+        collector = Etcd()
+        collector.cache_folder = str(tmp_path)
+        result = collector.collect()
+
+    assert full["children"][0]["children"] == [{"key": "/kernel/a", "value": "1"},
+                                               {"key": "/kernel/b", "value": "2"}]
+    # only the current index was read, the rest came from the events
+    assert client.reads == ["/"]
+    assert result == {
+        "type": "directory", "path": "/", "children": [{
+            "type": "directory", "path": "/kernel", "children": [
+                {"key": "/kernel/a", "value": "5"}, {"key": "/kernel/b", "value": "2"},
+                {"key": "/kernel/c", "value": "4"}], "children_count": 3
+        }, {
+            "type": "directory", "path": "/new", "children": [{
+                "type": "directory", "path": "/new/deep", "children": [
+                    {"key": "/new/deep/key", "value": "6"}], "children_count": 1
+            }], "children_count": 1
+        }], "children_count": 2
+    }
+
+
+@mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
+                 {'ETCDCTL_PEERS': 'http://localhost:2373'})
+def test_incremental_reads_everything_once_events_are_cleared(tmp_path):
+    """Test the keyspace is read again when etcd no longer has the events since the snapshot."""
+    tree = _directory("/", _directory("/kernel", _key("/kernel/a", "1")))
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', side_effect=_config(
+                ["key"], {"incremental": True})), \
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
+        etcd.EtcdException = EtcdException
+        etcd.EtcdConnectionFailed = EtcdConnectionFailed
+        etcd.Client.return_value = _WatchedClient(tree, 10)
+        collector = Etcd()
+        collector.cache_folder = str(tmp_path)
+        list(collector.iter_collect())
+
+        client = _WatchedClient(tree, 5000, oldest_index=4000)
+        etcd.Client.return_value = client
+        collector = Etcd()
+        collector.cache_folder = str(tmp_path)
+        result = list(collector.iter_collect())
+
+    assert result == [("/", []), ("/kernel", [{"key": "/kernel/a"}])]
+    assert client.reads == ["/", "/", "/", "/kernel"]
+    snapshot = json.loads(next((tmp_path / "etcd").iterdir()).read_text())
+    assert snapshot["etcd_index"] == 5000
+
+
+@mock.patch.dict('metamorphctl.commands.inventory.etcd.os.environ',
+                 {'ETCDCTL_PEERS': 'http://localhost:2373'})
+def test_incremental_watch_timeout_reads_everything(tmp_path):
+    """Test a watch timing out never moves the snapshot past events it did not get."""
+    tree = _directory("/", _directory("/registry", _key("/registry/secret", "s3cr3t")))
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', side_effect=_config(
+                ["key"], {"incremental": True})), \
+            mock.patch('metamorphctl.commands.inventory.etcd.etcd', autospec=True) as etcd:
+        etcd.EtcdException = EtcdException
+        etcd.EtcdConnectionFailed = EtcdConnectionFailed
+        etcd.Client.return_value = _WatchedClient(tree, 10)
+        collector = Etcd()
+        collector.cache_folder = str(tmp_path)
+        collector.collect()
+
+        snapshot_file = next((tmp_path / "etcd").iterdir())
+        # only the user reads the snapshot, and it holds the requested values only
+        assert stat.S_IMODE(os.stat(str(snapshot_file)).st_mode) == 0o600
+        assert "s3cr3t" not in snapshot_file.read_text()
+
+        # the event at index 11 is not served in time
+        client = _WatchedClient(tree, 12)
+        etcd.Client.return_value = client
+        collector = Etcd()
+        collector.cache_folder = str(tmp_path)
+        collector.collect()
+
+    assert client.reads == ["/", "/", "/", "/registry"]
+    assert json.loads(snapshot_file.read_text())["etcd_index"] == 12
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Informer tests."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import json
+from unittest.mock import Mock
+
+import pytest
+
+from metamorphctl.commands.inventory.informer import Informer
+
+
+def _pod(uid, version, phase="Pending"):
+    return {"metadata": {"uid": uid, "resourceVersion": version}, "status": {"phase": phase}}
+
+
+def _watch_response(*events):
+    lines = "".join(json.dumps(event) + "\n" for event in events)
+    # split in the middle of a line, like a chunked http response
+    return Mock(read_chunked=Mock(return_value=[lines[:10].encode(), lines[10:].encode()]))
+
+
+def test_watch_events_update_the_store():
+    """Test added, modified and deleted objects are applied from the list resourceVersion."""
+    api = Mock(return_value=_watch_response(
+        {"type": "ADDED", "object": _pod("c", "11")},
+        {"type": "MODIFIED", "object": _pod("a", "12", "Running")},
+        {"type": "DELETED", "object": _pod("b", "13")},
+    ))
+    lister = Mock(return_value={"metadata": {"resourceVersion": "10"},
+                                "items": [_pod("a", "5"), _pod("b", "6")]})
+    informer = Informer(api, lister)
+
+    informer._relist()
+    informer._watch()
+
+    assert api.call_args[1]["resource_version"] == "10"
+    assert api.call_args[1]["watch"] is True
+    assert informer.items() == [_pod("a", "12", "Running"), _pod("c", "11")]
+    assert informer.resource_version == "13"
+    api.return_value.release_conn.assert_called_once()
+
+
+def test_expired_watch_lists_again():
+    """Test a 410 event rebuilds the store from a new list."""
+    api = Mock(return_value=_watch_response(
+        {"type": "ERROR", "object": {"code": 410, "message": "too old resource version"}},
+        {"type": "ADDED", "object": _pod("ignored", "30")},
+    ))
+    lister = Mock(side_effect=[
+        {"metadata": {"resourceVersion": "10"}, "items": [_pod("a", "5")]},
+        {"metadata": {"resourceVersion": "20"}, "items": [_pod("b", "19")]},
+    ])
+    informer = Informer(api, lister)
+
+    informer._relist()
+    informer._watch()
+
+    assert lister.call_count == 2
+    assert informer.items() == [_pod("b", "19")]
+    assert informer.resource_version == "20"
+
+
+def test_other_watch_errors_are_raised():
+    """Test other error events end the watch with an exception, so it is retried later."""
+    api = Mock(return_value=_watch_response(
+        {"type": "ERROR", "object": {"code": 500, "message": "internal error"}}))
+    informer = Informer(api, Mock(return_value={"items": []}))
+
+    with pytest.raises(RuntimeError, match="internal error"):
+        informer._watch()
@@ -20,13 +20,18 @@
 # express and approved by McAfee in writing
 
 import json
+import threading
+import weakref
 from unittest import mock
 
-from kubernetes.client import (ApiClient, ApiextensionsV1beta1Api, CustomObjectsApi)
+from kubernetes.client import (ApiClient, ApiextensionsV1beta1Api, CustomObjectsApi,
+                               V1Namespace, V1NamespaceList, V1ObjectMeta)
 from kubernetes.client.rest import ApiException
 from mock import patch, Mock
 
 from metamorphctl.utils.config import Config
+from metamorphctl.commands.inventory.informer import Informer
+from metamorphctl.commands.inventory import k8s
 from metamorphctl.commands.inventory.k8s import Kubernetes
 
 # pylint: disable=unused-argument
@@ -36,20 +41,22 @@ def test_collect_with_empty_resources():
     """Test when there is no k8s resource to collect from."""
     with mock.patch.object(Config, '__init__', lambda x: None), \
             mock.patch.object(Config, 'get') as mocked_config:
-        mocked_config.return_value = {'kubernetes': []}
+        mocked_config.side_effect = _inventory({'kubernetes': []})
         result = Kubernetes().collect()
         assert not result  # empty result
 
 
-@patch('metamorphctl.commands.inventory.k8s.load_kubernetes')
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
 @patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
-def test_collect_with_single_resource(mock_find_api, mock_load_kubernetes):
+def test_collect_with_single_resource(mock_find_api, mock_load_kubeconfig):
     """Test when there is a single resource to collect from."""
     with mock.patch.object(Config, '__init__', lambda x: None), \
             mock.patch.object(Config, 'get') as mocked_config:
-        mocked_config.return_value = {"kubernetes": [{"title": "myresource", "api": "random-api"}]}
+        mocked_config.side_effect = _inventory(
+            {"kubernetes": [{"title": "myresource", "api": "random-api"}]})
         myresource_value = {"items": ["something"]}
-        mock_find_api.return_value = lambda: myresource_value
+        mock_find_api.return_value = lambda _preload_content: Mock(
+            data=json.dumps(myresource_value))
         expected = {"myresource": myresource_value["items"]}
 
         result = Kubernetes().collect()
@@ -58,13 +65,179 @@ def test_collect_with_single_resource(mock_find_api, mock_load_kubernetes):
         assert result == expected
 
 
-@patch('metamorphctl.commands.inventory.k8s.load_kubernetes')
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
 @patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
-def test_continue_collecting_on_api_exception(mock_find_api, mock_load_kubernetes):
+def test_collect_models_when_raw_is_disabled(mock_find_api, mock_load_kubeconfig):
+    """Test a title with raw false is deserialized into kubernetes models."""
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get') as mocked_config:
+        mocked_config.side_effect = _inventory({
+            "kubernetes": [{"title": "namespaces", "api": "list_namespace", "raw": False}]
+        })
+        namespaces = V1NamespaceList(items=[V1Namespace(metadata=V1ObjectMeta(name="default"))])
+        mock_find_api.return_value = lambda: namespaces
+
+        result = Kubernetes().collect()
+
+        assert result == {"namespaces": [{"metadata": {"name": "default"}}]}
+
+
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
+@patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
+def test_collect_titles_concurrently(mock_find_api, mock_load_kubeconfig):
+    """Test titles are listed at the same time and returned in the config order."""
+    settings = {"kubernetes": {"max_workers": 2}}
+    inventory = {"kubernetes": [{"title": "pods", "api": "pods"},
+                                {"title": "nodes", "api": "nodes"}]}
+    # each list call waits for the other one, which only works if both run at once
+    barrier = threading.Barrier(2, timeout=5)
+
+    def api(name):
+        def call(_preload_content):
+            barrier.wait()
+            return Mock(data=json.dumps({"items": [name]}))
+        return call
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', lambda x, key: {
+                "inventory": inventory, "inventory_settings": settings}[key]):
+        mock_find_api.side_effect = api
+
+        result = Kubernetes().collect()
+
+    assert list(result.items()) == [("pods", ["pods"]), ("nodes", ["nodes"])]
+
+
+class _Items(list):
+    """A list that can be weakly referenced."""
+
+
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
+@patch('metamorphctl.commands.inventory.k8s._handle_request')
+def test_iter_collect_keeps_at_most_max_workers_titles(mock_handle_request, mock_load_kubeconfig):
+    """Test titles are submitted max_workers at a time and released once yielded."""
+    settings = {"kubernetes": {"max_workers": 2}}
+    inventory = {"kubernetes": [{"title": str(index), "api": "pods"} for index in range(5)]}
+    started = []
+
+    def handle_request(req):
+        started.append(req["title"])
+        return _Items([req["title"]])
+
+    mock_handle_request.side_effect = handle_request
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', lambda x, key: {
+                "inventory": inventory, "inventory_settings": settings}[key]):
+        streamed = Kubernetes().iter_collect()
+        title, items = next(streamed)
+        released = weakref.ref(items)
+        assert len(started) == 2
+        del items
+        rest = [next(streamed)]
+        # the first title is not kept by the collector while the others are collected
+        assert released() is None
+        rest += list(streamed)
+
+    assert sorted([title] + [title for title, _ in rest]) == ["0", "1", "2", "3", "4"]
+
+
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
+@patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
+def test_informer_mode_lists_only_once(mock_find_api, mock_load_kubeconfig):
+    """Test in informer mode the titles are served from the informer store."""
+    settings = {"kubernetes": {"informer": True}}
+    inventory = {"kubernetes": [{"title": "pods", "api": "list_pod_for_all_namespaces"},
+                                {"title": "metrics", "api": "list_pod_metrics"}]}
+    pod = {"metadata": {"uid": "pod-1"}}
+    api = Mock(return_value=Mock(data=json.dumps({"items": [pod]})))
+    mock_find_api.return_value = api
+
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get', lambda x, key: {
+                "inventory": inventory, "inventory_settings": settings}[key]), \
+            mock.patch.object(Informer, '_run'), \
+            mock.patch.object(ApiClient, 'call_api') as mock_metrics:
+        mock_metrics.return_value = [Mock(data=json.dumps({"items": ["metric"]}))]
+        collector = Kubernetes()
+        first = collector.collect()
+        second = collector.collect()
+        collector.stop()
+
+    assert first == second == {"pods": [pod], "metrics": ["metric"]}
+    # the list api is only called once, workarounds can not be watched and are listed again
+    api.assert_called_once_with(_preload_content=False)
+    assert mock_metrics.call_count == 2
+    mock_load_kubeconfig.assert_called_once()
+
+
+def _chunk(items, next_token=None):
+    metadata = {"continue": next_token} if next_token else {}
+    return Mock(data=json.dumps({"metadata": metadata, "items": items}))
+
+
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
+@patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
+def test_collect_in_chunks_with_limit(mock_find_api, mock_load_kubeconfig):
+    """Test a title with limit follows the continue tokens."""
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get') as mocked_config:
+        mocked_config.side_effect = _inventory({
+            "kubernetes": [{"title": "pods", "api": "list_pod_for_all_namespaces", "limit": 2}]
+        })
+        api = Mock(side_effect=[_chunk(["a", "b"], "t1"), _chunk(["c", "d"], "t2"), _chunk(["e"])])
+        mock_find_api.return_value = api
+
+        result = Kubernetes().collect()
+
+        assert result == {"pods": ["a", "b", "c", "d", "e"]}
+        assert api.call_args_list == [
+            mock.call(_preload_content=False, limit=2),
+            mock.call(_preload_content=False, limit=2, _continue="t1"),
+            mock.call(_preload_content=False, limit=2, _continue="t2"),
+        ]
+
+
+@patch('metamorphctl.commands.inventory.k8s._execute_k8s_api_raw')
+def test_raw_items_are_not_copied(mock_execute):
+    """Test the items listed from the chunks are the title items, not a copy of them."""
+    items = [{"metadata": {"name": "pod-1"}}]
+    mock_execute.return_value = {"metadata": {}, "items": items}
+
+    assert k8s._handle_request({"title": "pods", "api": "pods", "limit": 2}) is items
+    mock_execute.return_value = {"metadata": {}, "items": None}
+    assert k8s._handle_request({"title": "pods", "api": "pods"}) == []
+
+
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
+@patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
+def test_collect_restarts_list_when_continue_expires(mock_find_api, mock_load_kubeconfig):
+    """Test an expired continue token (410) lists the title again from the start."""
+    with mock.patch.object(Config, '__init__', lambda x: None), \
+            mock.patch.object(Config, 'get') as mocked_config:
+        mocked_config.side_effect = _inventory({
+            "kubernetes": [{"title": "pods", "api": "list_pod_for_all_namespaces", "limit": 2}]
+        })
+        api = Mock(side_effect=[
+            _chunk(["a", "b"], "t1"),
+            ApiException(status=410, reason="Gone"),
+            _chunk(["a", "b2"], "t3"),
+            _chunk(["c"]),
+        ])
+        mock_find_api.return_value = api
+
+        result = Kubernetes().collect()
+
+        assert result == {"pods": ["a", "b2", "c"]}
+        assert api.call_args_list[2] == mock.call(_preload_content=False, limit=2)
+
+
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
+@patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
+def test_continue_collecting_on_api_exception(mock_find_api, mock_load_kubeconfig):
     """Test it continues collecting on ApiException."""
     with mock.patch.object(Config, '__init__', lambda x: None), \
             mock.patch.object(Config, 'get') as mocked_config:
-        mocked_config.return_value = {
+        mocked_config.side_effect = _inventory({
             "kubernetes": [{
                 "title": "pod",
                 "api": "pod"
@@ -72,14 +245,16 @@ def test_continue_collecting_on_api_exception(mock_find_api, mock_load_kubernete
                 "title": "node",
                 "api": "node"
             }]
-        }
+        })
         pod_value = {'error': 'Not Found'}
         node_value = {'items': ['bar']}
         expected = {'pod': pod_value, 'node': node_value['items']}
-        # raise exception for the first call, but not for the second
-        mock_find_api.side_effect = [
-            lambda: _raise(ApiException(reason='Not Found')), lambda: node_value
-        ]
+        # raise exception for the pod api, but not for the node one
+        apis = {
+            "pod": lambda _preload_content: _raise(ApiException(reason='Not Found')),
+            "node": lambda _preload_content: Mock(data=json.dumps(node_value))
+        }
+        mock_find_api.side_effect = apis.get
 
         result = Kubernetes().collect()
 
@@ -87,13 +262,13 @@ def test_continue_collecting_on_api_exception(mock_find_api, mock_load_kubernete
         assert result == expected
 
 
-@patch('metamorphctl.commands.inventory.k8s.load_kubernetes')
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
 @patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
-def test_continue_collecting_on_value_error_exception(mock_find_api, mock_load_kubernetes):
+def test_continue_collecting_on_value_error_exception(mock_find_api, mock_load_kubeconfig):
     """Test it continues collecting on ApiException."""
     with mock.patch.object(Config, '__init__', lambda x: None), \
             mock.patch.object(Config, 'get') as mocked_config:
-        mocked_config.return_value = {
+        mocked_config.side_effect = _inventory({
             "kubernetes": [{
                 "title": "pod",
                 "api": "pod"
@@ -101,12 +276,16 @@ def test_continue_collecting_on_value_error_exception(mock_find_api, mock_load_k
                 "title": "node",
                 "api": "node"
             }]
-        }
+        })
         pod_value = {'error': ''}
         node_value = {'items': ['bar']}
         expected = {'pod': pod_value, 'node': node_value['items']}
-        # raise exception for the first call, but not for the second
-        mock_find_api.side_effect = [lambda: _raise(ValueError()), lambda: node_value]
+        # raise exception for the pod api, but not for the node one
+        apis = {
+            "pod": lambda _preload_content: _raise(ValueError()),
+            "node": lambda _preload_content: Mock(data=json.dumps(node_value))
+        }
+        mock_find_api.side_effect = apis.get
 
         result = Kubernetes().collect()
 
@@ -114,18 +293,18 @@ def test_continue_collecting_on_value_error_exception(mock_find_api, mock_load_k
         assert result == expected
 
 
-@patch('metamorphctl.commands.inventory.k8s.load_kubernetes')
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
 @patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
-def test_collect_list_controller_revision_for_all_namespaces(mock_find_api, mock_load_kubernetes):
+def test_collect_list_controller_revision_for_all_namespaces(mock_find_api, mock_load_kubeconfig):
     """Test collect works with list_controller_revision_for_all_namespaces."""
     with mock.patch.object(Config, '__init__', lambda x: None), \
             mock.patch.object(Config, 'get') as mocked_config:
-        mocked_config.return_value = {
+        mocked_config.side_effect = _inventory({
             "kubernetes": [{
                 "title": "list_controller_revision_for_all_namespaces",
                 "api": "list_controller_revision_for_all_namespaces"
             }]
-        }
+        })
         resource_value = {'items': ['bar']}
         expected = {'list_controller_revision_for_all_namespaces': resource_value['items']}
         mock_find_api.return_value = lambda _preload_content: Mock(data=json.dumps(resource_value))
@@ -136,18 +315,18 @@ def test_collect_list_controller_revision_for_all_namespaces(mock_find_api, mock
         assert result == expected
 
 
-@patch('metamorphctl.commands.inventory.k8s.load_kubernetes')
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
 @patch('metamorphctl.commands.inventory.k8s.find_api_in_kubernetes')
-def test_collect_list_api_service(mock_find_api, mock_load_kubernetes):
+def test_collect_list_api_service(mock_find_api, mock_load_kubeconfig):
     """Test collect works with list_api_service."""
     with mock.patch.object(Config, '__init__', lambda x: None), \
             mock.patch.object(Config, 'get') as mocked_config:
-        mocked_config.return_value = {
+        mocked_config.side_effect = _inventory({
             "kubernetes": [{
                 "title": "list_api_service",
                 "api": "list_api_service"
             }]
-        }
+        })
         resource_value = {'items': ['bar']}
         expected = {'list_api_service': resource_value['items']}
         mock_find_api.return_value = lambda _preload_content: Mock(data=json.dumps(resource_value))
@@ -158,18 +337,18 @@ def test_collect_list_api_service(mock_find_api, mock_load_kubernetes):
         assert result == expected
 
 
-@patch('metamorphctl.commands.inventory.k8s.load_kubernetes')
-def test_collect_list_pod_metrics(mock_load_kubernetes):
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
+def test_collect_list_pod_metrics(mock_load_kubeconfig):
     """Test collect works with list_pod_metrics."""
     with mock.patch.object(Config, '__init__', lambda x: None), \
             mock.patch.object(Config, 'get') as mocked_config, \
             mock.patch.object(ApiClient, 'call_api') as mock_api_client:
-        mocked_config.return_value = {
+        mocked_config.side_effect = _inventory({
             "kubernetes": [{
                 "title": "list_pod_metrics",
                 "api": "list_pod_metrics"
             }]
-        }
+        })
         resource_value = {'items': ['bar']}
         expected = {'list_pod_metrics': resource_value['items']}
         mock_api_client.return_value = [Mock(data=json.dumps(resource_value))]
@@ -180,18 +359,18 @@ def test_collect_list_pod_metrics(mock_load_kubernetes):
         assert result == expected
 
 
-@patch('metamorphctl.commands.inventory.k8s.load_kubernetes')
-def test_collect_list_node_metrics(mock_load_kubernetes):
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
+def test_collect_list_node_metrics(mock_load_kubeconfig):
     """Test collect works with list_node_metrics."""
     with mock.patch.object(Config, '__init__', lambda x: None), \
             mock.patch.object(Config, 'get') as mocked_config, \
             mock.patch.object(ApiClient, 'call_api') as mock_api_client:
-        mocked_config.return_value = {
+        mocked_config.side_effect = _inventory({
             "kubernetes": [{
                 "title": "list_node_metrics",
                 "api": "list_node_metrics"
             }]
-        }
+        })
         resource_value = {'items': ['bar']}
         expected = {'list_node_metrics': resource_value['items']}
         mock_api_client.return_value = [Mock(data=json.dumps(resource_value))]
@@ -202,8 +381,8 @@ def test_collect_list_node_metrics(mock_load_kubernetes):
         assert result == expected
 
 
-@patch('metamorphctl.commands.inventory.k8s.load_kubernetes')
-def test_collect_list_cluster_custom_object(mock_load_kubernetes):
+@patch('metamorphctl.commands.inventory.k8s.load_kubeconfig')
+def test_collect_list_cluster_custom_object(mock_load_kubeconfig):
     """Test collect works with list_cluster_custom_object."""
 
     with mock.patch.object(Config, '__init__', lambda x: None), \
@@ -212,12 +391,12 @@ def test_collect_list_cluster_custom_object(mock_load_kubernetes):
                 ApiextensionsV1beta1Api, 'list_custom_resource_definition') as mock_custom, \
             mock.patch.object(CustomObjectsApi, 'list_cluster_custom_object') as mock_cluster_api:
 
-        mocked_config.return_value = {
+        mocked_config.side_effect = _inventory({
             "kubernetes": [{
                 "title": "list_cluster_custom_object",
                 "api": "list_cluster_custom_object"
             }]
-        }
+        })
 
         monitoring_params = {
             'metadata.name': 'monitoring_core_os',
@@ -255,5 +434,10 @@ def test_collect_list_cluster_custom_object(mock_load_kubernetes):
         assert result == expected
 
 
+def _inventory(inventory):
+    """Answer Config().get with the inventory, other sections are not configured."""
+    return lambda key: inventory if key == "inventory" else None
+
+
 def _raise(ex):
     raise ex
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""Inventory command tests."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2019 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from click.testing import CliRunner
+
+from metamorphctl.commands import inventory_command
+from metamorphctl.commands.inventory.report_handlers.jmespath_custom import JMESPATH_OPT
+from metamorphctl.commands.kernels.k8s_certified import K8sCertifiedOperator
+from metamorphctl.utils.config import Config
+
+
+def _collector(name, result=None, error=None):
+    instance = MagicMock()
+    if error:
+        instance.collect.side_effect = error
+        instance.iter_collect.side_effect = error
+    else:
+        instance.collect.return_value = result
+        instance.iter_collect.side_effect = lambda: iter(result.items())
+    return {"name": name, "instance": instance}
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"awsv2": [], "kubernetes": [], "etcd": []})
+@patch.object(inventory_command, '_write_output')
+@patch.object(inventory_command, '_build_collectors')
+def test_parallel_collectors_keep_order_and_errors(build_mock, write_mock):
+    """Test collectors run in parallel keep their order and isolate errors."""
+    build_mock.return_value = [
+        _collector("awsv2", result={"VPC": ["vpc-1"]}),
+        _collector("kubernetes", error=RuntimeError("boom")),
+        _collector("etcd", result={"type": "directory"}),
+    ]
+
+    res = CliRunner().invoke(inventory_command.cli, ['--systems', 'all', '--parallel', '3'])
+
+    assert res.exit_code == 0, res.output
+    content = write_mock.call_args[0][2]
+    assert set(content.keys()) == {"dateUtc", "systems"}
+    assert list(content["systems"].keys()) == ["awsv2", "kubernetes", "etcd"]
+    assert content["systems"]["awsv2"] == {"VPC": ["vpc-1"]}
+    assert content["systems"]["kubernetes"] == {"error": "boom"}
+    assert content["systems"]["etcd"] == {"type": "directory"}
+
+
+def _k8s_config(key):
+    return {"inventory": {"kubernetes": [{"title": "Pods", "api": "list_pod_for_all_namespaces"}]},
+            "inventory_settings": {}}[key]
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, key: _k8s_config(key))
+@patch('metamorphctl.commands.inventory.k8s._handle_request', lambda req: ["pod-1"])
+@patch('metamorphctl.utils.kubeutils.config.load_kube_config')
+def test_kubernetes_collector_runs_outside_of_the_click_context(load_mock, tmp_path):
+    """Test the kubernetes collector loads its kubeconfig from the collector threads."""
+    output = tmp_path / "inventory.json"
+    streamed = tmp_path / "inventory.ndjson"
+
+    res = CliRunner().invoke(
+        inventory_command.cli, ['--systems', 'kubernetes', '--file', str(output)])
+    streamed_res = CliRunner().invoke(
+        inventory_command.cli,
+        ['--systems', 'kubernetes', '--output', 'ndjson', '--file', str(streamed)])
+
+    assert res.exit_code == 0, res.output
+    assert streamed_res.exit_code == 0, streamed_res.output
+    assert json.loads(output.read_text())["systems"] == {"kubernetes": {"Pods": ["pod-1"]}}
+    assert json.loads(streamed.read_text()) == {
+        "system": "kubernetes", "title": "Pods", "record": "pod-1"}
+    load_mock.assert_called_with(config_file=None)
+
+
+def test_parallel_must_be_positive():
+    """Test --parallel rejects values lower than one."""
+    res = CliRunner().invoke(inventory_command.cli, ['--parallel', '0'])
+
+    assert res.exit_code != 0
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"awsv2": [{"title": "VPC", "id": "VpcId"}]})
+@patch.object(inventory_command, '_write_output')
+@patch.object(inventory_command, '_build_collectors')
+def test_since_writes_only_changes(build_mock, write_mock, tmp_path):
+    """Test --since writes the delta against the previous inventory."""
+    previous = tmp_path / "previous.json"
+    previous.write_text(json.dumps({
+        "dateUtc": "2020-01-01T00:00:00",
+        "systems": {"awsv2": {"VPC": [{"VpcId": "vpc-1"}, {"VpcId": "vpc-2"}]}}
+    }))
+    build_mock.return_value = [_collector("awsv2", result={"VPC": [{"VpcId": "vpc-1"}]})]
+
+    res = CliRunner().invoke(inventory_command.cli, ['--since', str(previous)])
+
+    assert res.exit_code == 0, res.output
+    content = write_mock.call_args[0][2]
+    assert content["since"] == {"file": str(previous), "dateUtc": "2020-01-01T00:00:00"}
+    assert content["summary"] == {"added": 0, "removed": 1, "changed": 0, "unchanged": 1}
+    assert content["systems"] == {
+        "awsv2": {"VPC": {"added": [], "removed": [{"VpcId": "vpc-2"}], "changed": []}}
+    }
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"awsv2": [{"title": "VPC"}]})
+@patch.object(inventory_command, '_build_collectors')
+def test_from_file_generates_report_without_collecting(build_mock, tmp_path):
+    """Test --from-file runs the report handler over a saved inventory."""
+    saved = tmp_path / "inventory.json"
+    saved.write_text(json.dumps({"systems": {"awsv2": {"VPC": [{"VpcId": "vpc-1"}]}}}))
+
+    with patch.dict(inventory_command.REPORT_HANDLERS, {"excel": MagicMock()}):
+        res = CliRunner().invoke(
+            inventory_command.cli,
+            ['--from-file', str(saved), '--report', 'excel', '--systems', 'awsv2,etcd'])
+        handler = inventory_command.REPORT_HANDLERS["excel"]
+
+    assert res.exit_code == 0, res.output
+    build_mock.assert_not_called()
+    handler.handle.assert_called_once()
+    name, cfg, items = handler.handle.call_args[0]
+    assert name.startswith("awsv2_report-")
+    assert cfg == [{"title": "VPC"}]
+    assert items == {"VPC": [{"VpcId": "vpc-1"}]}
+    assert "No etcd inventory found" in res.output
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"awsv2": [{"title": "VPC"}]})
+def test_from_file_generates_report_of_every_kernel(tmp_path):
+    """Test --from-file over a --kernels inventory writes the reports of each kernel."""
+    saved = tmp_path / "inventory.json"
+    saved.write_text(json.dumps({"kernels": {
+        "tfseks": {"systems": {"awsv2": {"VPC": [{"VpcId": "vpc-1"}]}}},
+        "tfsprod": {"systems": {"awsv2": {"VPC": [{"VpcId": "vpc-2"}]}}},
+        "tfsdown": {"error": "no kubeconfig"},
+    }}))
+
+    with patch.dict(inventory_command.REPORT_HANDLERS, {"excel": MagicMock()}):
+        res = CliRunner().invoke(
+            inventory_command.cli, ['--from-file', str(saved), '--report', 'excel'])
+        handler = inventory_command.REPORT_HANDLERS["excel"]
+
+    assert res.exit_code == 0, res.output
+    reports = [(call[0][0], call[0][2]) for call in handler.handle.call_args_list]
+    assert [name.split("-")[0] for name, _ in reports] == [
+        "tfseks_awsv2_report", "tfsprod_awsv2_report"]
+    assert [items for _, items in reports] == [
+        {"VPC": [{"VpcId": "vpc-1"}]}, {"VPC": [{"VpcId": "vpc-2"}]}]
+    assert "No inventory of kernel tfsdown" in res.output
+
+
+def test_since_rejects_an_inventory_of_several_kernels(tmp_path):
+    """Test --since against a --kernels inventory is rejected before collecting anything."""
+    previous = tmp_path / "previous.json"
+    previous.write_text(json.dumps({"kernels": {"tfseks": {"systems": {}}}}))
+
+    res = CliRunner().invoke(inventory_command.cli, ['--since', str(previous)])
+
+    assert res.exit_code != 0
+    assert "--since requires the inventory of a single kernel" in res.output
+
+
+def test_from_file_requires_report(tmp_path):
+    """Test --from-file without --report is rejected."""
+    saved = tmp_path / "inventory.json"
+    saved.write_text("{}")
+
+    res = CliRunner().invoke(inventory_command.cli, ['--from-file', str(saved)])
+
+    assert res.exit_code != 0
+    assert "--from-file requires --report" in res.output
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"awsv2": [], "kubernetes": []})
+@patch.object(inventory_command, '_build_collectors')
+def test_ndjson_streams_one_line_per_record(build_mock, tmp_path):
+    """Test --output ndjson writes a line per record and per failed title."""
+    build_mock.return_value = [
+        _collector("awsv2", result={"VPC": [{"VpcId": "vpc-1"}, {"VpcId": "vpc-2"},
+                                            {"error": "denied", "_region": "eu-west-1"}],
+                                    "EKS": {"error": "denied"}}),
+        _collector("kubernetes", error=RuntimeError("boom")),
+    ]
+    output = tmp_path / "inventory.ndjson"
+
+    res = CliRunner().invoke(
+        inventory_command.cli, ['--systems', 'all', '--output', 'ndjson', '--file', str(output)])
+
+    assert res.exit_code == 0, res.output
+    lines = [json.loads(line) for line in output.read_text().splitlines()]
+    assert lines == [
+        {"system": "awsv2", "title": "VPC", "record": {"VpcId": "vpc-1"}},
+        {"system": "awsv2", "title": "VPC", "record": {"VpcId": "vpc-2"}},
+        {"system": "awsv2", "title": "VPC", "region": "eu-west-1", "error": "denied"},
+        {"system": "awsv2", "title": "EKS", "error": "denied"},
+        {"system": "kubernetes", "title": None, "error": "boom"},
+    ]
+
+
+def test_ndjson_rejects_since(tmp_path):
+    """Test --since cannot be combined with the streaming output."""
+    previous = tmp_path / "previous.json"
+    previous.write_text("{}")
+
+    res = CliRunner().invoke(
+        inventory_command.cli, ['--output', 'ndjson', '--since', str(previous)])
+
+    assert res.exit_code != 0
+    assert "--since cannot be used with --output ndjson" in res.output
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"awsv2": []})
+@patch.object(inventory_command, '_build_collectors')
+def test_profile_writes_sidecar(build_mock, tmp_path):
+    """Test --profile writes the collectors profile next to the inventory."""
+    build_mock.return_value = [_collector("awsv2", result={"VPC": ["vpc-1"]})]
+    output = tmp_path / "inventory.json"
+
+    res = CliRunner().invoke(
+        inventory_command.cli, ['--systems', 'all', '--file', str(output), '--profile'])
+
+    assert res.exit_code == 0, res.output
+    profile = json.loads((tmp_path / "inventory.json.profile.json").read_text())
+    assert set(profile["systems"]["awsv2"]) >= {
+        "wall_time", "api_calls", "pages", "bytes_received", "items", "peak_memory", "titles"}
+    assert not inventory_command.PROFILER.enabled
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"kubernetes": []})
+@patch.object(inventory_command, '_write_output')
+@patch.object(inventory_command, '_build_collectors')
+def test_repeat_reuses_collectors_until_stopped(build_mock, write_mock):
+    """Test --repeat collects again with the same collectors, which are stopped at the end."""
+    collector = _collector("kubernetes", result={"Pods": ["pod-1"]})
+    build_mock.return_value = [collector]
+
+    with patch.object(inventory_command.time, 'sleep', side_effect=[None, KeyboardInterrupt]):
+        CliRunner().invoke(inventory_command.cli, ['--systems', 'all', '--repeat', '60'])
+
+    build_mock.assert_called_once()
+    assert collector["instance"].collect.call_count == 2
+    assert write_mock.call_count == 2
+    collector["instance"].stop.assert_called_once()
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"awsv2": []})
+@patch.object(inventory_command, '_write_output')
+@patch.object(inventory_command, '_build_collectors')
+def test_repeat_reports_do_not_reuse_enrichments_of_previous_runs(build_mock, write_mock):
+    """Test the enrichment memo is cleared at the start of every run."""
+    build_mock.return_value = [_collector("awsv2", result={"VPC": []})]
+    functions = JMESPATH_OPT.custom_functions
+    sizes = []
+
+    def handle(name, cfg, items):
+        sizes.append(functions.memo_stats()["size"])
+        functions._remember(("aws_s3_encryption", "bucket"), {"Rules": []})
+
+    with patch.object(inventory_command.time, 'sleep', side_effect=[None, KeyboardInterrupt]), \
+            patch.dict(inventory_command.REPORT_HANDLERS, {"excel": MagicMock()}):
+        inventory_command.REPORT_HANDLERS["excel"].handle.side_effect = handle
+        CliRunner().invoke(inventory_command.cli, ['--report', 'excel', '--repeat', '60'])
+    functions.clear_memo()
+
+    assert sizes == [0, 0]
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"awsv2": []})
+@patch.object(inventory_command, '_write_output')
+@patch.object(inventory_command, '_build_collectors')
+def test_repeat_reads_the_since_inventory_once(build_mock, write_mock, tmp_path):
+    """Test the --since inventory is read once, not on every --repeat run."""
+    previous = tmp_path / "previous.json"
+    previous.write_text(json.dumps({"systems": {"awsv2": {"VPC": []}}}))
+    build_mock.return_value = [_collector("awsv2", result={"VPC": []})]
+
+    with patch.object(inventory_command.time, 'sleep', side_effect=[None, KeyboardInterrupt]), \
+            patch.object(inventory_command, '_load_inventory',
+                         wraps=inventory_command._load_inventory) as load_mock:
+        CliRunner().invoke(inventory_command.cli, ['--since', str(previous), '--repeat', '60'])
+
+    load_mock.assert_called_once_with(str(previous))
+    assert write_mock.call_count == 2
+    assert write_mock.call_args[0][2]["since"]["file"] == str(previous)
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"awsv2": []})
+@patch.object(inventory_command, '_write_output')
+@patch.object(inventory_command, '_build_collectors')
+def test_max_age_overrides_collectors_cache(build_mock, write_mock):
+    """Test --max-age is given to the cache of every collector."""
+    collector = _collector("awsv2", result={"VPC": []})
+    build_mock.return_value = [collector]
+
+    res = CliRunner().invoke(inventory_command.cli, ['--systems', 'all', '--max-age', '0'])
+
+    assert res.exit_code == 0, res.output
+    assert collector["instance"].cache.max_age == 0
+
+
+def _initialize(operator):
+    if operator.kernel_namespace == "broken":
+        raise RuntimeError("cluster not found")
+    operator.env.kubeconfig = "/tmp/{}".format(operator.kernel_namespace)
+
+
+CREDENTIALS = ['--key', 'key', '--secret', 'secret', '--region', 'us-east-1']
+
+
+def test_read_kernels_from_list_or_file(tmp_path):
+    """Test --kernels takes a comma separated list or a file with one kernel per line."""
+    kernels_file = tmp_path / "kernels.txt"
+    kernels_file.write_text("kernel-a\n# staging\n\nkernel-b  # eu\nkernel-a\n")
+
+    assert inventory_command._read_kernels("kernel-a, kernel-b,") == ["kernel-a", "kernel-b"]
+    assert inventory_command._read_kernels(str(kernels_file)) == ["kernel-a", "kernel-b"]
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"kubernetes": []})
+@patch.object(K8sCertifiedOperator, 'initialize', autospec=True, side_effect=_initialize)
+@patch.object(inventory_command, 'ProcessPoolExecutor', ThreadPoolExecutor)
+@patch.object(inventory_command, '_write_output')
+@patch.object(inventory_command, '_build_collectors')
+def test_kernels_write_combined_output(build_mock, write_mock, init_mock):
+    """Test --kernels initializes and collects every kernel into one output."""
+    build_mock.side_effect = lambda *args: [_collector("kubernetes", result={"Pods": []})]
+
+    res = CliRunner().invoke(inventory_command.cli, [
+        '--systems', 'all', '--kernels', 'kernel-a,broken', '--file', 'out.json'
+    ] + CREDENTIALS)
+
+    assert res.exit_code == 0, res.output
+    assert init_mock.call_count == 2
+    content = write_mock.call_args[0][2]
+    assert list(content["kernels"].keys()) == ["kernel-a", "broken"]
+    assert content["kernels"]["kernel-a"]["systems"] == {"kubernetes": {"Pods": []}}
+    assert content["kernels"]["broken"] == {"error": "cluster not found"}
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, key: _k8s_config(key))
+@patch.object(K8sCertifiedOperator, 'initialize', autospec=True, side_effect=_initialize)
+@patch.object(inventory_command, 'ProcessPoolExecutor', ThreadPoolExecutor)
+@patch.object(inventory_command, '_write_output')
+@patch('metamorphctl.commands.inventory.k8s._handle_request', lambda req: ["pod-1"])
+@patch('metamorphctl.utils.kubeutils.config.load_kube_config')
+def test_kernels_collect_kubernetes_with_their_kubeconfig(load_mock, write_mock, init_mock):
+    """Test the kubernetes collector of a kernel loads the kubeconfig of that kernel."""
+    res = CliRunner().invoke(inventory_command.cli, [
+        '--systems', 'kubernetes', '--kernels', 'kernel-a', '--file', 'out.json'
+    ] + CREDENTIALS)
+
+    assert res.exit_code == 0, res.output
+    content = write_mock.call_args[0][2]
+    assert content["kernels"]["kernel-a"]["systems"] == {"kubernetes": {"Pods": ["pod-1"]}}
+    load_mock.assert_called_once_with(config_file="/tmp/kernel-a")
+
+
+@patch.object(Config, '__init__', lambda x: None)
+@patch.object(Config, 'get', lambda x, y: {"kubernetes": []})
+@patch.object(K8sCertifiedOperator, 'initialize', autospec=True, side_effect=_initialize)
+@patch.object(inventory_command, 'ProcessPoolExecutor', ThreadPoolExecutor)
+@patch.object(inventory_command, '_build_collectors')
+def test_kernels_shard_one_file_per_kernel(build_mock, init_mock, tmp_path):
+    """Test --shard writes the inventory of every kernel to its own file."""
+    build_mock.side_effect = lambda *args: [_collector("kubernetes", result={"Pods": []})]
+    output_file = tmp_path / "inventory.json"
+
+    res = CliRunner().invoke(inventory_command.cli, [
+        '--systems', 'all', '--kernels', 'kernel-a,kernel-b', '--shard',
+        '--file', str(output_file)
+    ] + CREDENTIALS)
+
+    assert res.exit_code == 0, res.output
+    assert init_mock.call_count == 2
+    assert not output_file.exists()
+    shard = json.loads((tmp_path / "inventory-kernel-b.json").read_text())
+    assert shard["kernel"] == "kernel-b"
+    assert shard["systems"] == {"kubernetes": {"Pods": []}}
+
+
+def test_kernels_require_credentials():
+    """Test --kernels needs the AWS credentials used to initialize the kernels."""
+    res = CliRunner().invoke(inventory_command.cli, ['--kernels', 'kernel-a'], env={
+        "AWS_ACCESS_KEY_ID": None, "AWS_SECRET_ACCESS_KEY": None, "AWS_DEFAULT_REGION": None
+    })
+
+    assert res.exit_code != 0
+    assert "--kernels requires --key" in res.output
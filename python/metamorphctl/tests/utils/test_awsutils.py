@@ -21,7 +21,8 @@
 
 from unittest.mock import MagicMock, patch
 
-from metamorphctl.utils.awsutils import find_ec2_instance
+from metamorphctl.utils import awsutils
+from metamorphctl.utils.awsutils import find_ec2_instance, get_client
 
 
 @patch('boto3.client')
@@ -72,6 +73,60 @@ def test_find_ec2_instance_by_private_dns_name(boto_mock):
     assert ec2_instance is not None
 
 
+@patch.dict('os.environ', {'AWS_DEFAULT_REGION': 'us-east-1'}, clear=True)
+@patch('boto3.client')
+def test_get_client_is_cached(boto_mock):
+    """Test clients are only created once per service and region."""
+    boto_mock.side_effect = lambda *args, **kwargs: MagicMock()
+
+    first = get_client('ec2')
+    second = get_client('ec2')
+    other_region = get_client('ec2', region_name='eu-west-1')
+    other_service = get_client('s3')
+
+    assert first is second
+    assert first is not other_region
+    assert first is not other_service
+    assert boto_mock.call_count == 3
+    assert boto_mock.call_args_list[0][1]['region_name'] == 'us-east-1'
+
+
+@patch.dict('os.environ', {'AWS_DEFAULT_REGION': 'us-east-1'}, clear=True)
+@patch('boto3.client')
+def test_get_client_keyed_by_credentials(boto_mock):
+    """Test switching credentials does not reuse a client built with the old ones."""
+    boto_mock.side_effect = lambda *args, **kwargs: MagicMock()
+
+    first = get_client('eks', aws_access_key_id='key1', aws_secret_access_key='secret1')
+    second = get_client('eks', aws_access_key_id='key2', aws_secret_access_key='secret2')
+
+    assert first is not second
+    assert boto_mock.call_args_list[1][1]['aws_access_key_id'] == 'key2'
+    assert boto_mock.call_args_list[1][1]['aws_secret_access_key'] == 'secret2'
+
+
+@patch('boto3.client')
+def test_get_client_max_pool_connections(boto_mock):
+    """Test the connection pool size is passed to botocore."""
+    get_client('ec2', max_pool_connections=50)
+
+    assert boto_mock.call_args[1]['config'].max_pool_connections == 50
+
+
+@patch.dict('os.environ', {'AWS_DEFAULT_REGION': 'us-east-1'}, clear=True)
+@patch('boto3.client')
+def test_other_regions_are_throttled_apart(boto_mock):
+    """Test clients of other regions than the default one get their own throttle bucket."""
+    boto_mock.side_effect = lambda *args, **kwargs: MagicMock()
+
+    with patch.object(awsutils.SCHEDULER, 'register') as register:
+        get_client('ec2')
+        get_client('ec2', region_name='us-east-1')
+        get_client('ec2', region_name='eu-west-1')
+
+    assert [call[0][1] for call in register.call_args_list] == ['ec2', 'ec2@eu-west-1']
+
+
 def _by_instance_id(Filters):  # noqa
     if Filters[0]['Name'] == 'instance-id':
         return {'Reservations': MagicMock()}
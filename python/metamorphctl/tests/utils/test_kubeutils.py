@@ -20,10 +20,12 @@
 # express and approved by McAfee in writing
 
 import uuid
+from unittest import mock
 
 import pytest
 from kubernetes import client
 
+from metamorphctl.utils import kubeutils
 from metamorphctl.utils.kubeutils import (SelectorOperator, SelectorParser,
                                           find_api_in_kubernetes)
 
@@ -142,3 +144,34 @@ def test_raise_when_api_is_not_found_in_kubernetes():
     api_name = str(uuid.uuid4())
     with pytest.raises(AttributeError):
         find_api_in_kubernetes(api_name)
+
+
+def test_suggest_near_misses_when_api_is_not_found():
+    """Test the error lists the apis with a close name."""
+    with pytest.raises(AttributeError, match="did you mean: list_pod_for_all_namespaces"):
+        find_api_in_kubernetes('list_pods_for_all_namespaces')
+
+
+def test_api_index_shares_one_api_client():
+    """Test the index is built once, every api using the same ApiClient."""
+    kubeutils.reset_api_index()
+    with mock.patch.object(client, 'ApiClient', wraps=client.ApiClient) as api_client:
+        pods = find_api_in_kubernetes('list_pod_for_all_namespaces')
+        nodes = find_api_in_kubernetes('list_node')
+        find_api_in_kubernetes('list_deployment_for_all_namespaces')
+
+    assert api_client.call_count == 1
+    assert pods.__self__.api_client is nodes.__self__.api_client
+    assert isinstance(pods.__self__, client.CoreV1Api)
+    kubeutils.reset_api_index()
+
+
+def test_shared_api_client_uses_configured_pool_size():
+    """Test the shared ApiClient is rebuilt with the requested connection pool size."""
+    kubeutils.reset_api_index(connection_pool_maxsize=7)
+    api_client = kubeutils.shared_api_client()
+
+    assert api_client.configuration.connection_pool_maxsize == 7
+    assert api_client.rest_client.pool_manager.connection_pool_kw['maxsize'] == 7
+    assert kubeutils.shared_api_client() is api_client
+    kubeutils.reset_api_index()
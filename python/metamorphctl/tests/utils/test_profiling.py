@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Profiling tests."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import threading
+from unittest.mock import MagicMock
+
+from metamorphctl.utils.profiling import Profiler
+
+
+def test_disabled_profiler_records_nothing():
+    """Test sections are a no-op until the profiler is started."""
+    profiler = Profiler()
+
+    with profiler.section("awsv2", "VPC"):
+        profiler.record_call(100)
+
+    assert profiler.report() == {"systems": {}}
+
+
+def test_calls_are_accounted_to_the_thread_section():
+    """Test titles run in other threads keep their own counters."""
+    profiler = Profiler()
+    profiler.start()
+
+    def collect(title, calls):
+        with profiler.section("awsv2", title):
+            for _ in range(calls):
+                profiler.record_call(10)
+            profiler.record_items(list(range(calls)))
+
+    with profiler.section("awsv2"):
+        profiler.record_call(5, page=False)
+        threads = [threading.Thread(target=collect, args=("VPC", 2)),
+                   threading.Thread(target=collect, args=("EC2", 3))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    profiler.stop()
+
+    awsv2 = profiler.report()["systems"]["awsv2"]
+    assert awsv2["titles"]["VPC"]["api_calls"] == 2
+    assert awsv2["titles"]["EC2"]["bytes_received"] == 30
+    assert awsv2["titles"]["EC2"]["items"] == 3
+    assert awsv2["api_calls"] == 6
+    assert awsv2["pages"] == 5
+    assert awsv2["bytes_received"] == 55
+    assert awsv2["items"] == 5
+    assert awsv2["wall_time"] >= 0
+    assert awsv2["peak_memory"] >= 0
+
+
+def test_boto_responses_are_recorded():
+    """Test the needs-retry hook records calls, pages and bytes."""
+    profiler = Profiler()
+    client = MagicMock()
+    profiler.register(client)
+    event, handler = client.meta.events.register.call_args[0]
+    profiler.start()
+
+    with profiler.section("awsv2", "VPC"):
+        handler(response=(MagicMock(content=b"12345", status_code=200), {}))
+        handler(response=(MagicMock(content=b"123", status_code=503), {}))
+        handler(response=None)
+    profiler.stop()
+
+    stats = profiler.report()["systems"]["awsv2"]["titles"]["VPC"]
+    assert event == "needs-retry"
+    assert (stats["api_calls"], stats["pages"], stats["bytes_received"]) == (3, 1, 8)
+
+
+def test_peak_memory_is_kept_per_section():
+    """Test a title holding memory does not inflate the peak of the titles run after it."""
+    profiler = Profiler()
+    profiler.start()
+
+    with profiler.section("kubernetes"):
+        with profiler.section("kubernetes", "Pods"):
+            pods = [bytearray(1024) for _ in range(1024)]
+            profiler.record_items(pods)
+            del pods
+        with profiler.section("kubernetes", "Nodes"):
+            profiler.record_items([])
+    profiler.stop()
+
+    report = profiler.report()
+    kubernetes = report["systems"]["kubernetes"]
+    assert kubernetes["titles"]["Pods"]["peak_memory"] >= 1024 * 1024
+    assert kubernetes["titles"]["Nodes"]["peak_memory"] < 100 * 1024
+    assert kubernetes["peak_memory"] >= 1024 * 1024
+    assert report["peak_memory"] >= 1024 * 1024
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Throttling tests."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+from unittest.mock import MagicMock
+
+from metamorphctl.utils import throttling
+from metamorphctl.utils.throttling import RequestScheduler, TokenBucket
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_bucket_paces_requests_after_burst():
+    """Test requests beyond the burst wait for the bucket to refill."""
+    clock = _Clock()
+    bucket = TokenBucket(rate=10.0, burst=2.0, clock=clock, sleep=clock.sleep)
+
+    waits = [bucket.acquire() for _ in range(4)]
+
+    assert waits[:2] == [0.0, 0.0]
+    assert all(wait > 0 for wait in waits[2:])
+    assert round(clock.now, 2) == 0.2
+    assert bucket.requests == 4
+    assert round(bucket.waited, 2) == 0.2
+
+
+def test_bucket_aimd():
+    """Test the rate grows additively and is cut multiplicatively."""
+    bucket = TokenBucket(rate=10.0)
+
+    bucket.on_success()
+    bucket.on_success()
+    assert bucket.rate == 10.0 + 2 * throttling.ADDITIVE_INCREASE
+
+    bucket.on_throttle()
+    assert bucket.rate == (10.0 + 2 * throttling.ADDITIVE_INCREASE) * \
+        throttling.MULTIPLICATIVE_DECREASE
+    assert bucket.throttled == 1
+
+    for _ in range(20):
+        bucket.on_throttle()
+    assert bucket.rate == throttling.MIN_RATE
+
+
+def test_scheduler_hooks_adapt_to_throttling():
+    """Test the client hooks feed throttling responses back to the service bucket."""
+    scheduler = RequestScheduler()
+    client = MagicMock()
+    scheduler.register(client, 'ec2')
+    hooks = {call[0][0]: call[0][1] for call in client.meta.events.register.call_args_list}
+
+    hooks['before-send'](request=MagicMock())
+    throttled = (MagicMock(status_code=503), {'Error': {'Code': 'RequestLimitExceeded'}})
+    assert hooks['needs-retry'](response=throttled, attempts=1) is None
+    hooks['needs-retry'](response=(MagicMock(status_code=200), {}), attempts=2)
+    hooks['needs-retry'](response=None, caught_exception=ValueError(), attempts=3)
+
+    stats = scheduler.stats()['ec2']
+    assert stats['requests'] == 1
+    assert stats['throttled'] == 1
+    assert stats['rate'] == throttling.INITIAL_RATE * throttling.MULTIPLICATIVE_DECREASE + \
+        throttling.ADDITIVE_INCREASE
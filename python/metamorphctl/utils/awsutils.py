@@ -18,13 +18,125 @@
 # of the Materials, either expressly, by implication, inducement, estoppel or
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
+import os
+import threading
 
 import boto3
+from botocore.config import Config as BotoConfig
+
+from metamorphctl.utils.profiling import PROFILER
+from metamorphctl.utils.throttling import SCHEDULER
+
+# Keep-alive connections kept by each cached client (botocore defaults to 10)
+MAX_POOL_CONNECTIONS = 20
+
+# Key added to the records collected in another region than the default one, so they are
+# looked up in their region later on
+REGION_KEY = "_region"
+
+_CLIENTS = {}
+_RESOURCES = {}
+# boto3 clients are thread safe, but creating them from the shared default session is not
+_LOCK = threading.Lock()
+
+
+def is_region_error(record):
+    """Return whether a record stands for a region its title could not be collected in."""
+    return isinstance(record, dict) and set(record.keys()) == {"error", REGION_KEY}
+
+
+def get_client(service, region_name=None, aws_access_key_id=None, aws_secret_access_key=None,
+               aws_session_token=None, max_pool_connections=MAX_POOL_CONNECTIONS):
+    """Return a boto3 client cached for the whole process.
+
+    Clients are built from the boto3 default session and keyed by service, region and
+    credentials, so loading the service model and opening the connection pool only happens
+    once. Credentials and region default to the `AWS_*` environment variables, which lets a
+    kernel initialization switch accounts without reusing stale clients.
+    Their requests are paced by the throttle aware scheduler of the service.
+    """
+    args = _resolve_args(region_name, aws_access_key_id, aws_secret_access_key,
+                         aws_session_token)
+    key = _cache_key(service, args, max_pool_connections)
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = boto3.client(service, **_boto_kwargs(args, max_pool_connections))
+                SCHEDULER.register(client, _bucket_name(service, region_name))
+                PROFILER.register(client)
+                _CLIENTS[key] = client
+    return client
+
+
+def get_resource(service, region_name=None, aws_access_key_id=None, aws_secret_access_key=None,
+                 aws_session_token=None, max_pool_connections=MAX_POOL_CONNECTIONS):
+    """Return a boto3 resource cached for the whole process.
+
+    Unlike clients, resources are not thread safe, so do not share them between threads.
+    """
+    args = _resolve_args(region_name, aws_access_key_id, aws_secret_access_key,
+                         aws_session_token)
+    key = _cache_key(service, args, max_pool_connections)
+    with _LOCK:
+        resource = _RESOURCES.get(key)
+        if resource is None:
+            resource = boto3.resource(service, **_boto_kwargs(args, max_pool_connections))
+            SCHEDULER.register(resource.meta.client, _bucket_name(service, region_name))
+            PROFILER.register(resource.meta.client)
+            _RESOURCES[key] = resource
+    return resource
+
+
+def clear_clients():
+    """Forget every cached client and resource."""
+    with _LOCK:
+        _CLIENTS.clear()
+        _RESOURCES.clear()
+
+
+def _resolve_args(region_name, aws_access_key_id, aws_secret_access_key, aws_session_token):
+    """Fill region and credentials from the environment when not given."""
+    environ = os.environ
+    if not aws_access_key_id:
+        aws_access_key_id = environ.get("AWS_ACCESS_KEY_ID")
+        aws_secret_access_key = environ.get("AWS_SECRET_ACCESS_KEY")
+        aws_session_token = environ.get("AWS_SESSION_TOKEN")
+    return (region_name or environ.get("AWS_DEFAULT_REGION"), aws_access_key_id,
+            aws_secret_access_key, aws_session_token)
+
+
+def _bucket_name(service, region_name):
+    """AWS throttles per service and region, other regions than the default get their bucket."""
+    if not region_name or region_name == os.environ.get("AWS_DEFAULT_REGION"):
+        return service
+    return "{}@{}".format(service, region_name)
+
+
+def _cache_key(service, args, max_pool_connections):
+    """Key clients by everything but the secret, which is implied by the access key."""
+    region_name, aws_access_key_id, _, aws_session_token = args
+    return service, region_name, aws_access_key_id, aws_session_token, max_pool_connections
+
+
+def _boto_kwargs(args, max_pool_connections):
+    """Build boto3 client arguments, only needed when the client is not cached yet."""
+    region_name, aws_access_key_id, aws_secret_access_key, aws_session_token = args
+    kwargs = {"config": BotoConfig(max_pool_connections=max_pool_connections)}
+    if region_name:
+        kwargs["region_name"] = region_name
+    if aws_access_key_id:
+        # the default session caches the first credentials it resolves, so pass them explicitly
+        kwargs["aws_access_key_id"] = aws_access_key_id
+        kwargs["aws_secret_access_key"] = aws_secret_access_key
+        kwargs["aws_session_token"] = aws_session_token
+    return kwargs
 
 
 def find_ec2_instance(node):
     """Find EC2 instance by instance_id, private ip or private dns."""
-    ec2 = boto3.client('ec2')
+    ec2 = get_client('ec2')
 
     by_instance_id = ec2.describe_instances(Filters=[{
         'Name': 'instance-id',
@@ -19,8 +19,10 @@
 # otherwise. Any license under such intellectual property rights must be
 # express and approved by McAfee in writing
 
+from difflib import get_close_matches
 from time import sleep
 import json
+import threading
 
 from jinja2 import Template
 from kubernetes import client, config
@@ -43,6 +45,13 @@ K8S_INTERFACES = [
     'StorageV1alpha1Api', 'StorageV1Api', 'StorageV1beta1Api', 'SettingsV1alpha1Api'
 ]
 
+# api name -> bound method of the first K8S_INTERFACES class providing it, built once
+_API_INDEX = {}
+# ApiClient shared by the indexed apis, and the size of its connection pool
+# (None keeps the kubernetes library default)
+_API_CLIENT = {'api_client': None, 'connection_pool_maxsize': None}
+_API_INDEX_LOCK = threading.Lock()
+
 
 class SelectorOperator():
     """Available selector operators based on kubernetes documentation."""
@@ -115,10 +124,26 @@ class SelectorParser():
 @pass_environment
 def load_kubernetes(env=None):
     """Load kubernetes based on its configuration."""
+    # If kubeconfig is in environment use it, otherwise default to system
+    load_kubeconfig(getattr(env, 'kubeconfig', None))
+
+
+@pass_environment
+def current_kubeconfig(env=None):
+    """Return the kubeconfig of the environment, None for the one of the system.
+
+    The environment is kept by the click context of the current thread, threads started by
+    a command have none: they get the kubeconfig from it and call load_kubeconfig.
+    """
+    return getattr(env, 'kubeconfig', None)
+
+
+def load_kubeconfig(kubeconfig=None):
+    """Load kubernetes from a kubeconfig file, None for the one of the system."""
     try:
-        # If kubeconfig is in environment use it, otherwise default to system
-        kubeconfig = getattr(env, 'kubeconfig', None)
         config.load_kube_config(config_file=kubeconfig)
+        # the indexed apis hold an ApiClient built with the previous configuration
+        reset_api_index()
     except TypeError:
         print("There was a problem loading kubernetes configuration.\n"
               "Please check that you have initialized a kubernetes environment.\n"
@@ -234,14 +259,61 @@ def find_pod_network_policies(pod):
 
 def find_api_in_kubernetes(api_name):
     """Find api by name in the kubernetes library and return it."""
-    for interface in K8S_INTERFACES:
-        interface_obj = getattr(client, interface, None)
-        if interface_obj is not None:
-            method_obj = getattr(interface_obj(), api_name, None)
-            if method_obj is not None:
-                return method_obj
-    # Only raise in the case the api couldn't be found in any k8s interface
-    raise AttributeError("Could not find: {} in kubernetes library".format(api_name))
+    index = _api_index()
+    method_obj = index.get(api_name)
+    if method_obj is None:
+        near_misses = get_close_matches(api_name, index.keys(), n=3)
+        hint = ", did you mean: {}?".format(", ".join(near_misses)) if near_misses else ""
+        raise AttributeError("Could not find: {} in kubernetes library{}".format(api_name, hint))
+    return method_obj
+
+
+def shared_api_client():
+    """Return the ApiClient shared by the indexed apis, so its connection pool is reused."""
+    with _API_INDEX_LOCK:
+        return _shared_api_client()
+
+
+def reset_api_index(connection_pool_maxsize=None):
+    """Forget the indexed apis, they are built again from the current configuration.
+
+    connection_pool_maxsize sets the connections kept open by the new shared ApiClient, it
+    should not be lower than the number of threads calling the apis at the same time.
+    None keeps the kubernetes library default.
+    """
+    with _API_INDEX_LOCK:
+        _API_INDEX.clear()
+        _API_CLIENT['api_client'] = None
+        _API_CLIENT['connection_pool_maxsize'] = connection_pool_maxsize
+
+
+def _shared_api_client():
+    if _API_CLIENT['api_client'] is None:
+        # a copy of the default configuration, as loaded by load_kubernetes
+        configuration = client.Configuration()
+        if _API_CLIENT['connection_pool_maxsize']:
+            configuration.connection_pool_maxsize = _API_CLIENT['connection_pool_maxsize']
+        _API_CLIENT['api_client'] = client.ApiClient(configuration)
+    return _API_CLIENT['api_client']
+
+
+def _api_index():
+    """Return the api index, building it with a single shared ApiClient the first time."""
+    with _API_INDEX_LOCK:
+        if not _API_INDEX:
+            api_client = _shared_api_client()
+            for interface in K8S_INTERFACES:
+                interface_obj = getattr(client, interface, None)
+                if interface_obj is None:
+                    continue
+                api = interface_obj(api_client)
+                for name in dir(api):
+                    # the first interface providing a name wins, as in K8S_INTERFACES order
+                    if not name.startswith('_') and name not in _API_INDEX:
+                        method_obj = getattr(api, name)
+                        if callable(method_obj):
+                            _API_INDEX[name] = method_obj
+        return _API_INDEX
 
 
 def exist_node(node_name):
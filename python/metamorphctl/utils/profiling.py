@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Per collector and per title profiling of inventory runs."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+COUNTERS = ('api_calls', 'pages', 'bytes_received', 'items')
+
+
+class Profiler():
+    """Collect wall time, API calls, pages, bytes, items and peak memory per section.
+
+    A section is a collector (title None) or one of its titles. The section being run is
+    kept per thread, so API calls are accounted to the title of the thread that made them.
+    The peak memory of a section is the highest memory traced by tracemalloc at its API calls,
+    item counts and end, above the memory in use when it started. tracemalloc is process wide,
+    so it includes the titles run at the same time. The real peak of the whole run, which
+    tracemalloc keeps itself, is reported apart.
+    """
+
+    def __init__(self):
+        """Init."""
+        self.enabled = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sections = {}
+        self._run_peak = None
+
+    def start(self):
+        """Enable profiling, memory is traced until stop() is called."""
+        with self._lock:
+            self._sections = {}
+        self._run_peak = None
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+
+    def stop(self):
+        """Disable profiling."""
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            self._run_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    @contextmanager
+    def section(self, system, title=None):
+        """Account everything run by this thread inside the block to system/title."""
+        if not self.enabled:
+            yield {}
+            return
+        stats = dict.fromkeys(COUNTERS, 0)
+        previous = getattr(self._local, 'section', None)
+        self._local.section = stats
+        # the process wide peak of tracemalloc cannot be reset per section before python 3.9,
+        # the memory is sampled instead
+        stats['_memory_start'] = stats['_memory_peak'] = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats['wall_time'] = round(time.perf_counter() - start, 3)
+            _sample_memory(stats)
+            memory_peak = stats.pop('_memory_peak')
+            stats['peak_memory'] = memory_peak - stats.pop('_memory_start')
+            self._local.section = previous
+            if previous is not None:
+                # the memory the section held is part of the enclosing one too
+                previous['_memory_peak'] = max(previous['_memory_peak'], memory_peak)
+            with self._lock:
+                self._sections[(system, title)] = stats
+
+    def record_call(self, bytes_received=0, page=True):
+        """Account an API call (and the page it returned) to the current section."""
+        stats = getattr(self._local, 'section', None)
+        if not self.enabled or stats is None:
+            return
+        stats['api_calls'] += 1
+        stats['pages'] += 1 if page else 0
+        stats['bytes_received'] += bytes_received
+        _sample_memory(stats)
+
+    def record_items(self, items):
+        """Record how many items the current section collected."""
+        stats = getattr(self._local, 'section', None)
+        if self.enabled and stats is not None:
+            stats['items'] = len(items) if isinstance(items, list) else 0
+            _sample_memory(stats)
+
+    def register(self, client):
+        """Account every response (including retries) received by a boto3 client."""
+
+        def needs_retry(response=None, **kwargs):  # pylint: disable=unused-argument
+            if response is None:
+                self.record_call(page=False)
+                return
+            http_response = response[0]
+            self.record_call(len(http_response.content or b''), http_response.status_code < 400)
+
+        client.meta.events.register('needs-retry', needs_retry)
+        return client
+
+    def report(self):
+        """Return the profile of every collector, including its titles and their totals."""
+        with self._lock:
+            sections = dict(self._sections)
+        systems = {}
+        for (system, title), stats in sections.items():
+            entry = systems.setdefault(system, {'titles': {}})
+            if title is None:
+                entry.update(stats)
+            else:
+                entry['titles'][title] = stats
+        for entry in systems.values():
+            for counter in COUNTERS:
+                entry[counter] = entry.get(counter, 0) + sum(
+                    stats[counter] for stats in entry['titles'].values())
+        report = {'systems': systems}
+        if self._run_peak is not None:
+            report['peak_memory'] = self._run_peak
+        return report
+
+
+def _sample_memory(stats):
+    """Raise the peak of a section to the memory traced now."""
+    stats['_memory_peak'] = max(stats['_memory_peak'], tracemalloc.get_traced_memory()[0])
+
+
+PROFILER = Profiler()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Throttle aware scheduling of AWS requests."""
+
+
+# MCAFEE CONFIDENTIAL
+# Copyright © 2020 McAfee LLC.
+# The source code contained or described herein and all documents related to
+# the source code ("Material") are owned by McAfee Corporation or its suppliers
+# or licensors. Title to the Material remains with McAfee Corporation or its
+# suppliers and licensors. The Material contains trade secrets and proprietary
+# and confidential information of McAfee or its suppliers and licensors. The
+# Material is protected by worldwide copyright and trade secret laws and
+# treaty provisions. No part of the Material may be used, copied, reproduced,
+# modified, published, uploaded, posted, transmitted, distributed, or
+# disclosed in any way without McAfee's prior express written permission.
+#
+# No license under any patent, copyright, trade secret or other intellectual
+# property right is granted to or conferred upon you by disclosure or delivery
+# of the Materials, either expressly, by implication, inducement, estoppel or
+# otherwise. Any license under such intellectual property rights must be
+# express and approved by McAfee in writing
+
+import threading
+import time
+
+# Requests per second allowed per service when a client is created, and its bounds
+INITIAL_RATE = 20.0
+MIN_RATE = 1.0
+MAX_RATE = 100.0
+# Requests that can be sent at once after some idle time
+BURST = 10.0
+# AIMD: successful requests raise the rate slowly, throttled ones cut it
+ADDITIVE_INCREASE = 0.5
+MULTIPLICATIVE_DECREASE = 0.5
+
+THROTTLING_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+    'BandwidthLimitExceeded', 'RequestThrottled', 'SlowDown', 'EC2ThrottledException',
+    'PriorRequestNotComplete'
+}
+
+
+class TokenBucket():
+    """Token bucket whose refill rate adapts to throttling (AIMD)."""
+
+    def __init__(self, rate=INITIAL_RATE, burst=BURST, clock=time.monotonic, sleep=time.sleep):
+        """Init."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.waited = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available. Return the seconds waited."""
+        with self._lock:
+            now = self._clock()
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            # reserve the token now, callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.requests += 1
+            self.waited += wait
+        if wait:
+            self._sleep(wait)
+        return wait
+
+    def on_success(self):
+        """Raise the rate after a request that was not throttled."""
+        with self._lock:
+            self.rate = min(MAX_RATE, self.rate + ADDITIVE_INCREASE)
+
+    def on_throttle(self):
+        """Cut the rate after a throttled request."""
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(MIN_RATE, self.rate * MULTIPLICATIVE_DECREASE)
+
+
+class RequestScheduler():
+    """Pace the requests of every registered boto3 client with one bucket per service."""
+
+    def __init__(self):
+        """Init."""
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, service):
+        """Return the bucket of an AWS service."""
+        with self._lock:
+            if service not in self._buckets:
+                self._buckets[service] = TokenBucket()
+            return self._buckets[service]
+
+    def register(self, client, service):
+        """Route every request (including botocore retries) of a client through its bucket."""
+        bucket = self.bucket(service)
+
+        def before_send(**kwargs):  # pylint: disable=unused-argument
+            bucket.acquire()
+
+        def needs_retry(response=None, **kwargs):  # pylint: disable=unused-argument
+            if response is None:
+                return
+            http_response, parsed = response
+            if parsed.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+                bucket.on_throttle()
+            elif http_response.status_code < 400:
+                bucket.on_success()
+
+        client.meta.events.register('before-send', before_send)
+        client.meta.events.register('needs-retry', needs_retry)
+        return client
+
+    def stats(self):
+        """Return, per service, the current rate, the requests sent and how long they waited."""
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {
+            service: {
+                'rate': round(bucket.rate, 2),
+                'requests': bucket.requests,
+                'throttled': bucket.throttled,
+                'waited_seconds': round(bucket.waited, 3)
+            }
+            for service, bucket in buckets.items()
+        }
+
+
+SCHEDULER = RequestScheduler()